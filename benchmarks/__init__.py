@@ -0,0 +1,4 @@
+"""
+Benchmarks for ess.  Each one is run as a module, for instance
+C{python -m benchmarks.sftp --help}, and writes its results as JSON.
+"""
@@ -0,0 +1,300 @@
+"""
+Module that provides what the benchmarks share: an in-process essftp
+server on loopback, a Conch SFTP client to drive it, timing helpers and
+JSON results.
+"""
+import json
+import platform
+import sys
+import tempfile
+import time
+
+from Crypto.PublicKey import RSA
+
+from zope.interface import implementer
+
+from twisted.conch.ssh import (channel, common, connection, filetransfer,
+                               keys, transport, userauth)
+from twisted.internet import defer, protocol, task
+from twisted.python import usage
+from twisted.python.filepath import FilePath
+import twisted
+
+from ess.checkers import IAuthorizedKeysDB, SSHPublicKeyChecker
+
+
+USERNAME = 'bench'
+
+
+def parseList(value, parse=int):
+    """
+    Parse a comma separated list of values
+
+    @param parse: a callable that parses one value
+    """
+    return [parse(v) for v in value.split(',') if v]
+
+
+def parseSize(value):
+    """
+    Parse a size in bytes, with an optional C{k}, C{m} or C{g} suffix
+    """
+    value = value.lower()
+    for suffix, multiplier in (('k', 1 << 10), ('m', 1 << 20),
+                               ('g', 1 << 30)):
+        if value.endswith(suffix):
+            return int(float(value[:-1]) * multiplier)
+    return int(value)
+
+
+class BenchmarkOptions(usage.Options):
+    """
+    Options shared by every benchmark
+    """
+    optParameters = [
+        ["output", "o", None, "File to write the JSON results to (default: "
+            "standard output)"],
+        ["repeat", "n", 3, "Number of times to run each measurement (the "
+            "best run is reported)", int]
+    ]
+
+
+def percentiles(values, points=(50, 90, 99, 99.9)):
+    """
+    @return: C{dict} mapping C{'pN'} to the Nth percentile of C{values}
+        (nearest rank), plus C{'max'}
+    """
+    values = sorted(values)
+    if not values:
+        return {}
+    result = {'max': values[-1]}
+    for point in points:
+        rank = max(0, int(round(point / 100.0 * len(values) + 0.5)) - 1)
+        result['p{0:g}'.format(point)] = values[min(rank, len(values) - 1)]
+    return result
+
+
+def writeResults(options, name, results, parameters=None, **extra):
+    """
+    Write benchmark results, with what they were measured on, as JSON
+
+    @param options: the L{BenchmarkOptions}
+    @param name: C{str} name of the benchmark
+    @param results: C{list} of C{dict}s, one per measurement
+    @param parameters: C{dict} of the parameters of the benchmark
+    @param extra: anything else to write, by key
+    """
+    document = {
+        'benchmark': name,
+        'time': time.time(),
+        'parameters': parameters or {},
+        'environment': {
+            'python': sys.version.split()[0],
+            'implementation': platform.python_implementation(),
+            'twisted': twisted.__version__,
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+        },
+        'results': results,
+    }
+    document.update(extra)
+    text = json.dumps(document, indent=2, sort_keys=True) + '\n'
+    if options['output']:
+        with open(options['output'], 'w') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+
+def run(main, options):
+    """
+    Parse the command line and run a benchmark on the reactor
+
+    @param main: a callable that takes the reactor and the parsed
+        C{options}, and returns a L{defer.Deferred}
+    @param options: the L{BenchmarkOptions} (subclass) instance to parse the
+        command line with
+    """
+    try:
+        options.parseOptions(sys.argv[1:])
+    except usage.UsageError as e:
+        raise SystemExit('{0}\n{1}'.format(options, e))
+    task.react(main, [options])
+
+
+def generateKey(bits=2048):
+    """
+    @return: a new RSA L{keys.Key}, for clients to authenticate with
+    """
+    return keys.Key(RSA.generate(bits))
+
+
+@implementer(IAuthorizedKeysDB)
+class _StaticKeyDB(object):
+    def __init__(self, keys):
+        self.keys = keys
+
+    def getAuthorizedKeys(self, username):
+        return self.keys.get(username, [])
+
+
+class Server(object):
+    """
+    An essftp server, configured like the essftp plugin, listening on
+    loopback in this process
+
+    @ivar root: L{FilePath} of the root directory the server serves
+    @ivar port: the listening port
+    """
+    def __init__(self, reactor, clientKey, root=None, args=()):
+        """
+        @param clientKey: L{keys.Key} that clients authenticate with
+        @param root: C{str} path of the directory to serve (the default is a
+            new temporary directory)
+        @param args: C{list} of extra essftp plugin command line arguments
+        """
+        from twisted.plugins.essftp_plugin import Options, serviceMaker
+        if root is None:
+            root = tempfile.mkdtemp(prefix='essbench')
+        self.root = FilePath(root)
+        options = Options()
+        options.parseOptions(['--root', self.root.path] + list(args))
+        options['credCheckers'] = [SSHPublicKeyChecker(
+            _StaticKeyDB({USERNAME: [clientKey.public()]}))]
+        factory = serviceMaker.makeFactory(options)
+        self.port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+
+    def getPort(self):
+        """
+        @return: C{int} port number the server listens on
+        """
+        return self.port.getHost().port
+
+    def stop(self):
+        """
+        Stop listening (sessions already open stay open)
+        """
+        return self.port.stopListening()
+
+
+class _FileTransferClient(filetransfer.FileTransferClient):
+    def __init__(self, ready):
+        filetransfer.FileTransferClient.__init__(self)
+        self.ready = ready
+
+    def gotServerVersion(self, serverVersion, extData):
+        self.ready.callback(self)
+
+
+class _SFTPChannel(channel.SSHChannel):
+    name = 'session'
+
+    def __init__(self, ready, *args, **kwargs):
+        channel.SSHChannel.__init__(self, *args, **kwargs)
+        self.ready = ready
+
+    def channelOpen(self, data):
+        d = self.conn.sendRequest(self, 'subsystem', common.NS('sftp'),
+                                  wantReply=True)
+        d.addCallbacks(self._cbSubsystem, self.ready.errback)
+
+    def _cbSubsystem(self, ignored):
+        self.client = _FileTransferClient(self.ready)
+        self.client.makeConnection(self)
+        self.dataReceived = self.client.dataReceived
+
+    def openFailed(self, reason):
+        self.ready.errback(reason)
+
+
+class _Connection(connection.SSHConnection):
+    def __init__(self, ready, channelOptions):
+        connection.SSHConnection.__init__(self)
+        self.ready = ready
+        self.channelOptions = channelOptions
+
+    def serviceStarted(self):
+        connection.SSHConnection.serviceStarted(self)
+        self.openChannel(_SFTPChannel(self.ready, conn=self,
+                                      **self.channelOptions))
+
+
+class _UserAuth(userauth.SSHUserAuthClient):
+    def __init__(self, user, key, instance):
+        userauth.SSHUserAuthClient.__init__(self, user, instance)
+        self.key = key
+        self.offered = False
+
+    def getPublicKey(self):
+        if self.offered:
+            return None
+        self.offered = True
+        return self.key.public()
+
+    def getPrivateKey(self):
+        return defer.succeed(self.key)
+
+
+class _ClientTransport(transport.SSHClientTransport):
+    def verifyHostKey(self, hostKey, fingerprint):
+        return defer.succeed(True)
+
+    def connectionSecure(self):
+        self.requestService(_UserAuth(
+            self.factory.username, self.factory.key,
+            _Connection(self.factory.ready, self.factory.channelOptions)))
+
+    def connectionLost(self, reason):
+        transport.SSHClientTransport.connectionLost(self, reason)
+        if not self.factory.ready.called:
+            self.factory.ready.errback(reason)
+
+
+def connect(reactor, port, key, username=USERNAME, host='127.0.0.1',
+            **channelOptions):
+    """
+    Open an SFTP session
+
+    @param key: L{keys.Key} to authenticate with
+    @param channelOptions: keyword arguments for the session channel (such
+        as C{localWindow} and C{localMaxPacket})
+
+    @return: a L{defer.Deferred} that fires with a
+        L{filetransfer.FileTransferClient} once the session is ready - see
+        L{disconnect} to close it
+    """
+    factory = protocol.ClientFactory()
+    factory.protocol = _ClientTransport
+    factory.username = username
+    factory.key = key
+    factory.channelOptions = channelOptions
+    factory.ready = defer.Deferred()
+    reactor.connectTCP(host, port, factory)
+    return factory.ready
+
+
+def disconnect(client):
+    """
+    Close the connection of an SFTP session opened by L{connect}
+    """
+    client.transport.conn.transport.transport.loseConnection()
+
+
+@defer.inlineCallbacks
+def pipelined(items, depth, function):
+    """
+    Call a function on every item, with up to C{depth} calls outstanding at
+    once
+
+    @param function: a callable that takes an item and returns a
+        L{defer.Deferred}
+    """
+    items = iter(items)
+
+    @defer.inlineCallbacks
+    def drain():
+        for item in items:
+            yield function(item)
+
+    yield defer.gatherResults([drain() for _ in range(depth)],
+                              consumeErrors=True)
@@ -0,0 +1,25 @@
+"""
+Run a L{benchmarks._harness.Server} on its own, so that benchmarks can
+measure the server process apart from the clients driving it.  The port it
+listens on is written to standard output once it is listening.
+
+    python -m benchmarks._serve PUBLIC_KEY_FILE ROOT [ESSFTP ARGUMENTS...]
+"""
+import sys
+
+from twisted.conch.ssh.keys import Key
+from twisted.internet import reactor
+
+from benchmarks import _harness
+
+
+def main(argv):
+    key = Key.fromFile(argv[0])
+    server = _harness.Server(reactor, key, root=argv[1], args=argv[2:])
+    sys.stdout.write('{0}\n'.format(server.getPort()))
+    sys.stdout.flush()
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
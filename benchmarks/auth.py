@@ -0,0 +1,184 @@
+"""
+Authentication benchmark: logins per second and latency percentiles of
+L{ess.checkers.SSHPublicKeyChecker}, with each authorized keys provider, as
+the number of keys in the user's authorized_keys file and the number of
+concurrent logins grow.
+
+Users and home directories are faked (with L{twisted.python.fakepwd} and a
+temporary directory), the way the tests do.  The key logged in with is the
+last one in the file, so every key is read.  Concurrent logins only overlap
+with providers that return L{twisted.internet.defer.Deferred}s.
+
+    python -m benchmarks.auth --keyCounts 1,100,1000 --providers unix,cached
+"""
+import os
+import shutil
+import struct
+import tempfile
+import time
+
+from Crypto.PublicKey import RSA
+
+from twisted.cred.credentials import SSHPrivateKey
+from twisted.conch.ssh.keys import Key
+from twisted.internet import defer
+from twisted.python import usage
+from twisted.python.fakepwd import UserDatabase
+
+from ess.checkers import (AuthorizedKeysFilesMapping, UNIXAuthorizedKeysFiles,
+                          CachingAuthorizedKeysDB, SQLiteAuthorizedKeysDB,
+                          MappedAuthorizedKeysIndex,
+                          compileAuthorizedKeysIndex, SSHPublicKeyChecker)
+
+from benchmarks import _harness
+
+
+PROVIDERS = ('mapping', 'unix', 'cached', 'index', 'sqlite')
+
+
+class Options(_harness.BenchmarkOptions):
+    optParameters = [
+        ["keyCounts", "", "1,10,100,1000", "Comma separated numbers of "
+            "keys in the authorized_keys file"],
+        ["concurrency", "", "1,16", "Comma separated numbers of logins to "
+            "keep outstanding at once"],
+        ["logins", "", 1000, "Number of logins to time", int],
+        ["providers", "", ','.join(PROVIDERS), "Comma separated authorized "
+            "keys providers to measure, out of: " + ', '.join(PROVIDERS)]
+    ]
+
+    def postOptions(self):
+        self['keyCounts'] = _harness.parseList(self['keyCounts'])
+        self['concurrency'] = _harness.parseList(self['concurrency'])
+        self['providers'] = _harness.parseList(self['providers'], str)
+        unknown = set(self['providers']) - set(PROVIDERS)
+        if unknown:
+            raise usage.UsageError(
+                'Unknown providers: ' + ', '.join(sorted(unknown)))
+
+
+def fillerKey(bits=2048):
+    """
+    @return: a L{Key} with a random modulus - not a usable key, but as
+        expensive to parse and compare as one, and much quicker to make
+    """
+    n = 0
+    for _ in range(bits // 32):
+        n = (n << 32) | struct.unpack('>I', os.urandom(4))[0]
+    return Key(RSA.construct((n | 1 | (1 << (bits - 1)), 65537L)))
+
+
+def makeProviders(names, directory, authorizedKeys):
+    """
+    Make authorized keys providers that serve C{authorizedKeys} for
+    L{_harness.USERNAME}
+
+    @param directory: C{str} path of a directory to put files in
+
+    @return: C{dict} mapping provider names to providers
+    """
+    home = os.path.join(directory, 'home')
+    sshDir = os.path.join(home, '.ssh')
+    os.makedirs(sshDir)
+    keysFile = os.path.join(sshDir, 'authorized_keys')
+    with open(keysFile, 'w') as f:
+        f.write(authorizedKeys)
+    mapping = {_harness.USERNAME: [keysFile]}
+
+    userdb = UserDatabase()
+    userdb.addUser(_harness.USERNAME, 'password', os.getuid(), os.getgid(),
+                   'benchmark user', home, '/bin/sh')
+
+    providers = {}
+    for name in names:
+        if name == 'mapping':
+            providers[name] = AuthorizedKeysFilesMapping(mapping)
+        elif name == 'unix':
+            providers[name] = UNIXAuthorizedKeysFiles(userdb, runas=None)
+        elif name == 'cached':
+            providers[name] = CachingAuthorizedKeysDB(
+                UNIXAuthorizedKeysFiles(userdb, runas=None))
+        elif name == 'index':
+            path = os.path.join(directory, 'index')
+            compileAuthorizedKeysIndex(mapping, path)
+            providers[name] = MappedAuthorizedKeysIndex(path)
+        elif name == 'sqlite':
+            providers[name] = SQLiteAuthorizedKeysDB(
+                os.path.join(directory, 'keys.sqlite'))
+            providers[name].importAuthorizedKeysFiles(mapping)
+    return providers
+
+
+@defer.inlineCallbacks
+def login(checker, credentials, latencies):
+    started = time.time()
+    yield checker.requestAvatarId(credentials)
+    latencies.append(time.time() - started)
+
+
+@defer.inlineCallbacks
+def measure(checker, credentials, logins, concurrency):
+    """
+    Log in C{logins} times, C{concurrency} at once
+
+    @return: a L{defer.Deferred} that fires with the number of seconds it
+        took and the latency of every login
+    """
+    latencies = []
+    started = time.time()
+    yield _harness.pipelined(
+        xrange(logins), concurrency,
+        lambda _: login(checker, credentials, latencies))
+    defer.returnValue((time.time() - started, latencies))
+
+
+@defer.inlineCallbacks
+def main(reactor, options):
+    key = _harness.generateKey()
+    sigData = 'session id and user auth request'
+    credentials = SSHPrivateKey(_harness.USERNAME, 'ssh-rsa',
+                                key.public().blob(), sigData,
+                                key.sign(sigData))
+    filler = [fillerKey().toString('openssh')
+              for _ in range(max(options['keyCounts']) - 1)]
+
+    results = []
+    for count in options['keyCounts']:
+        lines = filler[:count - 1] + [key.public().toString('openssh')]
+        directory = tempfile.mkdtemp(prefix='essbench')
+        providers = {}
+        try:
+            providers = makeProviders(options['providers'], directory,
+                                      '\n'.join(lines) + '\n')
+            for name in options['providers']:
+                checker = SSHPublicKeyChecker(providers[name])
+                for concurrency in options['concurrency']:
+                    runs = []
+                    for _ in range(options['repeat']):
+                        run = yield measure(checker, credentials,
+                                            options['logins'], concurrency)
+                        runs.append(run)
+                    seconds, latencies = min(runs)
+                    result = {'provider': name, 'keys': count,
+                              'concurrency': concurrency,
+                              'logins': options['logins'],
+                              'seconds': seconds,
+                              'loginsPerSecond':
+                                  options['logins'] / seconds}
+                    result.update(('latency_' + k, v) for k, v in
+                                  _harness.percentiles(latencies).items())
+                    results.append(result)
+        finally:
+            if 'sqlite' in providers:
+                providers['sqlite'].close()
+            shutil.rmtree(directory)
+
+    _harness.writeResults(options, 'auth', results, {
+        'keyCounts': options['keyCounts'],
+        'concurrency': options['concurrency'],
+        'logins': options['logins'], 'providers': options['providers'],
+        'repeat': options['repeat']})
+
+
+if __name__ == '__main__':
+    _harness.run(main, Options())
@@ -0,0 +1,137 @@
+"""
+Cipher and MAC micro-benchmark: how many bytes per second each cipher
+encrypts and decrypts, and each MAC authenticates, on this host, packet by
+packet the way an SSH transport does.  Ciphers are measured both with
+Conch's L{twisted.conch.ssh.transport.SSHCiphers} and with
+L{ess.algorithms.FastSSHCiphers}, which the essftp plugin uses.
+
+    python -m benchmarks.ciphers --ciphers aes128-ctr,aes256-ctr
+"""
+import os
+import sys
+import time
+
+from twisted.conch.ssh import transport
+from twisted.python import usage
+
+from ess.algorithms import FastSSHCiphers
+
+from benchmarks import _harness
+
+
+IMPLEMENTATIONS = (('conch', transport.SSHCiphers),
+                   ('ess', FastSSHCiphers))
+
+
+class Options(_harness.BenchmarkOptions):
+    optParameters = [
+        ["ciphers", "", ",".join(sorted(
+            name for name in transport.SSHCiphers.cipherMap
+            if name != 'none')), "Comma separated ciphers to measure"],
+        ["macs", "", ",".join(sorted(
+            name for name in transport.SSHCiphers.macMap
+            if name != 'none')), "Comma separated MACs to measure"],
+        ["packetSize", "", "32k", "Size of each packet"],
+        ["size", "", "16m", "Number of bytes to put through each cipher and "
+            "MAC"]
+    ]
+
+    def postOptions(self):
+        self['ciphers'] = _harness.parseList(self['ciphers'], str)
+        self['macs'] = _harness.parseList(self['macs'], str)
+        self['packetSize'] = _harness.parseSize(self['packetSize'])
+        self['size'] = _harness.parseSize(self['size'])
+        unknown = (set(self['ciphers']) -
+                   set(transport.SSHCiphers.cipherMap) |
+                   set(self['macs']) - set(transport.SSHCiphers.macMap))
+        if unknown:
+            raise usage.UsageError(
+                'Unknown algorithms: ' + ', '.join(sorted(unknown)))
+
+
+def makeCiphers(ciphersClass, cipher='none', mac='none'):
+    """
+    @return: a keyed instance of C{ciphersClass} that uses C{cipher} and
+        C{mac} both ways
+    """
+    ciphers = ciphersClass(cipher, cipher, mac, mac)
+    iv, key, integrity = os.urandom(16), os.urandom(32), os.urandom(64)
+    ciphers.setKeys(iv, key, iv, key, integrity, integrity)
+    return ciphers
+
+
+def measureCipher(ciphers, packet, count):
+    """
+    @return: the number of seconds it takes to encrypt and to decrypt
+        C{count} packets
+    """
+    started = time.time()
+    for _ in xrange(count):
+        ciphers.encrypt(packet)
+    encrypted = time.time() - started
+    started = time.time()
+    for _ in xrange(count):
+        ciphers.decrypt(packet)
+    return encrypted, time.time() - started
+
+
+def measureMAC(ciphers, packet, count):
+    """
+    @return: the number of seconds it takes to make and to verify the MACs
+        of C{count} packets
+    """
+    mac = ciphers.makeMAC(0, packet)
+    started = time.time()
+    for seq in xrange(count):
+        ciphers.makeMAC(seq, packet)
+    made = time.time() - started
+    started = time.time()
+    for _ in xrange(count):
+        ciphers.verify(0, packet, mac)
+    return made, time.time() - started
+
+
+def main(options):
+    packet = os.urandom(options['packetSize'])
+    count = max(1, options['size'] // len(packet))
+    size = count * len(packet)
+    results = []
+
+    def record(kind, name, implementation, measure, ciphers, directions):
+        runs = [measure(ciphers, packet, count)
+                for _ in range(options['repeat'])]
+        result = {'kind': kind, 'name': name,
+                  'implementation': implementation}
+        for direction, seconds in zip(directions, zip(*runs)):
+            result[direction + 'BytesPerSecond'] = size / min(seconds)
+        results.append(result)
+        sys.stderr.write('{0:>14} {1:>6}: {2}\n'.format(
+            name, implementation, ', '.join(
+                '{0} {1:.1f}MB/s'.format(
+                    direction, result[direction + 'BytesPerSecond'] /
+                    (1 << 20))
+                for direction in directions)))
+
+    for cipher in options['ciphers']:
+        for implementation, ciphersClass in IMPLEMENTATIONS:
+            record('cipher', cipher, implementation, measureCipher,
+                   makeCiphers(ciphersClass, cipher=cipher),
+                   ('encrypt', 'decrypt'))
+    for mac in options['macs']:
+        record('mac', mac, 'conch', measureMAC,
+               makeCiphers(transport.SSHCiphers, mac=mac),
+               ('make', 'verify'))
+
+    _harness.writeResults(options, 'ciphers', results, {
+        'ciphers': options['ciphers'], 'macs': options['macs'],
+        'packetSize': options['packetSize'], 'size': size,
+        'repeat': options['repeat']})
+
+
+if __name__ == '__main__':
+    options = Options()
+    try:
+        options.parseOptions(sys.argv[1:])
+    except usage.UsageError as e:
+        raise SystemExit('{0}\n{1}'.format(options, e))
+    main(options)
@@ -0,0 +1,164 @@
+"""
+Directory listing benchmark: how long L{ess.essftp.EssFTPServer.openDirectory}
+and a full iteration of the L{ess.essftp.ChrootedDirectory} it returns take,
+and how much memory they need, as the number of entries in the directory
+grows.
+
+The directories are filled like the fixtures of the essftp tests, with a mix
+of files, directories, and symbolic links to files inside and outside of the
+root.  Every measurement is made in a new process, so that its peak resident
+memory (C{ru_maxrss}) is the listing's alone.  No SSH is involved - the
+server is called directly.
+
+    python -m benchmarks.listing --sizes 1000,10000,100000,1000000
+"""
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from twisted.python import usage
+
+from benchmarks import _harness
+
+
+# how the entries of a directory are split between the kinds of entries
+MIX = (('file', 0.7), ('directory', 0.1), ('link', 0.1),
+       ('outsideLink', 0.1))
+
+
+class Options(_harness.BenchmarkOptions):
+    optParameters = [
+        ["sizes", "", "1000,10000,100000", "Comma separated numbers of "
+            "entries in the directory"]
+    ]
+
+    def postOptions(self):
+        self['sizes'] = _harness.parseList(self['sizes'])
+
+
+def makeDirectory(root, name, size):
+    """
+    Fill a directory under C{root} with C{size} entries of the kinds in
+    L{MIX}, with links outside of the root pointing into a sibling of it
+
+    @return: C{dict} mapping the kinds of entries to how many were made
+    """
+    directory = os.path.join(root, name)
+    outside = os.path.join(os.path.dirname(root), 'outside')
+    for path in (directory, outside):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    target = os.path.join(outside, 'target')
+    with open(target, 'w') as f:
+        f.write('outside')
+
+    counts = {}
+    made = 0
+    for kind, share in MIX:
+        counts[kind] = int(size * share)
+    counts['file'] += size - sum(counts.values())
+    for kind, _ in MIX:
+        for i in xrange(counts[kind]):
+            path = os.path.join(directory, '{0}{1:08d}'.format(kind, made))
+            if kind == 'file':
+                with open(path, 'w') as f:
+                    f.write(path)
+            elif kind == 'directory':
+                os.mkdir(path)
+            elif kind == 'link':
+                os.symlink(os.path.join(directory, 'file00000000'), path)
+            else:
+                os.symlink(target, path)
+            made += 1
+    return counts
+
+
+def maxRSS():
+    """
+    @return: the peak resident memory of this process so far, in bytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes everywhere but OS X
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def measure(root, name):
+    """
+    List a directory through L{ess.essftp.EssFTPServer}, and write the
+    measurements as JSON to standard output.  This is run in a new process
+    for every measurement.
+    """
+    from ess.essftp import EssFTPServer, EssFTPUser
+    server = EssFTPServer(EssFTPUser(root))
+    before = maxRSS()
+
+    started = time.time()
+    directory = server.openDirectory(name)
+    opened = time.time()
+    entries = 0
+    for entry in directory:
+        entries += 1
+    directory.close()
+    finished = time.time()
+
+    json.dump({'entries': entries, 'openSeconds': opened - started,
+               'iterateSeconds': finished - opened,
+               'seconds': finished - started,
+               'rssBefore': before, 'rssPeak': maxRSS()}, sys.stdout)
+
+
+def measureInProcess(root, name):
+    """
+    Run L{measure} in a new Python process
+
+    @return: C{dict} of its measurements
+    """
+    output = subprocess.check_output([
+        sys.executable, '-c',
+        'import sys; from benchmarks.listing import measure; '
+        'measure(*sys.argv[1:])', root, name])
+    return json.loads(output)
+
+
+def main(options):
+    results = []
+    for size in options['sizes']:
+        work = tempfile.mkdtemp(prefix='essbench')
+        try:
+            root = os.path.join(work, 'root')
+            counts = makeDirectory(root, 'listing', size)
+            runs = [measureInProcess(root, 'listing')
+                    for _ in range(options['repeat'])]
+        finally:
+            shutil.rmtree(work)
+        result = min(runs, key=lambda run: run['seconds'])
+        result['rssGrowth'] = min(run['rssPeak'] - run['rssBefore']
+                                  for run in runs)
+        result['bytesPerEntry'] = result['rssGrowth'] / float(size)
+        result['entriesPerSecond'] = size / result['seconds']
+        result['size'] = size
+        result['mix'] = counts
+        results.append(result)
+        sys.stderr.write('{0:>8} entries: {1:.3f}s, {2:.0f} entries/s, '
+                         'peak RSS +{3:.1f}MB\n'.format(
+                             size, result['seconds'],
+                             result['entriesPerSecond'],
+                             result['rssGrowth'] / float(1 << 20)))
+
+    _harness.writeResults(options, 'listing', results, {
+        'sizes': options['sizes'], 'repeat': options['repeat'],
+        'mix': dict(MIX)})
+
+
+if __name__ == '__main__':
+    options = Options()
+    try:
+        options.parseOptions(sys.argv[1:])
+    except usage.UsageError as e:
+        raise SystemExit('{0}\n{1}'.format(options, e))
+    main(options)
@@ -0,0 +1,390 @@
+"""
+Load generator and soak test: many concurrent SFTP sessions against an
+essftp server in a child process, each replaying a weighted mix of
+operations, with per-operation latency percentiles and the server's
+resident memory and open file descriptors sampled over time (from
+C{/proc}, so on Linux only).
+
+The server is sampled before any session connects, throughout the run, and
+again once every session has disconnected, so memory or descriptors that
+are never given back show up as the difference between the first and last
+samples.
+
+    python -m benchmarks.load --clients 500 --duration 600 \\
+        --mix getAttrs:4,readChunk:4,writeChunk:2,openFile:1,openDirectory:1
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from array import array
+
+from twisted.conch.ssh import filetransfer
+from twisted.internet import defer, protocol, task
+from twisted.python import usage
+
+from benchmarks import _harness
+
+
+OPERATIONS = ('openFile', 'readChunk', 'writeChunk', 'openDirectory',
+              'getAttrs')
+
+
+def parseMix(value):
+    """
+    Parse an operation mix, such as C{getAttrs:4,readChunk:1} (an operation
+    without a weight has a weight of 1)
+
+    @return: C{list} of C{(operation, weight)}
+    """
+    mix = []
+    for item in _harness.parseList(value, str):
+        name, _, weight = item.partition(':')
+        if name not in OPERATIONS:
+            raise usage.UsageError('Unknown operation {0!r}, not one of: {1}'
+                                   .format(name, ', '.join(OPERATIONS)))
+        mix.append((name, float(weight or 1)))
+    if not mix:
+        raise usage.UsageError('The operation mix is empty')
+    return mix
+
+
+class Options(_harness.BenchmarkOptions):
+    optParameters = [
+        ["clients", "c", 100, "Number of concurrent sessions", int],
+        ["connectConcurrency", "", 16, "Number of sessions to be connecting "
+            "at once while ramping up", int],
+        ["duration", "d", 60, "Seconds to run the load for, once every "
+            "session is connected", float],
+        ["mix", "", "getAttrs:4,readChunk:4,writeChunk:2,openFile:1,"
+            "openDirectory:1", "Comma separated operations, each with an "
+            "optional weight, out of: " + ', '.join(OPERATIONS)],
+        ["thinkTime", "", 0, "Seconds each session waits between "
+            "operations", float],
+        ["fileSize", "", "1m", "Size of each session's file"],
+        ["chunkSize", "", "32k", "Size of the read and write requests"],
+        ["entries", "", 100, "Number of entries in the directory listed",
+            int],
+        ["sampleInterval", "", 1, "Seconds between samples of the server "
+            "process", float],
+        ["seed", "", None, "Random seed, for a repeatable sequence of "
+            "operations", int],
+        ["serverArgs", "", "", "Extra essftp plugin arguments for the "
+            "server, space separated"]
+    ]
+
+    def postOptions(self):
+        self['mix'] = parseMix(self['mix'])
+        self['fileSize'] = _harness.parseSize(self['fileSize'])
+        self['chunkSize'] = _harness.parseSize(self['chunkSize'])
+
+
+def sampleProcess(pid):
+    """
+    @return: C{(rss, fds)} - the resident memory, in bytes, and the number
+        of open file descriptors of a process
+    """
+    rss = 0
+    with open('/proc/{0}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) * 1024
+                break
+    return rss, len(os.listdir('/proc/{0}/fd'.format(pid)))
+
+
+class _ServerProtocol(protocol.ProcessProtocol):
+    def __init__(self):
+        self.ready = defer.Deferred()
+        self.ended = defer.Deferred()
+        self.output = ''
+        self.errors = []
+
+    def outReceived(self, data):
+        self.output += data
+        if '\n' in self.output and not self.ready.called:
+            self.ready.callback(int(self.output.split('\n')[0]))
+
+    def errReceived(self, data):
+        self.errors.append(data)
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+        if not self.ready.called:
+            self.ready.errback(RuntimeError(
+                'The server exited:\n' + ''.join(self.errors)))
+
+
+class ServerProcess(object):
+    """
+    A L{_harness.Server} running in a child process (see
+    L{benchmarks._serve})
+
+    @ivar pid: C{int} process ID of the server
+    """
+    def __init__(self, reactor, keyFile, root, args=()):
+        self.protocol = _ServerProtocol()
+        process = reactor.spawnProcess(
+            self.protocol, sys.executable,
+            [sys.executable, '-m', 'benchmarks._serve', keyFile, root] +
+            list(args), env=os.environ, path=os.getcwd())
+        self.pid = process.pid
+
+    def getPort(self):
+        """
+        @return: a L{defer.Deferred} that fires with the C{int} port number
+            the server listens on, once it is listening
+        """
+        return self.protocol.ready
+
+    def stop(self):
+        """
+        @return: a L{defer.Deferred} that fires once the server has exited
+        """
+        if not self.protocol.ended.called:
+            self.protocol.transport.signalProcess('TERM')
+        return self.protocol.ended
+
+
+class Session(object):
+    """
+    One client session, which performs the operations in the mix on its
+    own file and on a shared directory
+    """
+    def __init__(self, client, path, options, random):
+        self.client = client
+        self.path = path
+        self.fileSize = options['fileSize']
+        self.chunkSize = options['chunkSize']
+        self.data = 'x' * self.chunkSize
+        self.random = random
+        self.file = None
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        """
+        Create the session's file, and keep it open for reading and writing
+        """
+        self.file = yield self.client.openFile(
+            self.path, filetransfer.FXF_READ | filetransfer.FXF_WRITE |
+            filetransfer.FXF_CREAT | filetransfer.FXF_TRUNC, {})
+        for offset in xrange(0, self.fileSize, self.chunkSize):
+            yield self.file.writeChunk(offset, self.data)
+
+    def _offset(self):
+        return self.random.randrange(
+            max(1, self.fileSize // self.chunkSize)) * self.chunkSize
+
+    @defer.inlineCallbacks
+    def openFile(self):
+        f = yield self.client.openFile(self.path, filetransfer.FXF_READ, {})
+        yield f.close()
+
+    def readChunk(self):
+        return self.file.readChunk(self._offset(), self.chunkSize)
+
+    def writeChunk(self):
+        return self.file.writeChunk(self._offset(), self.data)
+
+    @defer.inlineCallbacks
+    def openDirectory(self):
+        directory = yield self.client.openDirectory('/listing')
+        while True:
+            try:
+                yield directory.read()
+            except EOFError:
+                break
+        yield directory.close()
+
+    def getAttrs(self):
+        return self.client.getAttrs(self.path)
+
+
+class Load(object):
+    """
+    The state of a run: sessions, what they have measured, and samples of
+    the server
+
+    @ivar latencies: C{dict} mapping operation names to C{array}s of
+        latencies in seconds
+    @ivar errors: C{dict} mapping operation names to numbers of failures
+    @ivar samples: C{list} of C{dict}s, one per sample of the server
+    """
+    def __init__(self, reactor, options, server):
+        self.reactor = reactor
+        self.options = options
+        self.server = server
+        self.random = random.Random(options['seed'])
+        self.operations, weights = zip(*options['mix'])
+        total = sum(weights)
+        self.cumulative = []
+        for weight in weights:
+            self.cumulative.append(
+                (self.cumulative[-1] if self.cumulative else 0) +
+                weight / total)
+        self.latencies = dict((name, array('d')) for name in self.operations)
+        self.errors = dict((name, 0) for name in self.operations)
+        self.sessions = []
+        self.connectErrors = 0
+        self.completed = 0
+        self.loadSeconds = 0
+        self.phase = 'idle'
+        self.started = time.time()
+        self.samples = []
+
+    def sample(self):
+        """
+        Record the server's memory and file descriptors
+        """
+        rss, fds = sampleProcess(self.server.pid)
+        self.samples.append({
+            'time': time.time() - self.started, 'phase': self.phase,
+            'rss': rss, 'fds': fds, 'sessions': len(self.sessions),
+            'operations': self.completed})
+
+    def choose(self):
+        """
+        @return: the name of a random operation from the mix
+        """
+        point = self.random.random()
+        for name, bound in zip(self.operations, self.cumulative):
+            if point < bound:
+                return name
+        return self.operations[-1]
+
+    @defer.inlineCallbacks
+    def connect(self, port, key, index):
+        """
+        Connect a session, counting failures instead of giving up
+        """
+        try:
+            client = yield _harness.connect(self.reactor, port, key)
+            session = Session(client, '/session{0}'.format(index),
+                              self.options,
+                              random.Random(self.random.random()))
+            yield session.setUp()
+        except Exception:
+            self.connectErrors += 1
+        else:
+            self.sessions.append(session)
+
+    @defer.inlineCallbacks
+    def drive(self, session, deadline):
+        """
+        Perform random operations on a session until the deadline
+        """
+        while time.time() < deadline:
+            name = self.choose()
+            started = time.time()
+            try:
+                yield getattr(session, name)()
+            except Exception:
+                self.errors[name] += 1
+            else:
+                self.latencies[name].append(time.time() - started)
+            self.completed += 1
+            if self.options['thinkTime']:
+                yield task.deferLater(self.reactor,
+                                      self.options['thinkTime'],
+                                      lambda: None)
+
+    @defer.inlineCallbacks
+    def run(self, port, key):
+        """
+        Connect every session, drive them all for the duration of the run,
+        then disconnect them
+        """
+        sampler = task.LoopingCall(self.sample)
+        sampler.clock = self.reactor
+        sampler.start(self.options['sampleInterval'])
+        try:
+            self.phase = 'connecting'
+            yield _harness.pipelined(
+                xrange(self.options['clients']),
+                self.options['connectConcurrency'],
+                lambda index: self.connect(port, key, index))
+
+            self.phase = 'running'
+            started = time.time()
+            deadline = started + self.options['duration']
+            yield defer.gatherResults(
+                [self.drive(session, deadline) for session in self.sessions])
+            self.loadSeconds = time.time() - started
+
+            self.phase = 'disconnected'
+            for session in self.sessions:
+                _harness.disconnect(session.client)
+            del self.sessions[:]
+            # let the server notice the connections have gone
+            yield task.deferLater(self.reactor,
+                                  max(2, self.options['sampleInterval']),
+                                  lambda: None)
+        finally:
+            sampler.stop()
+        self.sample()
+
+    def results(self):
+        """
+        @return: C{list} of C{dict}s, the measurements of each operation
+        """
+        results = []
+        for name in self.operations:
+            latencies = self.latencies[name]
+            result = {'operation': name, 'count': len(latencies),
+                      'errors': self.errors[name],
+                      'opsPerSecond': len(latencies) / self.loadSeconds}
+            result.update(('latency_' + k, v) for k, v in
+                          _harness.percentiles(latencies).items())
+            results.append(result)
+        return results
+
+    def summary(self):
+        """
+        @return: C{dict} of the server's memory and file descriptors before,
+            at most during and after the run
+        """
+        first, last = self.samples[0], self.samples[-1]
+        return {
+            'rssBefore': first['rss'], 'rssAfter': last['rss'],
+            'rssPeak': max(s['rss'] for s in self.samples),
+            'fdsBefore': first['fds'], 'fdsAfter': last['fds'],
+            'fdsPeak': max(s['fds'] for s in self.samples),
+            'connectErrors': self.connectErrors,
+            'seconds': self.loadSeconds}
+
+
+@defer.inlineCallbacks
+def main(reactor, options):
+    key = _harness.generateKey()
+    work = tempfile.mkdtemp(prefix='essbench')
+    root = os.path.join(work, 'root')
+    listing = os.path.join(root, 'listing')
+    os.makedirs(listing)
+    for i in xrange(options['entries']):
+        open(os.path.join(listing, 'file{0:06d}'.format(i)), 'w').close()
+    keyFile = os.path.join(work, 'key.pub')
+    with open(keyFile, 'w') as f:
+        f.write(key.public().toString('openssh'))
+
+    server = ServerProcess(reactor, keyFile, root,
+                           options['serverArgs'].split())
+    try:
+        port = yield server.getPort()
+        load = Load(reactor, options, server)
+        yield load.run(port, key)
+    finally:
+        yield server.stop()
+        shutil.rmtree(work)
+
+    parameters = dict((name, options[name]) for name in (
+        'clients', 'connectConcurrency', 'duration', 'thinkTime', 'fileSize',
+        'chunkSize', 'entries', 'sampleInterval', 'seed', 'serverArgs'))
+    parameters['mix'] = dict(options['mix'])
+    _harness.writeResults(options, 'load', load.results(), parameters,
+                          summary=load.summary(), samples=load.samples)
+
+
+if __name__ == '__main__':
+    _harness.run(main, Options())
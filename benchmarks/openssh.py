@@ -0,0 +1,357 @@
+"""
+Head-to-head benchmark: the same workloads - bulk transfers, listings of a
+large directory and storms of metadata operations - against a local
+OpenSSH sshd (with its sftp-server) and against the essftp plugin, with
+throughput and latency reported side by side.
+
+OpenSSH is configured by L{ess._openSSHConfig.setupConfig}, and both servers
+are driven by the same Conch client, serving the same directory.  Conch's
+client only speaks SHA-1 key exchanges and C{ssh-rsa} signatures, which
+recent OpenSSH releases turn off by default, so they are turned back on in
+the generated sshd configuration.  If sshd or sftp-server cannot be found,
+the benchmark is skipped.
+
+    python -m benchmarks.openssh --fileSize 16m --entries 10000
+"""
+import getpass
+import os
+import socket
+import sys
+import tempfile
+import time
+from distutils.spawn import find_executable
+
+from twisted.conch.ssh import filetransfer
+from twisted.conch.ssh.keys import Key
+from twisted.internet import defer, protocol, task
+from twisted.python.filepath import FilePath
+
+from ess._openSSHConfig import setupConfig, clientPrivKey
+
+from benchmarks import _harness
+
+
+SFTP_SERVERS = ('/usr/lib/openssh/sftp-server',
+                '/usr/libexec/openssh/sftp-server',
+                '/usr/lib/ssh/sftp-server',
+                '/usr/libexec/sftp-server')
+
+# Conch's client needs these, and recent OpenSSH releases disable them
+COMPATIBILITY = """
+KexAlgorithms +diffie-hellman-group-exchange-sha1,diffie-hellman-group1-sha1
+HostKeyAlgorithms +ssh-rsa
+PubkeyAcceptedKeyTypes +ssh-rsa
+"""
+
+
+class Options(_harness.BenchmarkOptions):
+    optParameters = [
+        ["sshd", "", None, "Path of sshd (default: found in PATH or "
+            "/usr/sbin)"],
+        ["sftpServer", "", None, "Path of OpenSSH's sftp-server (default: "
+            "found in the usual places)"],
+        ["fileSize", "", "16m", "Size of the file to transfer"],
+        ["chunkSize", "", "32k", "Size of the read and write requests"],
+        ["depth", "", 16, "Number of transfer requests to keep outstanding "
+            "at once", int],
+        ["entries", "", 10000, "Number of entries in the directory to list",
+            int],
+        ["operations", "", 1000, "Number of metadata operations to time",
+            int]
+    ]
+
+    def postOptions(self):
+        self['fileSize'] = _harness.parseSize(self['fileSize'])
+        self['chunkSize'] = _harness.parseSize(self['chunkSize'])
+
+
+def findOpenSSH(options):
+    """
+    @return: C{(sshd, sftpServer)} paths, either of which is C{None} if it
+        can't be found
+    """
+    sshd = options['sshd'] or find_executable(
+        'sshd', os.pathsep.join([os.environ.get('PATH', ''), '/usr/sbin',
+                                 '/usr/local/sbin']))
+    sftpServer = options['sftpServer']
+    if sftpServer is None:
+        for candidate in SFTP_SERVERS:
+            if os.access(candidate, os.X_OK):
+                sftpServer = candidate
+                break
+    return sshd, sftpServer
+
+
+def freePort():
+    """
+    @return: C{int} number of a loopback TCP port nothing is listening on
+    """
+    s = socket.socket()
+    try:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+
+class _SSHDProtocol(protocol.ProcessProtocol):
+    def __init__(self):
+        self.output = []
+        self.ended = defer.Deferred()
+
+    def errReceived(self, data):
+        self.output.append(data)
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+
+
+class OpenSSHServer(object):
+    """
+    A local OpenSSH sshd, configured by L{setupConfig}, running in a child
+    process
+    """
+    def __init__(self, reactor, sshd, sftpServer):
+        self.reactor = reactor
+        self.port = freePort()
+        self.directory = FilePath(tempfile.mkdtemp(prefix='essbench'))
+        setupConfig(self.directory.path, self.port)
+        config = self.directory.child('sshd_config')
+        text = config.getContent().replace(
+            '/usr/lib/openssh/sftp-server', sftpServer)
+        if os.getuid() == 0:
+            text = text.replace('PermitRootLogin no',
+                                'PermitRootLogin without-password')
+        config.setContent(text + COMPATIBILITY)
+        self.process = _SSHDProtocol()
+        reactor.spawnProcess(self.process, sshd,
+                             [sshd, '-D', '-e', '-f', config.path],
+                             env=os.environ)
+
+    @defer.inlineCallbacks
+    def connect(self, key, timeout=10):
+        """
+        Open an SFTP session, waiting for sshd to start listening
+
+        @return: a L{defer.Deferred} that fires with a
+            L{filetransfer.FileTransferClient}
+        """
+        deadline = time.time() + timeout
+        while True:
+            try:
+                client = yield _harness.connect(self.reactor, self.port, key,
+                                                username=getpass.getuser())
+            except Exception:
+                if self.process.ended.called or time.time() > deadline:
+                    raise RuntimeError('Could not connect to sshd:\n' +
+                                       ''.join(self.process.output))
+                yield task.deferLater(self.reactor, 0.1, lambda: None)
+            else:
+                defer.returnValue(client)
+
+    @defer.inlineCallbacks
+    def stop(self):
+        """
+        Stop sshd and remove its configuration
+        """
+        if not self.process.ended.called:
+            self.process.transport.signalProcess('TERM')
+            yield self.process.ended
+        self.directory.remove()
+
+
+def timing(latencies, function):
+    """
+    @return: a function that calls C{function} and adds the number of
+        seconds the L{defer.Deferred} it returns takes to fire to
+        C{latencies}
+    """
+    def timed(*args):
+        started = time.time()
+        d = function(*args)
+
+        def record(result):
+            latencies.append(time.time() - started)
+            return result
+        return d.addCallback(record)
+    return timed
+
+
+@defer.inlineCallbacks
+def transfer(client, path, options, upload):
+    """
+    Upload or download a file
+
+    @return: a L{defer.Deferred} that fires with the number of seconds it
+        took and the latency of every request
+    """
+    size, chunkSize = options['fileSize'], options['chunkSize']
+    data = 'x' * chunkSize
+    latencies = []
+    started = time.time()
+    if upload:
+        f = yield client.openFile(path, filetransfer.FXF_WRITE |
+                                  filetransfer.FXF_CREAT |
+                                  filetransfer.FXF_TRUNC, {})
+        request = lambda offset: f.writeChunk(
+            offset, data[:min(chunkSize, size - offset)])
+    else:
+        f = yield client.openFile(path, filetransfer.FXF_READ, {})
+        request = lambda offset: f.readChunk(
+            offset, min(chunkSize, size - offset))
+    yield _harness.pipelined(xrange(0, size, chunkSize), options['depth'],
+                             timing(latencies, request))
+    yield f.close()
+    defer.returnValue((time.time() - started, latencies))
+
+
+@defer.inlineCallbacks
+def listing(client, path, options):
+    """
+    Open a directory and read every entry in it
+
+    @return: a L{defer.Deferred} that fires with the number of seconds it
+        took and the latency of every read request
+    """
+    latencies = []
+    read = timing(latencies, lambda d: d.read())
+    started = time.time()
+    directory = yield client.openDirectory(path)
+    while True:
+        try:
+            yield read(directory)
+        except EOFError:
+            break
+    yield directory.close()
+    defer.returnValue((time.time() - started, latencies))
+
+
+@defer.inlineCallbacks
+def metadata(client, path, options):
+    """
+    Get the attributes of a file, and open and close it, over and over
+
+    @return: a L{defer.Deferred} that fires with the number of seconds it
+        took and the latency of every operation
+    """
+    latencies = []
+    stat = timing(latencies, client.getAttrs)
+    openFile = timing(latencies, client.openFile)
+    started = time.time()
+    for _ in xrange(options['operations'] // 2):
+        yield stat(path)
+        f = yield openFile(path, filetransfer.FXF_READ, {})
+        yield f.close()
+    defer.returnValue((time.time() - started, latencies))
+
+
+def workloads(prefix, options):
+    """
+    @param prefix: C{str} path of the shared directory, as the server sees
+        it
+
+    @return: C{list} of C{(name, function, units)}, where C{function} takes
+        a client and returns what L{transfer} does, and C{units} is the
+        amount of work it does
+    """
+    bench = prefix + '/bench'
+    return [
+        ('upload', lambda c: transfer(c, bench, options, True),
+         options['fileSize'] / float(1 << 20)),
+        ('download', lambda c: transfer(c, bench, options, False),
+         options['fileSize'] / float(1 << 20)),
+        ('listing', lambda c: listing(c, prefix + '/listing', options),
+         options['entries']),
+        ('metadata', lambda c: metadata(c, bench, options),
+         options['operations'] // 2 * 2),
+    ]
+
+
+UNITS = {'upload': 'MBps', 'download': 'MBps', 'listing': 'entriesPerSecond',
+         'metadata': 'opsPerSecond'}
+
+
+@defer.inlineCallbacks
+def measure(client, prefix, options):
+    """
+    Run every workload against one server
+
+    @return: a L{defer.Deferred} that fires with a C{dict} mapping workload
+        names to results
+    """
+    results = {}
+    for name, workload, units in workloads(prefix, options):
+        runs = []
+        for _ in range(options['repeat']):
+            run = yield workload(client)
+            runs.append(run)
+        seconds, latencies = min(runs)
+        result = {'seconds': seconds, UNITS[name]: units / seconds}
+        result.update(('latency_' + k, v) for k, v in
+                      _harness.percentiles(latencies).items())
+        results[name] = result
+    defer.returnValue(results)
+
+
+def makeListing(directory, entries):
+    """
+    Fill a directory with C{entries} empty files
+    """
+    directory.makedirs()
+    for i in xrange(entries):
+        open(os.path.join(directory.path, 'file{0:08d}'.format(i)),
+             'w').close()
+
+
+@defer.inlineCallbacks
+def main(reactor, options):
+    parameters = dict((name, options[name]) for name in (
+        'fileSize', 'chunkSize', 'depth', 'entries', 'operations', 'repeat'))
+    sshd, sftpServer = findOpenSSH(options)
+    if sshd is None or sftpServer is None:
+        reason = 'OpenSSH {0} not found'.format(
+            'sshd' if sshd is None else 'sftp-server')
+        sys.stderr.write('Skipped: {0}\n'.format(reason))
+        parameters['skipped'] = reason
+        _harness.writeResults(options, 'openssh', [], parameters)
+        return
+
+    key = Key.fromString(clientPrivKey.strip())
+    root = FilePath(tempfile.mkdtemp(prefix='essbench'))
+    os.chmod(root.path, 0755)
+    makeListing(root.child('listing'), options['entries'])
+    essftp = _harness.Server(reactor, key, root=root.path)
+    openssh = OpenSSHServer(reactor, sshd, sftpServer)
+    measured = {}
+    try:
+        client = yield _harness.connect(reactor, essftp.getPort(), key)
+        measured['essftp'] = yield measure(client, '', options)
+        _harness.disconnect(client)
+
+        client = yield openssh.connect(key)
+        measured['openssh'] = yield measure(client, root.path, options)
+        _harness.disconnect(client)
+    finally:
+        yield essftp.stop()
+        yield openssh.stop()
+        root.remove()
+
+    results = []
+    for name, _, _ in workloads('', options):
+        essftpResult = measured['essftp'][name]
+        opensshResult = measured['openssh'][name]
+        units = UNITS[name]
+        results.append({
+            'workload': name, 'essftp': essftpResult,
+            'openssh': opensshResult,
+            'ratio': essftpResult[units] / opensshResult[units]})
+        sys.stderr.write('{0:<10} {1}: essftp {2:.1f}, openssh {3:.1f} '
+                         '({4:.0%})\n'.format(name, units,
+                                              essftpResult[units],
+                                              opensshResult[units],
+                                              results[-1]['ratio']))
+    _harness.writeResults(options, 'openssh', results, parameters)
+
+
+if __name__ == '__main__':
+    _harness.run(main, Options())
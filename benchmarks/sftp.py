@@ -0,0 +1,151 @@
+"""
+End-to-end SFTP benchmark: upload and download throughput across chunk
+sizes, pipelining depths and file sizes, and the rate of metadata
+operations, against an in-process essftp server over loopback.
+
+Client and server share one process and one reactor, so the numbers are
+for both ends together - compare them between revisions, not with other
+servers.
+
+    python -m benchmarks.sftp --fileSizes 1m,16m --chunkSizes 8k,32k
+"""
+import time
+
+from twisted.conch.ssh import filetransfer
+from twisted.internet import defer
+
+from benchmarks import _harness
+
+
+class Options(_harness.BenchmarkOptions):
+    optParameters = [
+        ["fileSizes", "", "1m,16m", "Comma separated sizes of the files to "
+            "transfer"],
+        ["chunkSizes", "", "8k,32k,64k", "Comma separated sizes of the "
+            "read and write requests"],
+        ["depths", "", "1,4,16", "Comma separated numbers of requests to "
+            "keep outstanding at once"],
+        ["operations", "", 1000, "Number of metadata operations to time",
+            int],
+        ["serverArgs", "", "", "Extra essftp plugin arguments for the "
+            "server, space separated"]
+    ]
+
+    def postOptions(self):
+        self['fileSizes'] = _harness.parseList(self['fileSizes'],
+                                               _harness.parseSize)
+        self['chunkSizes'] = _harness.parseList(self['chunkSizes'],
+                                                _harness.parseSize)
+        self['depths'] = _harness.parseList(self['depths'])
+
+
+@defer.inlineCallbacks
+def upload(client, path, size, chunkSize, depth):
+    """
+    Write a file of C{size} bytes, C{chunkSize} bytes per request
+
+    @return: a L{defer.Deferred} that fires with the number of seconds it
+        took
+    """
+    data = 'x' * chunkSize
+    started = time.time()
+    f = yield client.openFile(path, filetransfer.FXF_WRITE |
+                              filetransfer.FXF_CREAT |
+                              filetransfer.FXF_TRUNC, {})
+    yield _harness.pipelined(
+        xrange(0, size, chunkSize), depth,
+        lambda offset: f.writeChunk(offset,
+                                    data[:min(chunkSize, size - offset)]))
+    yield f.close()
+    defer.returnValue(time.time() - started)
+
+
+@defer.inlineCallbacks
+def download(client, path, size, chunkSize, depth):
+    """
+    Read a file of C{size} bytes, C{chunkSize} bytes per request
+
+    @return: a L{defer.Deferred} that fires with the number of seconds it
+        took
+    """
+    started = time.time()
+    f = yield client.openFile(path, filetransfer.FXF_READ, {})
+    yield _harness.pipelined(
+        xrange(0, size, chunkSize), depth,
+        lambda offset: f.readChunk(offset, min(chunkSize, size - offset)))
+    yield f.close()
+    defer.returnValue(time.time() - started)
+
+
+@defer.inlineCallbacks
+def stat(client, path, count):
+    """
+    @return: a L{defer.Deferred} that fires with the number of seconds it
+        took to get the attributes of a file C{count} times
+    """
+    started = time.time()
+    for _ in xrange(count):
+        yield client.getAttrs(path)
+    defer.returnValue(time.time() - started)
+
+
+@defer.inlineCallbacks
+def openClose(client, path, count):
+    """
+    @return: a L{defer.Deferred} that fires with the number of seconds it
+        took to open and close a file C{count} times
+    """
+    started = time.time()
+    for _ in xrange(count):
+        f = yield client.openFile(path, filetransfer.FXF_READ, {})
+        yield f.close()
+    defer.returnValue(time.time() - started)
+
+
+@defer.inlineCallbacks
+def main(reactor, options):
+    key = _harness.generateKey()
+    server = _harness.Server(reactor, key,
+                             args=options['serverArgs'].split())
+    client = yield _harness.connect(reactor, server.getPort(), key)
+    results = []
+
+    for fileSize in options['fileSizes']:
+        for chunkSize in options['chunkSizes']:
+            for depth in options['depths']:
+                for direction, transfer in (('upload', upload),
+                                            ('download', download)):
+                    runs = []
+                    for _ in range(options['repeat']):
+                        seconds = yield transfer(client, '/bench', fileSize,
+                                                 chunkSize, depth)
+                        runs.append(seconds)
+                    seconds = min(runs)
+                    results.append({
+                        'operation': direction, 'fileSize': fileSize,
+                        'chunkSize': chunkSize, 'depth': depth,
+                        'seconds': seconds,
+                        'MBps': fileSize / seconds / (1 << 20)})
+
+    count = options['operations']
+    for name, operation in (('stat', stat), ('openClose', openClose)):
+        runs = []
+        for _ in range(options['repeat']):
+            seconds = yield operation(client, '/bench', count)
+            runs.append(seconds)
+        seconds = min(runs)
+        results.append({'operation': name, 'count': count,
+                        'seconds': seconds, 'opsPerSecond': count / seconds})
+
+    _harness.disconnect(client)
+    yield server.stop()
+    server.root.remove()
+    _harness.writeResults(options, 'sftp', results, {
+        'fileSizes': options['fileSizes'],
+        'chunkSizes': options['chunkSizes'],
+        'depths': options['depths'], 'operations': count,
+        'repeat': options['repeat'], 'serverArgs': options['serverArgs']})
+
+
+if __name__ == '__main__':
+    _harness.run(main, Options())
@@ -0,0 +1,148 @@
+"""
+Module that sets which ciphers, MACs and key exchanges the server offers,
+and makes counter mode ciphers fast.
+
+Among the algorithms both sides offer, the client's order decides which is
+used, so the server can only steer the choice by what it leaves out.  The
+C{throughput} profile leaves out everything but the ciphers and MACs that
+move the most bytes per second here (see C{benchmarks/ciphers.py}).
+
+Conch counts the blocks of counter mode ciphers with a Python callable,
+called for every 16 bytes encrypted or decrypted; L{FastSSHCiphers} uses
+PyCrypto's own counter instead, which produces the same key stream several
+times faster.
+
+Conch also picks Diffie-Hellman group exchange exponents as long as the
+prime, which makes the exchange cost seconds of CPU with the 8192 bit
+primes some clients ask for.  L{TunedServerTransport} picks them the length
+OpenSSH does (twice the bits of security wanted) instead.
+"""
+from hashlib import sha1
+
+from Crypto.Util import Counter
+from Crypto.Util.number import bytes_to_long
+
+from twisted.conch.ssh import transport
+from twisted.conch.ssh.common import NS, MP, getMP, _MPpow
+from twisted.python import randbytes
+
+
+PROFILES = {
+    # Conch's own preferences
+    'default': {
+        'ciphers': transport.SSHTransportBase.supportedCiphers,
+        'macs': transport.SSHTransportBase.supportedMACs,
+        'keyExchanges': transport.SSHTransportBase.supportedKeyExchanges,
+    },
+    # AES in counter mode only, with the cheapest MAC first
+    'throughput': {
+        'ciphers': ['aes128-ctr', 'aes192-ctr', 'aes256-ctr'],
+        'macs': ['hmac-md5', 'hmac-sha1'],
+        'keyExchanges': transport.SSHTransportBase.supportedKeyExchanges,
+    },
+}
+
+
+def parseAlgorithms(value, supported):
+    """
+    Parse a comma separated list of algorithm names, most preferred first
+
+    @param supported: the names that may be used
+
+    @return: C{list} of the names
+    @raise ValueError: if a name is not supported
+    """
+    names = [name for name in value.split(',') if name]
+    unknown = [name for name in names if name not in supported]
+    if unknown or not names:
+        raise ValueError('Unsupported algorithms: {0!r} (supported: '
+                         '{1})'.format(value, ','.join(sorted(supported))))
+    return names
+
+
+class FastSSHCiphers(transport.SSHCiphers):
+    """
+    L{transport.SSHCiphers} whose counter mode ciphers count blocks with
+    PyCrypto's counter rather than Conch's
+    """
+    def _getCipher(self, cip, iv, key):
+        modName, keySize, counterMode = self.cipherMap[cip]
+        if not (modName and counterMode):
+            return transport.SSHCiphers._getCipher(self, cip, iv, key)
+        mod = __import__('Crypto.Cipher.%s' % modName, {}, {}, 'x')
+        counter = Counter.new(
+            mod.block_size * 8,
+            initial_value=bytes_to_long(iv[:mod.block_size]),
+            allow_wraparound=True)
+        return mod.new(key[:keySize], mod.MODE_CTR, counter=counter)
+
+
+class TunedServerTransport(transport.SSHServerTransport):
+    """
+    SSH server transport that uses L{FastSSHCiphers}, and short exponents
+    for Diffie-Hellman group exchange.  Subclass it (see L{makeTransport})
+    to set C{supportedCiphers}, C{supportedMACs} and
+    C{supportedKeyExchanges}.
+
+    @cvar exponentBits: the number of bits of group exchange exponents
+    """
+    exponentBits = 512
+
+    def ssh_KEXINIT(self, packet):
+        transport.SSHServerTransport.ssh_KEXINIT(self, packet)
+        chosen = self.nextEncryptions
+        self.nextEncryptions = FastSSHCiphers(
+            chosen.outCipType, chosen.inCipType, chosen.outMACType,
+            chosen.inMACType)
+
+    def ssh_KEX_DH_GEX_INIT(self, packet):
+        """
+        As L{transport.SSHServerTransport.ssh_KEX_DH_GEX_INIT}, but with an
+        exponent of C{exponentBits} bits rather than as many as the prime
+        """
+        clientDHpublicKey, _ = getMP(packet)
+        y = transport._generateX(randbytes.secureRandom, self.exponentBits)
+        serverDHpublicKey = _MPpow(self.g, y, self.p)
+        sharedSecret = _MPpow(clientDHpublicKey, y, self.p)
+        hostKey = self.factory.publicKeys[self.keyAlg].blob()
+        h = sha1()
+        h.update(NS(self.otherVersionString))
+        h.update(NS(self.ourVersionString))
+        h.update(NS(self.otherKexInitPayload))
+        h.update(NS(self.ourKexInitPayload))
+        h.update(NS(hostKey))
+        h.update(self.dhGexRequest)
+        h.update(MP(self.p))
+        h.update(MP(self.g))
+        h.update(MP(clientDHpublicKey))
+        h.update(serverDHpublicKey)
+        h.update(sharedSecret)
+        exchangeHash = h.digest()
+        self.sendPacket(
+            transport.MSG_KEX_DH_GEX_REPLY, NS(hostKey) + serverDHpublicKey +
+            NS(self.factory.privateKeys[self.keyAlg].sign(exchangeHash)))
+        self._keySetup(sharedSecret, exchangeHash)
+
+
+def makeTransport(profile='default', ciphers=None, macs=None,
+                  keyExchanges=None):
+    """
+    Make a L{TunedServerTransport} subclass that offers the algorithms of a
+    profile, or the ones given instead
+
+    @param profile: the name of the profile in L{PROFILES}
+    @param ciphers: C{list} of cipher names, most preferred first
+    @param macs: C{list} of MAC names, most preferred first
+    @param keyExchanges: C{list} of key exchange names, most preferred first
+
+    @return: the transport class, for an SSH factory's C{protocol}
+    """
+    algorithms = PROFILES[profile]
+
+    class _Transport(TunedServerTransport):
+        supportedCiphers = list(ciphers or algorithms['ciphers'])
+        supportedMACs = list(macs or algorithms['macs'])
+        supportedKeyExchanges = list(keyExchanges or
+                                     algorithms['keyExchanges'])
+
+    return _Transport
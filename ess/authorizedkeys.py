@@ -0,0 +1,99 @@
+"""
+Command line tool that loads users' authorized keys files into a store the
+essftp plugin can look keys up in, so that the files need not be read at
+login:
+
+    python -m ess.authorizedkeys import keys.db [USERNAME ...]
+    python -m ess.authorizedkeys compile keys.index [USERNAME ...]
+
+Run it as a user that can read everyone's authorized keys files.  Without
+usernames, every user in the passwd database is loaded.
+"""
+try:
+    import pwd as _pwd
+except ImportError:
+    _pwd = None
+
+import sys
+
+from twisted.python import usage
+
+from ess.checkers import (SQLiteAuthorizedKeysDB, UNIXAuthorizedKeysFiles,
+                          compileAuthorizedKeysIndex)
+
+
+def authorizedKeysFiles(usernames=None, pwd=None):
+    """
+    Find the authorized keys files of users
+
+    @param usernames: iterable of C{str} usernames, or C{None} for every
+        user in C{pwd}
+    @param pwd: access to the Unix user account and password database
+        (default is the Python module L{pwd})
+
+    @return: C{dict} of usernames mapped to C{list}s of paths of their
+        authorized keys files, which may not exist, as taken by
+        L{ess.checkers.AuthorizedKeysFilesMapping}
+    """
+    if pwd is None:
+        pwd = _pwd
+    if not usernames:
+        usernames = [passwd.pw_name for passwd in pwd.getpwall()]
+    keyFiles = UNIXAuthorizedKeysFiles(pwd)
+    return dict((username, [fp.path for fp in
+                            keyFiles.getAuthorizedKeysFiles(username)])
+                for username in usernames)
+
+
+class ImportOptions(usage.Options):
+    synopsis = "DATABASE [USERNAME ...]"
+
+    def parseArgs(self, database, *usernames):
+        self['database'] = database
+        self['usernames'] = usernames
+
+
+class CompileOptions(usage.Options):
+    synopsis = "INDEX [USERNAME ...]"
+
+    def parseArgs(self, index, *usernames):
+        self['index'] = index
+        self['usernames'] = usernames
+
+
+class Options(usage.Options):
+    synopsis = "COMMAND [options]"
+    subCommands = [
+        ["import", None, ImportOptions, "Replace the keys of users in an "
+            "SQLite database (see --authorizedKeysDB) with the keys in their "
+            "authorized keys files"],
+        ["compile", None, CompileOptions, "Replace an authorized keys index "
+            "(see --authorizedKeysIndex) with one of the keys in users' "
+            "authorized keys files"]
+    ]
+
+    def postOptions(self):
+        if self.subCommand is None:
+            raise usage.UsageError("Please choose a command")
+
+
+def main(options, pwd=None):
+    subOptions = options.subOptions
+    mapping = authorizedKeysFiles(subOptions['usernames'], pwd)
+    if options.subCommand == 'import':
+        keydb = SQLiteAuthorizedKeysDB(subOptions['database'])
+        try:
+            keydb.importAuthorizedKeysFiles(mapping)
+        finally:
+            keydb.close()
+    elif options.subCommand == 'compile':
+        compileAuthorizedKeysIndex(mapping, subOptions['index'])
+
+
+if __name__ == '__main__':
+    options = Options()
+    try:
+        options.parseOptions(sys.argv[1:])
+    except usage.UsageError as e:
+        raise SystemExit('{0}\n{1}'.format(options, e))
+    main(options)
@@ -0,0 +1,210 @@
+"""
+Module that limits how much work each SFTP session can have queued on the
+server: how many of its requests may be waiting for responses, and how
+many bytes of responses may be waiting for the client's channel window to
+open.  Past either limit, the server stops handling the session's requests
+and stops opening its channel window, so the client stops sending until the
+responses drain.
+"""
+import struct
+from collections import Counter
+
+from twisted.conch.ssh import connection, filetransfer
+from twisted.python import log
+
+from ess import shelless
+
+
+# packets that answer a request (all but FXP_VERSION, which answers INIT)
+_RESPONSES = frozenset([filetransfer.FXP_STATUS, filetransfer.FXP_HANDLE,
+                        filetransfer.FXP_DATA, filetransfer.FXP_NAME,
+                        filetransfer.FXP_ATTRS,
+                        filetransfer.FXP_EXTENDED_REPLY])
+
+
+class FlowControlledConnection(connection.SSHConnection):
+    """
+    SSH connection service that does not open the window of a channel while
+    the channel says its reading is paused (see L{FlowControlledSession})
+    """
+    def adjustWindow(self, channel, bytesToAdd):
+        if getattr(channel, 'readingPaused', False):
+            return
+        connection.SSHConnection.adjustWindow(self, channel, bytesToAdd)
+
+
+class FlowControlledSession(shelless.ShelllessSession):
+    """
+    Shell-less session channel whose subsystem can pause reading from the
+    client, and is told when responses buffered for the client have been
+    sent.  The window is only withheld over a L{FlowControlledConnection}.
+
+    @ivar readingPaused: whether the window is not to be opened
+    @ivar flowObserver: the subsystem protocol to tell, with its
+        C{channelDrained} method, when buffered data has been sent, or
+        C{None}
+    """
+    def __init__(self, *args, **kwargs):
+        shelless.ShelllessSession.__init__(self, *args, **kwargs)
+        self.readingPaused = False
+        self.flowObserver = None
+
+    def pauseReading(self):
+        """
+        Stop opening the window, so that the client stops sending once it
+        has used up what is left of it
+        """
+        self.readingPaused = True
+
+    def resumeReading(self):
+        """
+        Open the window again, if it has been used up by half or more
+        """
+        self.readingPaused = False
+        if (not self.localClosed and
+                self.localWindowLeft < self.localWindowSize // 2):
+            self.conn.adjustWindow(
+                self, self.localWindowSize - self.localWindowLeft)
+
+    def addWindowBytes(self, bytes):
+        shelless.ShelllessSession.addWindowBytes(self, bytes)
+        if self.flowObserver is not None:
+            self.flowObserver.channelDrained()
+
+
+class FlowControlledFileTransferServer(filetransfer.FileTransferServer):
+    """
+    SFTP server protocol that stops handling requests while C{maxRequests}
+    of them are waiting for responses, or while C{maxBufferedBytes} of
+    responses are waiting to be sent, and then has its channel (if it is a
+    L{FlowControlledSession}) pause reading.  The limits are the avatar's
+    C{maxRequests} and C{maxBufferedBytes}, if it has them; C{None} is no
+    limit.
+
+    Every request of a known type is counted, from when it is handled until
+    a response with its ID is sent, or until its handler fails (Conch logs
+    the error and never answers it).  Requests that share an ID each count,
+    and each response answers one of them.
+
+    @ivar maxRequests: C{int} maximum number of requests waiting for
+        responses, or C{None}
+    @ivar maxBufferedBytes: C{int} maximum number of bytes of responses
+        waiting to be sent, or C{None}
+    @ivar requests: C{Counter} of the IDs (packed) of the requests waiting
+        for responses
+    @ivar outstanding: C{int} number of requests waiting for responses
+    """
+    def __init__(self, data=None, avatar=None):
+        filetransfer.FileTransferServer.__init__(self, data, avatar)
+        self.maxRequests = getattr(avatar, 'maxRequests', None)
+        self.maxBufferedBytes = getattr(avatar, 'maxBufferedBytes', None)
+        self.requests = Counter()
+        self.outstanding = 0
+        self._pending = ''
+        self._dispatching = False
+        self._channel = None
+
+    def connectionMade(self):
+        filetransfer.FileTransferServer.connectionMade(self)
+        channel = getattr(self.transport, 'session', None)
+        if hasattr(channel, 'pauseReading'):
+            self._channel = channel
+            channel.flowObserver = self
+
+    def bufferedBytes(self):
+        """
+        @return: C{int} number of bytes of responses waiting for the client's
+            channel window to open
+        """
+        return len(getattr(getattr(self.transport, 'session', None), 'buf',
+                           None) or '')
+
+    def isFull(self):
+        """
+        @return: whether no more requests should be handled for now
+        """
+        return ((self.maxRequests is not None and
+                 self.outstanding >= self.maxRequests) or
+                (self.maxBufferedBytes is not None and
+                 self.bufferedBytes() >= self.maxBufferedBytes))
+
+    def dataReceived(self, data):
+        self._pending += data
+        self._dispatch()
+
+    def _dispatch(self):
+        """
+        Handle whole requests received, one at a time, until there are none
+        left or the session is full, then pause or resume reading
+        """
+        if self._dispatching:
+            return
+        self._dispatching = True
+        try:
+            while len(self._pending) >= 5 and not self.isFull():
+                length, kind = struct.unpack('!LB', self._pending[:5])
+                if len(self._pending) < 4 + length:
+                    break
+                packet = self._pending[:4 + length]
+                self._pending = self._pending[4 + length:]
+                if (kind != filetransfer.FXP_INIT and
+                        kind in self.packetTypes):
+                    self.requests[packet[5:9]] += 1
+                    self.outstanding += 1
+                self._handle(kind, packet[5:])
+        finally:
+            self._dispatching = False
+        if self._channel is not None:
+            if self.isFull():
+                self._channel.pauseReading()
+            elif self._channel.readingPaused:
+                self._channel.resumeReading()
+
+    def _handle(self, kind, data):
+        """
+        Handle one packet as L{filetransfer.FileTransferBase.dataReceived}
+        does, but stop counting the request if handling it fails
+        """
+        packetType = self.packetTypes.get(kind)
+        handler = getattr(self, 'packet_{0}'.format(packetType), None)
+        try:
+            if handler is not None:
+                handler(data)
+            elif packetType is not None:
+                # Conch passes _sendStatus the unpacked ID here, and fails
+                struct.unpack('!L', data[:4])
+                self._sendStatus(data[:4], filetransfer.FX_OP_UNSUPPORTED,
+                                 "don't understand {0}".format(packetType))
+            else:
+                log.msg('no packet type for', kind)
+        except Exception:
+            log.err()
+            self._answered(data[:4])
+
+    def sendPacket(self, kind, data):
+        filetransfer.FileTransferServer.sendPacket(self, kind, data)
+        if kind in _RESPONSES:
+            self._answered(data[:4])
+            self._dispatch()
+
+    def _answered(self, requestId):
+        """
+        Stop counting one of the requests with an ID, if any
+        """
+        if self.requests[requestId] > 0:
+            self.requests[requestId] -= 1
+            self.outstanding -= 1
+            if not self.requests[requestId]:
+                del self.requests[requestId]
+
+    def channelDrained(self):
+        """
+        Called by the channel when buffered responses have been sent
+        """
+        self._dispatch()
+
+    def connectionLost(self, reason):
+        filetransfer.FileTransferServer.connectionLost(self, reason)
+        if self._channel is not None:
+            self._channel.flowObserver = None
+            self._channel = None
@@ -7,18 +7,29 @@ try:
 except ImportError:
     _pwd = None
 
+import hashlib
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+from collections import OrderedDict, namedtuple
+
 from zope.interface import implementer, Interface
 
 from twisted.conch.error import ValidPublicKey
-from twisted.conch.ssh.keys import Key
+from twisted.conch.ssh.common import NS, getNS
+from twisted.conch.ssh.keys import BadKeyError, Key
 from twisted.cred.checkers import ICredentialsChecker
 from twisted.cred.credentials import ISSHPrivateKey
 from twisted.cred.error import UnauthorizedLogin
-from twisted.internet import defer
+from twisted.internet import defer, error, protocol
 from twisted.python import log
 from twisted.python.util import runAsEffectiveUser
 from twisted.python.filepath import FilePath
 
+from ess.metrics import timed
+
 
 class IAuthorizedKeysDB(Interface):
     """
@@ -28,7 +39,23 @@ class IAuthorizedKeysDB(Interface):
         """
         @param username: C{str} username of the user
 
-        @return: an iterable of L{twisted.conch.ssh.keys.Key}
+        @return: an iterable of L{twisted.conch.ssh.keys.Key}, or a
+            L{twisted.internet.defer.Deferred} that fires with one
+        """
+
+
+class IAuthorizedKeyLookup(Interface):
+    """
+    An object that can tell whether a single key is authorized for a user
+    without providing all of the user's keys
+    """
+    def isAuthorizedKey(username, blob):
+        """
+        @param username: C{str} username of the user
+        @param blob: C{str} SSH public key blob of the key
+
+        @return: C{bool} whether the key is authorized for the user, or a
+            L{twisted.internet.defer.Deferred} that fires with one
         """
 
 
@@ -68,11 +95,20 @@ class AuthorizedKeysFilesMapping(object):
         self.mapping = mapping
         self.parsekey = parsekey
 
+    def getAuthorizedKeysFiles(self, username):
+        """
+        @param username: C{str} username of the user
+
+        @return: C{list} of L{FilePath}s of the files keys for the user are
+            read from, which may not exist
+        """
+        return [FilePath(f) for f in self.mapping.get(username, [])]
+
     def getAuthorizedKeys(self, username):
         """
         @see: L{ess.checkers.ISSHPublicKeyDB}
         """
-        for fp in (FilePath(f) for f in self.mapping.get(username, [])):
+        for fp in self.getAuthorizedKeysFiles(username):
             if fp.exists():
                 try:
                     f = fp.open()
@@ -83,6 +119,453 @@ class AuthorizedKeysFilesMapping(object):
                         yield key
 
 
+@implementer(IAuthorizedKeysDB, IAuthorizedKeyLookup)
+class SQLiteAuthorizedKeysDB(object):
+    """
+    Object that provides SSH public keys stored in a local SQLite database,
+    so that neither the memory used nor the time taken by a lookup grows
+    with the number of users.
+
+    Keys are stored as blobs, indexed by username and by a hash of the key
+    blob.  Existing authorized keys files can be bulk loaded with
+    L{importAuthorizedKeysFiles}, and the database can then be kept up to
+    date with L{addKey}, L{removeKey}, L{setKeys} and L{removeUser}.
+    L{isAuthorizedKey} checks a single key by its hash, without reading or
+    parsing the user's other keys.
+
+    The database connection is shared by all threads and used by one at a
+    time, so lookups can be run with
+    L{twisted.internet.threads.deferToThread} (see
+    L{CoalescingAuthorizedKeysDB}).
+
+    @ivar path: C{str} path of the database file (created if it does not
+        exist)
+    """
+    _schema = ("CREATE TABLE IF NOT EXISTS authorized_keys ("
+               "username TEXT NOT NULL, "
+               "blobhash TEXT NOT NULL, "
+               "blob BLOB NOT NULL, "
+               "PRIMARY KEY (username, blobhash))")
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(self._schema)
+
+    def getAuthorizedKeys(self, username):
+        """
+        @see: L{ess.checkers.ISSHPublicKeyDB}
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT blob FROM authorized_keys WHERE username = ?",
+                (username,)).fetchall()
+        return [Key.fromString(str(blob)) for (blob,) in rows]
+
+    def isAuthorizedKey(self, username, blob):
+        """
+        @see: L{ess.checkers.IAuthorizedKeyLookup}
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT blob FROM authorized_keys "
+                "WHERE username = ? AND blobhash = ?",
+                (username, _blobHash(blob))).fetchone()
+        return row is not None and str(row[0]) == blob
+
+    def addKey(self, username, key):
+        """
+        Authorize a key for a user
+
+        @param username: C{str} username of the user
+        @param key: L{twisted.conch.ssh.keys.Key} to authorize
+        """
+        with self._lock, self._conn:
+            self._insert(username, [key])
+
+    def removeKey(self, username, key):
+        """
+        Stop authorizing a key for a user
+
+        @param username: C{str} username of the user
+        @param key: L{twisted.conch.ssh.keys.Key} to stop authorizing
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM authorized_keys "
+                "WHERE username = ? AND blobhash = ?",
+                (username, _blobHash(key.blob())))
+
+    def setKeys(self, username, keys):
+        """
+        Replace all the keys authorized for a user
+
+        @param username: C{str} username of the user
+        @param keys: an iterable of L{twisted.conch.ssh.keys.Key}
+        """
+        with self._lock, self._conn:
+            self._delete(username)
+            self._insert(username, keys)
+
+    def removeUser(self, username):
+        """
+        Stop authorizing any keys for a user
+
+        @param username: C{str} username of the user
+        """
+        with self._lock, self._conn:
+            self._delete(username)
+
+    def importAuthorizedKeysFiles(self, mapping, parsekey=Key.fromString):
+        """
+        Bulk load authorized keys files in a single transaction, replacing
+        the keys of every user in the mapping.  Files that do not exist or
+        cannot be read are skipped, as are keys that cannot be parsed.
+
+        @param mapping: C{dict} of usernames mapped to iterables of
+            authorized key files, as taken by L{AuthorizedKeysFilesMapping}
+        @param parsekey: a callable that takes a string and returns a
+            L{twisted.conch.ssh.keys.Key}, mainly to be used for testing.  The
+            default is L{twisted.conch.keys.Key.fromString}
+        """
+        with self._lock, self._conn:
+            for username, files in mapping.iteritems():
+                keydb = AuthorizedKeysFilesMapping({username: files},
+                                                   parsekey)
+                self._delete(username)
+                self._insert(username, keydb.getAuthorizedKeys(username))
+
+    def close(self):
+        """
+        Close the database connection
+        """
+        with self._lock:
+            self._conn.close()
+
+    def _insert(self, username, keys):
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO authorized_keys (username, blobhash, blob) "
+            "VALUES (?, ?, ?)",
+            ((username, _blobHash(blob), sqlite3.Binary(blob))
+             for blob in (key.blob() for key in keys)))
+
+    def _delete(self, username):
+        self._conn.execute("DELETE FROM authorized_keys WHERE username = ?",
+                           (username,))
+
+
+def _blobHash(blob):
+    """
+    @param blob: C{str} SSH public key blob
+
+    @return: C{str} hex digest identifying the key blob
+    """
+    return hashlib.sha256(blob).hexdigest()
+
+
+_INDEX_MAGIC = 'ESSAKIX2'
+_INDEX_HEADER = struct.Struct('>8sI')  # magic, number of records
+_INDEX_ENTRY = struct.Struct('>QI')  # hash, record offset
+_INDEX_USERNAME = struct.Struct('>H')  # username length
+_INDEX_BLOB = struct.Struct('>I')  # key blob length
+
+
+def _usernameHash(username):
+    """
+    @param username: C{str} username of the user
+
+    @return: C{int} 64 bit hash of the username, by which the entries of
+        the username table of an index are sorted
+    """
+    return struct.unpack('>Q', hashlib.sha1(username).digest()[:8])[0]
+
+
+def _keyHash(username, blob):
+    """
+    @param username: C{str} username of the user
+    @param blob: C{str} SSH public key blob of the key
+
+    @return: C{int} 64 bit hash of the username and key blob, by which the
+        entries of the key table of an index are sorted
+    """
+    return struct.unpack(
+        '>Q', hashlib.sha1(NS(username) + blob).digest()[:8])[0]
+
+
+def compileAuthorizedKeysIndex(mapping, path, parsekey=Key.fromString):
+    """
+    Compile authorized keys files into an immutable binary index, to be
+    served by L{MappedAuthorizedKeysIndex}.  The index is written to a
+    temporary file which then replaces C{path} atomically, so servers
+    reading the old index never see a partially written one.
+
+    The index is a header, followed by a table of (username hash, record
+    offset) entries sorted by username hash, followed by a table of
+    (username and key blob hash, record offset) entries sorted by that
+    hash, followed by one record per authorized (username, key blob) pair.
+
+    @param mapping: C{dict} of usernames mapped to iterables of authorized
+        key files, as taken by L{AuthorizedKeysFilesMapping}
+    @param path: C{str} path of the index file to write
+    @param parsekey: a callable that takes a string and returns a
+        L{twisted.conch.ssh.keys.Key}, mainly to be used for testing.  The
+        default is L{twisted.conch.keys.Key.fromString}
+    """
+    pairs = set()
+    for username, files in mapping.iteritems():
+        keydb = AuthorizedKeysFilesMapping({username: files}, parsekey)
+        for key in keydb.getAuthorizedKeys(username):
+            pairs.add((username, key.blob()))
+
+    byUsername, byKey, records = [], [], []
+    offset = _INDEX_HEADER.size + 2 * _INDEX_ENTRY.size * len(pairs)
+    for username, blob in sorted(pairs):
+        record = (_INDEX_USERNAME.pack(len(username)) + username +
+                  _INDEX_BLOB.pack(len(blob)) + blob)
+        byUsername.append((_usernameHash(username), offset))
+        byKey.append((_keyHash(username, blob), offset))
+        records.append(record)
+        offset += len(record)
+
+    FilePath(path).setContent(
+        ''.join([_INDEX_HEADER.pack(_INDEX_MAGIC, len(pairs))] +
+                [_INDEX_ENTRY.pack(*entry)
+                 for entry in sorted(byUsername) + sorted(byKey)] +
+                records))
+
+
+@implementer(IAuthorizedKeysDB, IAuthorizedKeyLookup)
+class MappedAuthorizedKeysIndex(object):
+    """
+    Object that provides SSH public keys from an index compiled by
+    L{compileAuthorizedKeysIndex}.  The index is memory-mapped rather than
+    read, so opening it takes the same time no matter how big it is, and
+    processes serving the same index share its pages.  L{isAuthorizedKey}
+    finds a key by the hash of the username and key blob, and compares
+    bytes rather than parsing any keys.
+
+    Every lookup checks whether the index file has been replaced (one
+    C{stat}), and if so maps the new one, so recompiling the index takes
+    effect without a restart.
+
+    @ivar path: C{str} path of the index file
+    """
+    def __init__(self, path):
+        self.path = path
+        self._identity = None
+        self._map = None
+        self._count = 0
+        self._refresh()
+
+    def getAuthorizedKeys(self, username):
+        """
+        @see: L{ess.checkers.ISSHPublicKeyDB}
+        """
+        self._refresh()
+        return [Key.fromString(blob) for name, blob in self._records(
+                    _INDEX_HEADER.size, _usernameHash(username))
+                if name == username]
+
+    def isAuthorizedKey(self, username, blob):
+        """
+        @see: L{ess.checkers.IAuthorizedKeyLookup}
+        """
+        self._refresh()
+        table = _INDEX_HEADER.size + self._count * _INDEX_ENTRY.size
+        return (username, blob) in self._records(
+            table, _keyHash(username, blob))
+
+    def _records(self, table, hashed):
+        """
+        @param table: the offset of the table of entries to look in
+        @param hashed: the hash to look for
+
+        @return: an iterable of the (username, key blob) records of the
+            entries in the table with that hash
+        """
+        i = self._lowerBound(table, hashed)
+        while i < self._count:
+            entryHash, offset = _INDEX_ENTRY.unpack_from(
+                self._map, table + i * _INDEX_ENTRY.size)
+            if entryHash != hashed:
+                break
+            length, = _INDEX_USERNAME.unpack_from(self._map, offset)
+            offset += _INDEX_USERNAME.size
+            username = self._map[offset:offset + length]
+            offset += length
+            length, = _INDEX_BLOB.unpack_from(self._map, offset)
+            offset += _INDEX_BLOB.size
+            yield username, self._map[offset:offset + length]
+            i += 1
+
+    def _lowerBound(self, table, hashed):
+        """
+        @return: the index of the first entry of the table at offset
+            C{table} whose hash is not less than C{hashed}
+        """
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            entryHash, _ = _INDEX_ENTRY.unpack_from(
+                self._map, table + middle * _INDEX_ENTRY.size)
+            if entryHash < hashed:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _refresh(self):
+        """
+        Map the index file, if it has been replaced since it was last mapped
+
+        @raise ValueError: if the file is not an authorized keys index
+        """
+        stat = os.stat(self.path)
+        identity = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+        if identity == self._identity:
+            return
+        if stat.st_size < _INDEX_HEADER.size:
+            raise ValueError(
+                "{0} is not an authorized keys index".format(self.path))
+
+        with open(self.path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = _INDEX_HEADER.unpack_from(mapped, 0)
+        if magic != _INDEX_MAGIC:
+            mapped.close()
+            raise ValueError(
+                "{0} is not an authorized keys index".format(self.path))
+
+        if self._map is not None:
+            self._map.close()
+        self._identity, self._map, self._count = identity, mapped, count
+
+
+class CachingUserDatabase(object):
+    """
+    Object that wraps access to the Unix user account and password database
+    and caches the results of C{getpwnam}, so that repeated login attempts
+    do not hit a slow (e.g. LDAP or SSSD backed) database every time.
+
+    Unknown usernames are cached too, so that usernames sprayed by scanners
+    are rejected without another database lookup.  Only L{KeyError} (the
+    user does not exist) is cached - any other error is passed through.
+
+    @ivar pwd: access to the Unix user account and password database (default
+        is the Python module L{pwd})
+    @ivar positiveTTL: C{int} number of seconds to cache an existing user
+    @ivar negativeTTL: C{int} number of seconds to cache a nonexistent user
+    @ivar maxSize: C{int} maximum number of usernames to cache - the least
+        recently used username is evicted first
+    @ivar clock: L{twisted.internet.interfaces.IReactorTime} provider used to
+        expire cached entries, mainly to be used for testing.  The default
+        is the reactor.
+    @ivar shared: a L{ess.sharedcache.SharedMemoryCache} to also cache
+        entries in, for other processes (and to look them up in), or C{None}
+    """
+    def __init__(self, pwd=None, positiveTTL=60, negativeTTL=10,
+                 maxSize=1024, clock=None, shared=None):
+        self.pwd = pwd
+        self.positiveTTL = positiveTTL
+        self.negativeTTL = negativeTTL
+        self.maxSize = maxSize
+        self.clock = clock
+        self.shared = shared
+        if pwd is None:
+            self.pwd = _pwd
+        if clock is None:
+            from twisted.internet import reactor
+            self.clock = reactor
+        self._cache = OrderedDict()
+
+    def getpwnam(self, username):
+        """
+        @param username: C{str} username of the user
+
+        @raise KeyError: if there is no such user
+
+        @return: the password database entry for the user
+        """
+        now = self.clock.seconds()
+        entry = self._cache.pop(username, None)
+        if entry is not None and entry[0] > now:
+            self._cache[username] = entry  # most recently used
+            if entry[1] is None:
+                raise KeyError(username)
+            return entry[1]
+
+        if self.shared is not None:
+            found = self.shared.get('passwd:' + username, now)
+            if found is not None:
+                passwd = _decodePasswd(found[0])
+                self._store(username, passwd, found[1])
+                if passwd is None:
+                    raise KeyError(username)
+                return passwd
+
+        try:
+            passwd = self.pwd.getpwnam(username)
+        except KeyError:
+            self._store(username, None, now + self.negativeTTL, True)
+            raise
+
+        self._store(username, passwd, now + self.positiveTTL, True)
+        return passwd
+
+    def invalidate(self, username=None):
+        """
+        Discard the cached entry for a user, or for all users
+
+        @param username: C{str} username of the user, or C{None} to discard
+            every cached entry
+        """
+        if username is None:
+            self._cache.clear()
+            if self.shared is not None:
+                self.shared.clear()
+        else:
+            self._cache.pop(username, None)
+            if self.shared is not None:
+                self.shared.delete('passwd:' + username)
+
+    def _store(self, username, passwd, expires, share=False):
+        self._cache[username] = (expires, passwd)
+        while len(self._cache) > self.maxSize:
+            self._cache.popitem(last=False)
+        if share and self.shared is not None:
+            self.shared.set('passwd:' + username, _encodePasswd(passwd),
+                            expires)
+
+
+_Passwd = namedtuple('_Passwd', ['pw_name', 'pw_passwd', 'pw_uid', 'pw_gid',
+                                 'pw_gecos', 'pw_dir', 'pw_shell'])
+
+
+def _encodePasswd(passwd):
+    """
+    Encode a password database entry (or C{None} for a nonexistent user) to
+    be cached in a L{ess.sharedcache.SharedMemoryCache}
+    """
+    if passwd is None:
+        return ''
+    return ''.join(NS(str(getattr(passwd, field)))
+                   for field in _Passwd._fields)
+
+
+def _decodePasswd(data):
+    """
+    Decode a password database entry encoded by L{_encodePasswd}
+    """
+    if not data:
+        return None
+    fields = getNS(data, len(_Passwd._fields))[:-1]
+    passwd = _Passwd(*fields)
+    return passwd._replace(pw_uid=int(passwd.pw_uid),
+                           pw_gid=int(passwd.pw_gid))
+
+
 @implementer(IAuthorizedKeysDB)
 class UNIXAuthorizedKeysFiles(object):
     """
@@ -90,7 +573,8 @@ class UNIXAuthorizedKeysFiles(object):
     authorized_keys and authorized_keys2 files in UNIX user .ssh/ directories.
 
     @ivar pwd: access to the Unix user account and password database (default
-        is the Python module L{pwd})
+        is the Python module L{pwd}) - wrap it in a L{CachingUserDatabase} to
+        avoid a lookup per login attempt
     @ivar runas: a callable that takes a uid, a gid, and a param callable plus
         its args and kwargs, which calls the param callable as the user with
         the given uid and gid - this is mainly to be used for testing.  The
@@ -107,6 +591,19 @@ class UNIXAuthorizedKeysFiles(object):
         if pwd is None:
             self.pwd = _pwd
 
+    def getAuthorizedKeysFiles(self, username):
+        """
+        @param username: C{str} username of the user
+
+        @return: C{list} of L{FilePath}s of the files keys for the user are
+            read from, which may not exist
+        """
+        try:
+            passwd = self.pwd.getpwnam(username)
+        except:
+            return []
+        return self._files(passwd)
+
     def getAuthorizedKeys(self, username):
         """
         @see: L{ess.checkers.ISSHPublicKeyDB}
@@ -116,9 +613,7 @@ class UNIXAuthorizedKeysFiles(object):
         except:
             return
 
-        root = FilePath(passwd.pw_dir).child('.ssh')
-        files = ['authorized_keys', 'authorized_keys2']
-        for fp in (root.child(f) for f in files):
+        for fp in self._files(passwd):
             if fp.exists():
                 f = None
                 try:
@@ -131,6 +626,431 @@ class UNIXAuthorizedKeysFiles(object):
                     for key in readAuthorizedKeyFile(f, self.parsekey):
                         yield key
 
+    def _files(self, passwd):
+        root = FilePath(passwd.pw_dir).child('.ssh')
+        files = ['authorized_keys', 'authorized_keys2']
+        return [root.child(f) for f in files]
+
+
+@implementer(IAuthorizedKeysDB)
+class CachingAuthorizedKeysDB(object):
+    """
+    Object that wraps another L{IAuthorizedKeysDB} provider and caches the
+    keys it provides for each user.
+
+    Given a L{ess.watcher.FileWatcher}, and a wrapped provider that can say
+    which files a user's keys are read from (by having a
+    C{getAuthorizedKeysFiles} method, like L{AuthorizedKeysFilesMapping} and
+    L{UNIXAuthorizedKeysFiles}), cached keys are discarded as soon as any of
+    those files change, and otherwise do not expire.  Keys whose files cannot
+    be watched (no watcher, a provider not backed by files, or the inotify
+    watch limit has been reached) expire after C{ttl} seconds instead.
+
+    Concurrent cache misses for the same user are not coalesced - wrap a
+    L{CoalescingAuthorizedKeysDB} for that.
+
+    @ivar keydb: the wrapped L{IAuthorizedKeysDB} provider
+    @ivar ttl: C{int} number of seconds to cache keys that are not watched
+    @ivar maxSize: C{int} maximum number of users to cache keys for - the
+        least recently used user is evicted first
+    @ivar clock: L{twisted.internet.interfaces.IReactorTime} provider used to
+        expire cached entries, mainly to be used for testing.  The default
+        is the reactor.
+    @ivar watcher: a L{ess.watcher.FileWatcher}, or C{None} to only expire
+        cached keys after C{ttl} seconds
+    @ivar shared: a L{ess.sharedcache.SharedMemoryCache} to also cache keys
+        in, for other processes (and to look them up in), or C{None}.  Keys
+        cached there expire after C{ttl} seconds even if watched, since
+        other processes may not be watching their files.
+    """
+    def __init__(self, keydb, ttl=60, maxSize=1024, clock=None,
+                 watcher=None, shared=None):
+        self.keydb = keydb
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self.clock = clock
+        self.watcher = watcher
+        self.shared = shared
+        if clock is None:
+            from twisted.internet import reactor
+            self.clock = reactor
+        self._cache = OrderedDict()
+        self._watching = {}
+        self._invalidations = 0
+
+    def getAuthorizedKeys(self, username):
+        """
+        @see: L{ess.checkers.IAuthorizedKeysDB}
+
+        @return: a C{list} of L{twisted.conch.ssh.keys.Key}, or a
+            L{twisted.internet.defer.Deferred} that fires with one if the
+            wrapped provider returned a L{twisted.internet.defer.Deferred}
+        """
+        now = self.clock.seconds()
+        entry = self._cache.pop(username, None)
+        if entry is not None:
+            if entry[0] is None or entry[0] > now:
+                self._cache[username] = entry  # most recently used
+                return entry[1]
+            self._unwatch(username, entry[2])
+
+        invalidations = self._invalidations
+        files, watched = self._watch(username)
+        expires = None if watched else now + self.ttl
+        if self.shared is not None:
+            found = self.shared.get('keys:' + username, now)
+            if found is not None:
+                return self._store(_decodeKeys(found[0]), username, expires,
+                                   files, invalidations)
+
+        keys = self.keydb.getAuthorizedKeys(username)
+        if isinstance(keys, defer.Deferred):
+            return keys.addCallback(self._store, username, expires, files,
+                                    invalidations, now + self.ttl)
+        return self._store(keys, username, expires, files, invalidations,
+                           now + self.ttl)
+
+    def invalidate(self, username=None):
+        """
+        Discard the cached keys for a user, or for all users
+
+        @param username: C{str} username of the user, or C{None} to discard
+            the keys of every user
+        """
+        self._invalidations += 1
+        if username is None:
+            self._cache.clear()
+            if self.watcher is not None:
+                for fp in self._watching:
+                    self.watcher.unwatch(fp, self._fileChanged)
+            self._watching.clear()
+            if self.shared is not None:
+                self.shared.clear()
+        else:
+            entry = self._cache.pop(username, None)
+            if entry is not None:
+                self._unwatch(username, entry[2])
+            if self.shared is not None:
+                self.shared.delete('keys:' + username)
+
+    def _watch(self, username):
+        """
+        Watch the files the wrapped provider reads keys for the user from
+
+        @return: a C{list} of the files, and whether they are all watched
+        """
+        getFiles = getattr(self.keydb, 'getAuthorizedKeysFiles', None)
+        if self.watcher is None or getFiles is None:
+            return [], False
+
+        files = getFiles(username)
+        watched = bool(files)
+        for fp in files:
+            self._watching.setdefault(fp, set()).add(username)
+            watched = self.watcher.watch(fp, self._fileChanged) and watched
+        return files, watched
+
+    def _unwatch(self, username, files):
+        """
+        Stop watching the files keys for the user were read from, unless
+        keys of other users were read from them too
+        """
+        for fp in files:
+            usernames = self._watching.get(fp, set())
+            usernames.discard(username)
+            if not usernames:
+                self._watching.pop(fp, None)
+                self.watcher.unwatch(fp, self._fileChanged)
+
+    def _fileChanged(self, filePath):
+        """
+        Called by the watcher when a file changes
+        """
+        for username in list(self._watching.get(filePath, ())):
+            self.invalidate(username)
+
+    def _store(self, keys, username, expires, files, invalidations,
+               sharedExpires=None):
+        """
+        Cache keys, unless the cache was invalidated while they were loaded,
+        and share them if C{sharedExpires} is given
+        """
+        keys = list(keys)
+        if invalidations == self._invalidations:
+            self._cache[username] = (expires, keys, files)
+            while len(self._cache) > self.maxSize:
+                evicted, entry = self._cache.popitem(last=False)
+                self._unwatch(evicted, entry[2])
+            if sharedExpires is not None and self.shared is not None:
+                self.shared.set('keys:' + username, _encodeKeys(keys),
+                                sharedExpires)
+        else:
+            self._unwatch(username, files)
+        return keys
+
+
+def _encodeKeys(keys):
+    """
+    Encode keys to be cached in a L{ess.sharedcache.SharedMemoryCache}
+    """
+    return ''.join(NS(key.blob()) for key in keys)
+
+
+def _decodeKeys(data):
+    """
+    Decode keys encoded by L{_encodeKeys}
+    """
+    keys = []
+    while data:
+        blob, data = getNS(data)
+        keys.append(Key.fromString(blob))
+    return keys
+
+
+@implementer(IAuthorizedKeysDB)
+class CoalescingAuthorizedKeysDB(object):
+    """
+    Object that wraps another L{IAuthorizedKeysDB} provider so that
+    concurrent lookups for the same username share a single in-flight load
+    from the wrapped provider, and all get the same result.
+
+    Lookups can only overlap if the wrapped provider returns a
+    L{twisted.internet.defer.Deferred}, or if C{runner} loads keys outside
+    the reactor thread - pass L{twisted.internet.threads.deferToThread} to
+    take a blocking provider such as L{UNIXAuthorizedKeysFiles} off the
+    reactor thread.  Any caching provider can be wrapped (or can wrap this),
+    since both sides just provide L{IAuthorizedKeysDB}.
+
+    @ivar keydb: the wrapped L{IAuthorizedKeysDB} provider
+    @ivar runner: a callable that takes a callable plus its args, calls it,
+        and returns a L{twisted.internet.defer.Deferred} that fires with its
+        result.  It must only be used to run blocking providers.  The default
+        is L{twisted.internet.defer.maybeDeferred}
+    """
+    def __init__(self, keydb, runner=defer.maybeDeferred):
+        self.keydb = keydb
+        self.runner = runner
+        self._inFlight = {}
+
+    def getAuthorizedKeys(self, username):
+        """
+        @see: L{ess.checkers.IAuthorizedKeysDB}
+
+        @return: a L{twisted.internet.defer.Deferred} that fires with a
+            C{list} of L{twisted.conch.ssh.keys.Key}
+        """
+        d = defer.Deferred()
+        if username in self._inFlight:
+            self._inFlight[username].append(d)
+        else:
+            self._inFlight[username] = [d]
+            load = self.runner(self._loadKeys, username)
+            load.addBoth(self._loaded, username)
+        return d
+
+    def _loadKeys(self, username):
+        """
+        Get all the keys for the user from the wrapped provider
+
+        @return: a C{list} of keys, or a L{twisted.internet.defer.Deferred}
+            that fires with one
+        """
+        keys = self.keydb.getAuthorizedKeys(username)
+        if isinstance(keys, defer.Deferred):
+            return keys.addCallback(list)
+        return list(keys)
+
+    def _loaded(self, result, username):
+        """
+        Hand the result of a load (keys or failure) to every lookup waiting
+        on it
+        """
+        for d in self._inFlight.pop(username):
+            d.callback(result)
+
+
+class AuthorizedKeysCommandError(Exception):
+    """
+    A helper process of an L{AuthorizedKeysCommand} failed to answer
+    """
+
+
+class _AuthorizedKeysHelper(protocol.ProcessProtocol):
+    """
+    Talks to one helper process of an L{AuthorizedKeysCommand}, one request
+    at a time.  A request is a username followed by a newline, and the
+    response is zero or more lines in authorized_keys format followed by an
+    empty line.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.request = None
+        self.timeoutCall = None
+        self.ended = defer.Deferred()
+        self._buffer = ''
+        self._lines = []
+
+    def lookup(self, username):
+        """
+        @return: a L{twisted.internet.defer.Deferred} that fires with a
+            C{list} of the lines the helper answered with
+        """
+        self.request = defer.Deferred()
+        self.timeoutCall = self.pool.reactor.callLater(
+            self.pool.timeout, self._timedOut, username)
+        self.transport.write(username + '\n')
+        return self.request
+
+    def outReceived(self, data):
+        self._buffer += data
+        while self.request is not None and '\n' in self._buffer:
+            line, self._buffer = self._buffer.split('\n', 1)
+            line = line.strip()
+            if line:
+                self._lines.append(line)
+            else:
+                lines, self._lines = self._lines, []
+                self._finish().callback(lines)
+                self.pool._helperIdle(self)
+
+    def errReceived(self, data):
+        log.msg("Authorized keys helper: {0}".format(data.rstrip()))
+
+    def processEnded(self, reason):
+        if self.request is not None:
+            self._finish().errback(AuthorizedKeysCommandError(
+                "Helper exited: {0}".format(reason.getErrorMessage())))
+        self.pool._helperEnded(self)
+        self.pool._processes.remove(self)
+        self.ended.callback(None)
+
+    def _timedOut(self, username):
+        """
+        The helper took too long to answer - its answer can no longer be
+        told apart from the answer to the next request, so kill it
+        """
+        self.timeoutCall = None
+        self._finish().errback(AuthorizedKeysCommandError(
+            "Timed out looking up keys for {0!r}".format(username)))
+        self.pool._helperEnded(self)
+        try:
+            self.transport.signalProcess('KILL')
+        except error.ProcessExitedAlready:
+            pass
+
+    def _finish(self):
+        if self.timeoutCall is not None:
+            self.timeoutCall.cancel()
+            self.timeoutCall = None
+        request, self.request = self.request, None
+        return request
+
+
+@implementer(IAuthorizedKeysDB)
+class AuthorizedKeysCommand(object):
+    """
+    Object that provides SSH public keys by asking a helper program, much
+    like OpenSSH's C{AuthorizedKeysCommand}, except that up to C{poolSize}
+    long-lived helper processes are kept running and reused, rather than
+    one being started per lookup.
+
+    Helpers read usernames, one per line, from standard input, and answer
+    each with zero or more lines in authorized_keys format followed by an
+    empty line.  A helper that does not answer within C{timeout} seconds is
+    killed, and replaced for later lookups.
+
+    Results are not cached - wrap this in a L{CachingAuthorizedKeysDB} (and
+    a L{CoalescingAuthorizedKeysDB} to share concurrent lookups).
+
+    @ivar command: C{str} path of the helper program
+    @ivar args: C{list} of arguments to the helper program
+    @ivar poolSize: C{int} maximum number of helper processes
+    @ivar timeout: number of seconds to wait for a helper to answer
+    @ivar reactor: the reactor used to run helpers and time them out,
+        mainly to be used for testing.  The default is the reactor.
+    @ivar parsekey: a callable that takes a string and returns a
+        L{twisted.conch.ssh.keys.Key}, mainly to be used for testing.  The
+        default is L{twisted.conch.keys.Key.fromString}
+    """
+    def __init__(self, command, args=(), poolSize=2, timeout=5,
+                 reactor=None, parsekey=Key.fromString):
+        self.command = command
+        self.args = list(args)
+        self.poolSize = poolSize
+        self.timeout = timeout
+        self.reactor = reactor
+        self.parsekey = parsekey
+        if reactor is None:
+            from twisted.internet import reactor
+            self.reactor = reactor
+        self._processes = []
+        self._helpers = []
+        self._idle = []
+        self._queue = []
+
+    def getAuthorizedKeys(self, username):
+        """
+        @see: L{ess.checkers.IAuthorizedKeysDB}
+
+        Usernames that are empty, or that have whitespace or control
+        characters in them, have no keys and are not sent to helpers.
+
+        @return: a L{twisted.internet.defer.Deferred} that fires with a
+            C{list} of L{twisted.conch.ssh.keys.Key}, or fails with
+            L{AuthorizedKeysCommandError}
+        """
+        if not username or any(c.isspace() or c < ' ' or c == '\x7f'
+                               for c in username):
+            return defer.succeed([])
+        d = defer.Deferred()
+        self._queue.append((username, d))
+        self._dispatch()
+        return d.addCallback(
+            lambda lines: list(readAuthorizedKeyFile(lines, self.parsekey)))
+
+    def stop(self):
+        """
+        Ask every helper process to exit, by closing its standard input
+
+        @return: a L{twisted.internet.defer.Deferred} that fires once they
+            all have (including any killed helpers still exiting)
+        """
+        for helper in self._helpers:
+            helper.transport.closeStdin()
+        return defer.gatherResults(
+            [helper.ended for helper in self._processes])
+
+    def _dispatch(self):
+        """
+        Hand queued lookups to idle helpers, starting helpers if there are
+        not enough of them
+        """
+        while self._queue and (self._idle or
+                               len(self._helpers) < self.poolSize):
+            if self._idle:
+                helper = self._idle.pop()
+            else:
+                helper = _AuthorizedKeysHelper(self)
+                self._processes.append(helper)
+                self._helpers.append(helper)
+                self.reactor.spawnProcess(
+                    helper, self.command, [self.command] + self.args,
+                    env=os.environ)
+            username, d = self._queue.pop(0)
+            helper.lookup(username).chainDeferred(d)
+
+    def _helperIdle(self, helper):
+        if helper in self._helpers:
+            self._idle.append(helper)
+            self._dispatch()
+
+    def _helperEnded(self, helper):
+        if helper in self._helpers:
+            self._helpers.remove(helper)
+        if helper in self._idle:
+            self._idle.remove(helper)
+        self._dispatch()
+
 
 @implementer(ICredentialsChecker)
 class SSHPublicKeyChecker(object):
@@ -142,12 +1062,20 @@ class SSHPublicKeyChecker(object):
     equivalent to L{twisted.conch.checkers.SSHPublicKeyDatabase}.
 
     @ivar keydb: a provider of L{ISSHPublicKeyDB}
+    @ivar checkProbes: if C{True}, credentials without a signature (a client
+        asking whether a key would be accepted) are checked against
+        C{keydb} before the client is told to go ahead and sign, so that
+        unauthorized keys are rejected without computing or verifying a
+        signature.  The default is C{False}, which tells the client to sign
+        with any well-formed key.
     """
     credentialInterfaces = (ISSHPrivateKey,)
 
-    def __init__(self, keydb):
+    def __init__(self, keydb, checkProbes=False):
         self.keydb = keydb
+        self.checkProbes = checkProbes
 
+    @timed('auth.publickey')
     def requestAvatarId(self, credentials):
         """
         @see L{twisted.cred.checkers.ICredentialsChecker.requestAvatarId}
@@ -165,23 +1093,26 @@ class SSHPublicKeyChecker(object):
         @param credentials: The L{ISSHPrivateKey} provider credentials
             offered by the user.
 
-        @raise ValidPublicKey: the credentials do not include a signature. See
-            L{error.ValidPublicKey} for more information.
+        @raise ValidPublicKey: the credentials do not include a signature, and
+            C{checkProbes} is C{False}. See L{error.ValidPublicKey} for more
+            information.
 
         @raise BadKeyError: the key included with the credentials is not
             recognized as a key
 
         @return: L{twisted.conch.ssh.keys.Key} of the key in the credentials
         """
-        if not credentials.signature:
+        if not credentials.signature and not self.checkProbes:
             raise ValidPublicKey()
 
         return Key.fromString(credentials.blob)
 
+    @timed('auth.keyLookup')
     def _checkKey(self, pubKey, credentials):
         """
         Check the public key against all authorized keys (if any) for the
-        user.
+        user, or just ask C{keydb} about that key if it provides
+        L{IAuthorizedKeyLookup}.
 
         @param pubKey: L{twisted.conch.ssh.keys.Key} of the key in the
             credentials (just to prevent it from having to be calculated
@@ -190,21 +1121,40 @@ class SSHPublicKeyChecker(object):
         @param credentials: The L{ISSHPrivateKey} provider credentials
             offered by the user.
 
-        @raise UnauthorizedLogin: if the key is not authorized, or if there
+        @return: a L{twisted.internet.defer.Deferred} that fires with the
+            C{pubKey} if the key is authorized, or fails with
+            L{UnauthorizedLogin} if the key is not authorized or if there
             was any error obtaining a list of authorized keys for the user
+        """
+        if IAuthorizedKeyLookup.providedBy(self.keydb):
+            d = defer.maybeDeferred(self.keydb.isAuthorizedKey,
+                                    credentials.username, pubKey.blob())
+        else:
+            d = defer.maybeDeferred(self.keydb.getAuthorizedKeys,
+                                    credentials.username)
+            d.addCallback(lambda keys: any(key == pubKey for key in keys))
+        d.addCallbacks(self._cbKeyMatched, self._ebKeyLookup,
+                       callbackArgs=(pubKey,))
+        return d
 
-        @return: The C{pubKey}, if the key is authorized
+    def _cbKeyMatched(self, matched, pubKey):
         """
-        try:
-            if any(key == pubKey for key in
-                   self.keydb.getAuthorizedKeys(credentials.username)):
-                return pubKey
-        except:
-            log.err()
-            raise UnauthorizedLogin("Unable to get avatar id")
+        @raise UnauthorizedLogin: if no authorized key matched
 
+        @return: The C{pubKey}, if the key is authorized
+        """
+        if matched:
+            return pubKey
         raise UnauthorizedLogin("Key not authorized")
 
+    def _ebKeyLookup(self, failure):
+        """
+        @raise UnauthorizedLogin: always, after logging the error obtaining
+            (or reading) the list of authorized keys for the user
+        """
+        log.err(failure)
+        raise UnauthorizedLogin("Unable to get avatar id")
+
     def _verifyKey(self, pubKey, credentials):
         """
         Check whether the credentials themselves are valid, now that we know
@@ -217,11 +1167,226 @@ class SSHPublicKeyChecker(object):
         @param credentials: The L{ISSHPrivateKey} provider credentials
             offered by the user.
 
+        @raise ValidPublicKey: the credentials do not include a signature,
+            but the key is authorized for the user (only happens if
+            C{checkProbes} is C{True})
+
         @raise UnauthorizedLogin: if the key signature is invalid or there
             was any error verifying the signature
 
         @return: The user's username, if authentication was successful.
         """
+        if not credentials.signature:
+            raise ValidPublicKey()
+
+        try:
+            if pubKey.verify(credentials.signature, credentials.sigData):
+                return credentials.username
+        except:  # any error should be treated as a failed login
+            log.err()
+            raise UnauthorizedLogin('Error while verifying key')
+
+        raise UnauthorizedLogin("Key signature invalid.")
+
+
+# Key types of OpenSSH certificates, mapped to the key types of the keys
+# they certify and the number of mpints in those keys
+CERTIFICATE_TYPES = {
+    'ssh-rsa-cert-v01@openssh.com': ('ssh-rsa', 2),
+    'ssh-dss-cert-v01@openssh.com': ('ssh-dss', 4),
+}
+
+SSH_CERT_TYPE_USER = 1
+SSH_CERT_TYPE_HOST = 2
+
+
+Certificate = namedtuple('Certificate', [
+    'key', 'serial', 'type', 'keyId', 'principals', 'validAfter',
+    'validBefore', 'criticalOptions', 'extensions', 'signatureKey',
+    'signature', 'signed'])
+
+
+class _Reader(object):
+    """
+    Reads SSH wire format values from the start of a string
+    """
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def _take(self, length):
+        if self.offset + length > len(self.data):
+            raise BadKeyError("Truncated certificate")
+        value = self.data[self.offset:self.offset + length]
+        self.offset += length
+        return value
+
+    def uint32(self):
+        return struct.unpack('>L', self._take(4))[0]
+
+    def uint64(self):
+        return struct.unpack('>Q', self._take(8))[0]
+
+    def string(self):
+        return self._take(self.uint32())
+
+    def strings(self):
+        reader = _Reader(self.string())
+        values = []
+        while reader.offset < len(reader.data):
+            values.append(reader.string())
+        return values
+
+    def options(self):
+        values = self.strings()
+        if len(values) % 2:
+            raise BadKeyError("Malformed certificate options")
+        return dict((name, _Reader(data).string() if data else '')
+                    for name, data in zip(values[::2], values[1::2]))
+
+
+def parseCertificate(blob):
+    """
+    Parse an OpenSSH certificate (see PROTOCOL.certkeys in OpenSSH).  This
+    does not check that the certificate is valid in any way.
+
+    @param blob: C{str} the certificate blob
+
+    @raise BadKeyError: if the blob is not a supported certificate
+
+    @return: a L{Certificate}, whose C{key} is the certified
+        L{twisted.conch.ssh.keys.Key}, and whose C{signed} is the part of
+        the blob that the C{signature} by C{signatureKey} is over
+    """
+    reader = _Reader(blob)
+    certType = reader.string()
+    if certType not in CERTIFICATE_TYPES:
+        raise BadKeyError("Unsupported certificate type {0!r}".format(
+            certType))
+    keyType, mpints = CERTIFICATE_TYPES[certType]
+
+    reader.string()  # nonce
+    start = reader.offset
+    for _ in range(mpints):
+        reader.string()
+    key = Key.fromString(NS(keyType) + blob[start:reader.offset])
+
+    fields = [key, reader.uint64(), reader.uint32(), reader.string(),
+              reader.strings(), reader.uint64(), reader.uint64(),
+              reader.options(), reader.options()]
+    reader.string()  # reserved
+    signatureKey = reader.string()
+    signed = blob[:reader.offset]
+    signature = reader.string()
+    return Certificate(*(fields + [signatureKey, signature, signed]))
+
+
+@implementer(ICredentialsChecker)
+class SSHCertificateChecker(object):
+    """
+    Checker that authenticates OpenSSH user certificates signed by trusted
+    certificate authorities, without looking up any per-user keys.
+
+    A certificate is accepted if it is a user certificate signed by one of
+    the trusted CA keys, the username is one of its principals, it is
+    within its validity period, and every critical option in it is
+    understood.  Keys that are not certificates are passed on to a fallback
+    checker, if there is one, since a portal only has one checker for
+    L{ISSHPrivateKey} credentials.
+
+    The default L{twisted.conch.ssh.userauth.SSHUserAuthServer} cannot
+    parse certificates - use L{ess.userauth.EssUserAuthServer}.
+
+    @ivar caKeys: C{set} of the key blobs of the trusted CA keys
+    @ivar fallback: an L{ICredentialsChecker} for L{ISSHPrivateKey}
+        credentials that are not certificates, or C{None} to reject them
+    @ivar criticalOptions: C{dict} of the names of understood critical
+        options mapped to callables that take the option's value and the
+        credentials, and return whether the option is satisfied.  By default
+        no options are understood, so certificates with any critical options
+        (such as C{force-command} or C{source-address}) are rejected.
+    @ivar clock: L{twisted.internet.interfaces.IReactorTime} provider used to
+        check validity periods, mainly to be used for testing.  The default
+        is the reactor.
+    """
+    credentialInterfaces = (ISSHPrivateKey,)
+
+    def __init__(self, caKeys, fallback=None, criticalOptions=None,
+                 clock=None):
+        self.caKeys = set(key.blob() for key in caKeys)
+        self.fallback = fallback
+        self.criticalOptions = criticalOptions or {}
+        self.clock = clock
+        if clock is None:
+            from twisted.internet import reactor
+            self.clock = reactor
+
+    @timed('auth.certificate')
+    def requestAvatarId(self, credentials):
+        """
+        @see L{twisted.cred.checkers.ICredentialsChecker.requestAvatarId}
+        """
+        if credentials.algName not in CERTIFICATE_TYPES:
+            if self.fallback is None:
+                return defer.fail(UnauthorizedLogin("Not a certificate"))
+            return self.fallback.requestAvatarId(credentials)
+
+        d = defer.maybeDeferred(parseCertificate, credentials.blob)
+        d.addCallback(self._checkCertificate, credentials)
+        d.addCallback(self._verifySignature, credentials)
+        return d
+
+    def _checkCertificate(self, certificate, credentials):
+        """
+        Check that the certificate was issued by a trusted CA for the user,
+        and may be used now.
+
+        @raise UnauthorizedLogin: if the certificate may not be used
+
+        @return: the certified L{twisted.conch.ssh.keys.Key}
+        """
+        if certificate.type != SSH_CERT_TYPE_USER:
+            raise UnauthorizedLogin("Not a user certificate")
+        if certificate.signatureKey not in self.caKeys:
+            raise UnauthorizedLogin("Certificate not signed by a trusted CA")
+        if credentials.username not in certificate.principals:
+            raise UnauthorizedLogin("User not a certificate principal")
+
+        now = self.clock.seconds()
+        if not certificate.validAfter <= now < certificate.validBefore:
+            raise UnauthorizedLogin("Certificate not valid now")
+
+        for name, value in certificate.criticalOptions.iteritems():
+            check = self.criticalOptions.get(name)
+            if check is None or not check(value, credentials):
+                raise UnauthorizedLogin(
+                    "Critical option {0!r} not satisfied".format(name))
+
+        try:
+            caKey = Key.fromString(certificate.signatureKey)
+            valid = caKey.verify(certificate.signature, certificate.signed)
+        except:
+            log.err()
+            raise UnauthorizedLogin("Error while verifying certificate")
+        if not valid:
+            raise UnauthorizedLogin("Certificate signature invalid")
+
+        return certificate.key
+
+    def _verifySignature(self, pubKey, credentials):
+        """
+        Check that the user holds the private key for the certified key.
+
+        @raise ValidPublicKey: the credentials do not include a signature
+
+        @raise UnauthorizedLogin: if the signature is invalid, or there was
+            any error verifying it
+
+        @return: The user's username, if authentication was successful.
+        """
+        if not credentials.signature:
+            raise ValidPublicKey()
+
         try:
             if pubKey.verify(credentials.signature, credentials.sigData):
                 return credentials.username
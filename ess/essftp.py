@@ -9,7 +9,20 @@ from twisted.python import components
 from zope.interface import implements
 
 from ess import shelless
+from ess.backpressure import (FlowControlledSession,
+                              FlowControlledFileTransferServer)
 from ess.filepath import FilePath
+from ess.metrics import timed
+from ess.profiling import ProfilingFileTransferServer
+from ess.window import TunedSession
+
+
+def _readSize(self, offset, length, result):
+    return len(result)
+
+
+def _writeSize(self, offset, data, result):
+    return len(data)
 
 
 def _simplifyAttributes(filePath):
@@ -38,6 +51,7 @@ class EssFTPServer:
     def __init__(self, avatar):
         self.avatar = avatar
         self.root = FilePath(self.avatar.root)
+        self.flow = getattr(avatar, 'flow', None)
 
     def _getFilePath(self, path):
         """
@@ -77,13 +91,16 @@ class EssFTPServer:
             return True
         return False
 
+    @timed('sftp.gotVersion')
     def gotVersion(self, otherVersion, extData):
         return {}
 
+    @timed('sftp.openFile')
     def openFile(self, filename, flags, attrs):
         fp = self._getFilePath(filename)
-        return ChrootedFile(fp, flags, attrs)
+        return ChrootedFile(fp, flags, attrs, server=self)
 
+    @timed('sftp.removeFile')
     def removeFile(self, filename):
         """
         Remove the given file if it is either a file or a symlink.
@@ -98,6 +115,7 @@ class EssFTPServer:
             raise IOError("%s is a directory" % filename)
         fp.remove()
 
+    @timed('sftp.renameFile')
     def renameFile(self, oldname, newname):
         """
         Rename the given file/directory/link.
@@ -113,6 +131,7 @@ class EssFTPServer:
             raise IOError("%s does not exist" % oldname)
         oldFP.moveTo(newFP)
 
+    @timed('sftp.makeDirectory')
     def makeDirectory(self, path, attrs=None):
         """
         Make a directory.  Ignores the attributes.
@@ -122,6 +141,7 @@ class EssFTPServer:
             raise IOError("%s already exists." % path)
         fp.createDirectory()
 
+    @timed('sftp.removeDirectory')
     def removeDirectory(self, path):
         """
         Remove a directory non-recursively.
@@ -143,12 +163,14 @@ class EssFTPServer:
             raise IOError("%s is not empty.")
         fp.remove()
 
+    @timed('sftp.openDirectory')
     def openDirectory(self, path):
         fp = self._getFilePath(path)
         if not fp.isdir():
             raise IOError("%s is not a directory." % path)
         return ChrootedDirectory(self, fp)
 
+    @timed('sftp.getAttrs')
     def getAttrs(self, path, followLinks=True):
         """
         Get attributes of the path.
@@ -161,9 +183,11 @@ class EssFTPServer:
         fp.restat(followLink=followLinks)
         return _simplifyAttributes(fp)
 
+    @timed('sftp.setAttrs')
     def setAttrs(self, path, attrs):
         raise NotImplementedError
 
+    @timed('sftp.readLink')
     def readLink(self, path):
         """
         Returns the target of a symbolic link (relative to the root), so
@@ -182,6 +206,7 @@ class EssFTPServer:
             return self._getRelativePath(rp)
         raise IOError("%s is not a link." % path)
 
+    @timed('sftp.makeLink')
     def makeLink(self, linkPath, targetPath):
         """
         Create a symbolic link from linkPath to targetPath.
@@ -197,6 +222,7 @@ class EssFTPServer:
             raise IOError("%s does not exist." % targetPath)
         tp.linkTo(lp)
 
+    @timed('sftp.realPath')
     def realPath(self, path):
         """
         Despite what the interface says, this function will only return
@@ -211,6 +237,7 @@ class EssFTPServer:
             fp = fp.realpath()
         return self._getRelativePath(fp)
 
+    @timed('sftp.extendedRequest')
     def extendedRequest(self, extendedName, extendedData):
         raise NotImplementedError
 
@@ -229,6 +256,7 @@ class ChrootedDirectory:
         twisted.python.filepath)
         """
         self.server = server
+        self.filePath = filePath
         self.files = filePath.children()
 
     def __iter__(self):
@@ -237,6 +265,7 @@ class ChrootedDirectory:
     def has_next(self):
         return len(self.files) > 0
 
+    @timed('directory.next')
     def next(self):
         # TODO: problem - what if the user that logs in is not a user in the
         # system?
@@ -252,6 +281,7 @@ class ChrootedDirectory:
         longname = longname[:15] + longname[32:]  # remove uid and gid
         return (f.basename(), longname, _simplifyAttributes(f))
 
+    @timed('directory.close')
     def close(self):
         self.files = None
 
@@ -262,11 +292,13 @@ class ChrootedFile:
     """
     implements(ISFTPFile)
 
-    def __init__(self, filePath, flags, attrs=None):
+    def __init__(self, filePath, flags, attrs=None, server=None):
         """
         @param filePath: a FilePath to open
         @param flags: flags to open the file with
+        @param server: the EssFTPServer that opened the file, if any
         """
+        self.server = server
         self.filePath = filePath
         self.fd = self.filePath.open(flags=self.flagTranslator(flags))
 
@@ -307,9 +339,22 @@ class ChrootedFile:
 
         return newflags
 
+    def _shape(self, size, f, *args):
+        """
+        Call a function now or, if the user has a bandwidth
+        L{ess.shaping.Flow}, when the flow lets it go
+        """
+        flow = getattr(self.server, 'flow', None)
+        if flow is None:
+            return f(*args)
+        return flow.submit(size, f, *args)
+
+    @timed('file.close')
     def close(self):
-        self.fd.close()
+        # closing waits for the user's reads and writes queued before it
+        return self._shape(0, self.fd.close)
 
+    @timed('file.readChunk', _readSize)
     def readChunk(self, offset, length):
         """
         Read a chunk of data from the file
@@ -317,9 +362,13 @@ class ChrootedFile:
         @param offset: where to start reading
         @param length: how much data to read
         """
+        return self._shape(length, self._readChunk, offset, length)
+
+    def _readChunk(self, offset, length):
         self.fd.seek(offset)
         return self.fd.read(length)
 
+    @timed('file.writeChunk', _writeSize)
     def writeChunk(self, offset, data):
         """
         Write data to the file at the given offset
@@ -327,12 +376,17 @@ class ChrootedFile:
         @param offset: where to start writing
         @param data: the data to write in the file
         """
+        return self._shape(len(data), self._writeChunk, offset, data)
+
+    def _writeChunk(self, offset, data):
         self.fd.seek(offset)
         self.fd.write(data)
 
+    @timed('file.getAttrs')
     def getAttrs(self):
         return _simplifyAttributes(self.filePath)
 
+    @timed('file.setAttrs')
     def setAttrs(self, attrs=None):
         """
         This must return something, in order for certain write to be able to
@@ -345,25 +399,79 @@ class ChrootedFile:
 class EssFTPRealm(object):
     """
     A realm that returns a EssSFTPUser as an avatar
+
+    @ivar profiler: a L{ess.profiling.SessionProfiler} to profile sessions
+        with, or C{None}
+    @ivar maxRequests: maximum number of requests of a session waiting for
+        responses (see L{ess.backpressure}), or C{None} for no limit
+    @ivar maxBufferedBytes: maximum number of bytes of responses of a
+        session waiting to be sent, or C{None} for no limit
+    @ivar bandwidth: a L{ess.shaping.BandwidthScheduler} to shape users'
+        reads and writes with, or C{None}
+    @ivar bandwidthLimits: C{dict} mapping avatar IDs to the
+        L{ess.shaping.BandwidthLimit}s of the users, and C{None} to the
+        limit of users not in it, or C{None} for no limits
+    @ivar window: the L{ess.window.WindowPolicy} of session channels, or
+        C{None} for Conch's defaults
     """
     implements(portal.IRealm)
 
-    def __init__(self, root):
+    def __init__(self, root, profiler=None, maxRequests=None,
+                 maxBufferedBytes=None, bandwidth=None, bandwidthLimits=None,
+                 window=None):
         self.root = root
+        self.profiler = profiler
+        self.maxRequests = maxRequests
+        self.maxBufferedBytes = maxBufferedBytes
+        self.bandwidth = bandwidth
+        self.bandwidthLimits = bandwidthLimits or {}
+        self.window = window
 
     def requestAvatar(self, avatarID, mind, *interfaces):
-        user = EssFTPUser(self.root)
+        flow = None
+        if self.bandwidth is not None:
+            flow = self.bandwidth.flow(avatarID, self.bandwidthLimits.get(
+                avatarID, self.bandwidthLimits.get(None)))
+        user = EssFTPUser(self.root, avatarID, self.profiler,
+                          self.maxRequests, self.maxBufferedBytes, flow,
+                          self.window)
         return interfaces[0], user, user.logout
 
 
 class EssFTPUser(shelless.ShelllessUser):
     """
     A shell-less user that does not answer any global requests.
+
+    @ivar avatarId: the avatar ID the user logged in as, if known
+    @ivar profiler: a L{ess.profiling.SessionProfiler} to profile the user's
+        sessions with, or C{None}
+    @ivar maxRequests: maximum number of requests of a session waiting for
+        responses (see L{ess.backpressure}), or C{None} for no limit
+    @ivar maxBufferedBytes: maximum number of bytes of responses of a
+        session waiting to be sent, or C{None} for no limit
+    @ivar flow: the L{ess.shaping.Flow} the user's reads and writes wait
+        their turn in, or C{None}
+    @ivar window: the L{ess.window.WindowPolicy} of the user's session
+        channels, or C{None} for Conch's defaults
     """
-    def __init__(self, root):
+    def __init__(self, root, avatarId=None, profiler=None, maxRequests=None,
+                 maxBufferedBytes=None, flow=None, window=None):
         shelless.ShelllessUser.__init__(self)
         self.subsystemLookup["sftp"] = filetransfer.FileTransferServer
+        if maxRequests is not None or maxBufferedBytes is not None:
+            self.channelLookup["session"] = FlowControlledSession
+            self.subsystemLookup["sftp"] = FlowControlledFileTransferServer
+        if window is not None:
+            self.channelLookup["session"] = TunedSession
+        if profiler is not None:
+            self.subsystemLookup["sftp"] = ProfilingFileTransferServer
         self.root = root
+        self.avatarId = avatarId
+        self.profiler = profiler
+        self.maxRequests = maxRequests
+        self.maxBufferedBytes = maxBufferedBytes
+        self.flow = flow
+        self.window = window
 
 
 components.registerAdapter(EssFTPServer, EssFTPUser,
@@ -0,0 +1,113 @@
+"""
+Module that looks after the server's host keys and Diffie-Hellman groups:
+host keys missing from the key directory are generated and written there
+on first start, and moduli files are parsed only once per process.
+"""
+import os
+
+from Crypto.PublicKey import DSA, RSA
+
+from twisted.conch.openssh_compat import primes
+from twisted.conch.openssh_compat.factory import OpenSSHFactory
+from twisted.conch.ssh import keys
+from twisted.python import log
+
+
+# how to generate each type of host key
+_GENERATORS = {
+    'rsa': lambda: RSA.generate(2048),
+    'dsa': lambda: DSA.generate(1024),
+}
+
+# parsed moduli files, by path: ((mtime, size), primes)
+_moduli = {}
+
+
+def _writeNew(path, data, mode):
+    """
+    Write a file that is not there yet, all at once: other processes see
+    either no file or the whole of it
+
+    @return: whether the file was written (rather than already there)
+    """
+    temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+    fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.link(temporary, path)
+    except OSError:
+        if not os.path.exists(path):
+            raise
+        return False
+    finally:
+        os.unlink(temporary)
+    return True
+
+
+def generateHostKeys(directory, keyTypes=('rsa',)):
+    """
+    Generate the host keys of the given types that are missing from a
+    directory, and write them there in OpenSSH's format and naming
+    (C{ssh_host_rsa_key} and C{ssh_host_rsa_key.pub}, say).  Public keys
+    missing next to existing private keys are written from them.
+
+    @param directory: C{str} path of the directory
+    @param keyTypes: the types of keys (C{'rsa'} or C{'dsa'})
+
+    @return: C{list} of the paths of the private keys generated
+    """
+    generated = []
+    for keyType in keyTypes:
+        path = os.path.join(directory, 'ssh_host_{0}_key'.format(keyType))
+        key = None
+        if not os.path.exists(path):
+            key = keys.Key(_GENERATORS[keyType]())
+            if _writeNew(path, key.toString('openssh'), 0600):
+                log.msg('Generated host key {0}'.format(path))
+                generated.append(path)
+            else:
+                key = None
+        if os.path.exists(path + '.pub'):
+            continue
+        if key is None:
+            try:
+                key = keys.Key.fromFile(path)
+            except (IOError, keys.BadKeyError) as e:
+                log.msg('Cannot write public host key {0}.pub: {1}'.format(
+                    path, e))
+                continue
+        if _writeNew(path + '.pub', key.public().toString('openssh'), 0644):
+            log.msg('Wrote public host key {0}.pub'.format(path))
+    return generated
+
+
+def loadModuli(path):
+    """
+    Parse a moduli file, or return what it was parsed into before, if it
+    has not changed since
+
+    @return: C{dict} mapping sizes to C{list}s of (generator, prime), or
+        C{None} if the file cannot be read
+    """
+    try:
+        stat = os.stat(path)
+        version = (stat.st_mtime, stat.st_size)
+        cached = _moduli.get(path)
+        if cached is None or cached[0] != version:
+            cached = _moduli[path] = (version, primes.parseModuliFile(path))
+    except (IOError, OSError):
+        return None
+    return cached[1]
+
+
+class EssOpenSSHFactory(OpenSSHFactory):
+    """
+    L{OpenSSHFactory} that reads moduli with L{loadModuli}, from the key
+    directory unless C{moduliRoot} is set
+    """
+    moduliRoot = None
+
+    def getPrimes(self):
+        return loadModuli(os.path.join(self.moduliRoot or self.dataRoot,
+                                       'moduli'))
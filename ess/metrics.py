@@ -0,0 +1,215 @@
+"""
+Module that records how many times server operations are performed, how
+many bytes they transfer and how long they take, and exposes the results in
+the Prometheus text format (over HTTP, with L{MetricsResource})
+"""
+import time
+from array import array
+from bisect import bisect_left
+from functools import wraps
+
+from twisted.conch.error import ValidPublicKey
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from twisted.web import resource
+
+
+# upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# exceptions that end an operation without it having failed: the end of an
+# iterator (such as a directory listing), and the answer to a client asking
+# whether a public key would be accepted, which OpenSSH does before signing
+# with it
+_NOT_FAILURES = (StopIteration, ValidPublicKey)
+
+
+class Histogram(object):
+    """
+    Histogram with fixed buckets, so that recording a value is just a bisect
+    and an increment.
+
+    @ivar buckets: C{tuple} of the upper bounds of the buckets, in increasing
+        order - values greater than the last one are counted in an extra
+        bucket
+    @ivar counts: C{array} of the number of values in each bucket (not
+        cumulative), including the extra one
+    @ivar sum: sum of every value recorded
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = array('L', [0] * (len(self.buckets) + 1))
+        self.sum = 0.0
+
+    def observe(self, value):
+        """
+        Record a value
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class OperationStats(object):
+    """
+    What has been recorded about one operation
+
+    @ivar calls: C{int} number of times the operation was performed
+    @ivar errors: C{int} number of times it failed
+    @ivar bytes: C{int} number of bytes it transferred
+    @ivar latency: L{Histogram} of how many seconds it took
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.calls = 0
+        self.errors = 0
+        self.bytes = 0
+        self.latency = Histogram(buckets)
+
+
+class Metrics(object):
+    """
+    Object that records L{OperationStats} by operation name
+
+    @ivar operations: C{dict} mapping operation names to L{OperationStats}
+    @ivar buckets: C{tuple} of the upper bounds of the latency histogram
+        buckets
+    @ivar timer: a callable that returns the current time in seconds, mainly
+        to be used for testing.  The default is L{time.time}.
+    @ivar current: a C{tuple} of the name of the timed operation running
+        (synchronously) right now, the arguments it was called with and the
+        time it started, or C{None}
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS, timer=time.time):
+        self.operations = {}
+        self.buckets = buckets
+        self.timer = timer
+        self.current = None
+
+    def record(self, operation, seconds, size=0, failed=False):
+        """
+        Record one performance of an operation
+
+        @param operation: C{str} name of the operation
+        @param seconds: how long it took
+        @param size: C{int} number of bytes it transferred
+        @param failed: whether it failed
+        """
+        stats = self.operations.get(operation)
+        if stats is None:
+            stats = self.operations[operation] = OperationStats(self.buckets)
+        stats.calls += 1
+        stats.errors += failed
+        stats.bytes += size
+        stats.latency.observe(seconds)
+
+    def timed(self, operation, size=None):
+        """
+        Decorator that records every call of a function as a performance of
+        an operation.  If the function returns a
+        L{twisted.internet.defer.Deferred}, the operation ends when it
+        fires.  L{StopIteration} (the end of an iterator, such as a
+        directory listing) and L{twisted.conch.error.ValidPublicKey} (the
+        answer to a public key probe) are not counted as failures.
+
+        @param operation: C{str} name of the operation
+        @param size: a callable that takes the arguments the function was
+            called with, followed by C{result=} what it returned (or what
+            its L{twisted.internet.defer.Deferred} fired with), and returns
+            the number of bytes transferred - or C{None} to not count bytes
+        """
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                started = self.timer()
+                outer, self.current = self.current, (operation, args, started)
+                try:
+                    result = f(*args, **kwargs)
+                except _NOT_FAILURES:
+                    self.record(operation, self.timer() - started)
+                    raise
+                except:
+                    self.record(operation, self.timer() - started,
+                                failed=True)
+                    raise
+                finally:
+                    self.current = outer
+                if isinstance(result, defer.Deferred):
+                    return result.addBoth(self._finished, operation,
+                                          started, size, args, kwargs)
+                return self._finished(result, operation, started, size,
+                                      args, kwargs)
+            return wrapper
+        return decorator
+
+    def _finished(self, result, operation, started, size, args, kwargs):
+        seconds = self.timer() - started
+        if isinstance(result, Failure):
+            self.record(operation, seconds,
+                        failed=not result.check(*_NOT_FAILURES))
+        else:
+            self.record(operation, seconds,
+                        size(*args, result=result, **kwargs) if size else 0)
+        return result
+
+    def render(self, prefix='ess'):
+        """
+        @param prefix: C{str} prefix of every metric name
+
+        @return: C{str} of every metric, in the Prometheus text format
+        """
+        names = sorted(self.operations)
+        lines = []
+        for metric, kind, description, attribute in (
+                ('operations_total', 'counter',
+                 'Number of operations performed', 'calls'),
+                ('operation_errors_total', 'counter',
+                 'Number of operations that failed', 'errors'),
+                ('operation_bytes_total', 'counter',
+                 'Number of bytes transferred by operations', 'bytes')):
+            metric = '{0}_{1}'.format(prefix, metric)
+            lines.append('# HELP {0} {1}'.format(metric, description))
+            lines.append('# TYPE {0} {1}'.format(metric, kind))
+            for name in names:
+                lines.append('{0}{{operation="{1}"}} {2}'.format(
+                    metric, name,
+                    getattr(self.operations[name], attribute)))
+
+        metric = '{0}_operation_duration_seconds'.format(prefix)
+        lines.append('# HELP {0} How long operations took'.format(metric))
+        lines.append('# TYPE {0} histogram'.format(metric))
+        for name in names:
+            histogram = self.operations[name].latency
+            total = 0
+            bounds = [repr(float(b)) for b in histogram.buckets] + ['+Inf']
+            for bound, count in zip(bounds, histogram.counts):
+                total += count
+                lines.append('{0}_bucket{{operation="{1}",le="{2}"}} {3}'
+                             .format(metric, name, bound, total))
+            lines.append('{0}_sum{{operation="{1}"}} {2!r}'.format(
+                metric, name, histogram.sum))
+            lines.append('{0}_count{{operation="{1}"}} {2}'.format(
+                metric, name, total))
+        return '\n'.join(lines) + '\n'
+
+
+# the metrics recorded by the server
+metrics = Metrics()
+timed = metrics.timed
+
+
+class MetricsResource(resource.Resource):
+    """
+    Web resource that renders metrics in the Prometheus text format
+
+    @ivar metrics: the L{Metrics} to render (the default is the ones
+        recorded by the server)
+    """
+    isLeaf = True
+
+    def __init__(self, metrics=metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        return self.metrics.render()
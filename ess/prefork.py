@@ -0,0 +1,238 @@
+"""
+Module that runs a server in several pre-forked worker processes, which all
+accept connections from one listening socket, and a supervisor service that
+restarts workers that exit.
+
+Workers are started as C{python -m ess.prefork FD FACTORY [ARGS...]}: they
+adopt the listening socket passed to them as file descriptor C{FD} (of the
+address family in the environment variable C{ESS_WORKER_FAMILY}), and
+serve it with the factory returned by calling the callable named by the
+fully qualified name C{FACTORY} with the list of C{ARGS}.
+"""
+import os
+import socket
+import sys
+
+from twisted.application import service
+from twisted.internet import defer, error, protocol
+from twisted.internet.abstract import isIPv6Address
+from twisted.python import log, reflect
+
+
+_WORKER_FD = 3
+
+# environment variable telling a worker its index
+_WORKER_INDEX = 'ESS_WORKER_INDEX'
+
+# environment variable telling a worker the address family of the socket
+_WORKER_FAMILY = 'ESS_WORKER_FAMILY'
+
+
+def workerIndex():
+    """
+    @return: C{int} index of this worker process (from C{0}), or C{None} if
+        this is not a worker process
+    """
+    index = os.environ.get(_WORKER_INDEX)
+    if index is None:
+        return None
+    return int(index)
+
+
+class _WorkerProtocol(protocol.ProcessProtocol):
+    """
+    Logs the output of one worker, and tells the supervisor when it exits
+    """
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.started = supervisor.reactor.seconds()
+        self.ended = defer.Deferred()
+
+    def outReceived(self, data):
+        for line in data.splitlines():
+            log.msg("[worker {0}] {1}".format(self.index, line))
+
+    errReceived = outReceived
+
+    def processEnded(self, reason):
+        self.supervisor._workerEnded(self, reason)
+        self.ended.callback(None)
+
+
+class WorkerSupervisor(service.Service):
+    """
+    Service that listens on a TCP port and starts worker processes to
+    accept and serve connections on it, so that a server can use more than
+    one CPU.  The port is bound in L{privilegedStartService}, so that it can
+    be a privileged one.  Workers that exit are restarted after
+    C{restartDelay} seconds, doubling (up to C{maxRestartDelay}) while they
+    keep exiting within C{maxRestartDelay} seconds of being started.  When
+    the service stops, workers are sent C{SIGTERM}, and C{SIGKILL} if they
+    have not exited C{killTimeout} seconds later.
+
+    @ivar port: C{int} port to listen on (C{0} for any free port - see
+        L{getPort})
+    @ivar workers: C{int} number of worker processes
+    @ivar factoryName: C{str} fully qualified name of a callable that takes
+        C{args} and returns the factory for workers to serve the port with
+    @ivar args: C{list} of C{str} arguments for C{factoryName}
+    @ivar interface: C{str} IPv4 or IPv6 address of the interface to
+        listen on (C{''} for every IPv4 one, C{'::'} for every one)
+    @ivar backlog: C{int} size of the listen queue
+    @ivar restartDelay: number of seconds to wait before restarting a worker
+    @ivar maxRestartDelay: maximum number of seconds to wait before
+        restarting a worker
+    @ivar killTimeout: number of seconds to wait for workers to exit when
+        stopping, before killing them
+    @ivar reactor: the reactor used to run workers, mainly to be used for
+        testing.  The default is the reactor.
+    """
+    def __init__(self, port, workers, factoryName, args=(), interface='',
+                 backlog=50, restartDelay=1, maxRestartDelay=30,
+                 killTimeout=10, reactor=None):
+        self.port = port
+        self.workers = workers
+        self.factoryName = factoryName
+        self.args = list(args)
+        self.interface = interface
+        self.backlog = backlog
+        self.restartDelay = restartDelay
+        self.maxRestartDelay = maxRestartDelay
+        self.killTimeout = killTimeout
+        self.reactor = reactor
+        if reactor is None:
+            from twisted.internet import reactor
+            self.reactor = reactor
+        self._socket = None
+        self._workers = {}
+        self._delays = {}
+        self._restarts = {}
+
+    def getPort(self):
+        """
+        @return: C{int} port number the workers are listening on
+        """
+        return self._socket.getsockname()[1]
+
+    def privilegedStartService(self):
+        service.Service.privilegedStartService(self)
+        self._socket = self._listen()
+
+    def startService(self):
+        service.Service.startService(self)
+        if self._socket is None:
+            self._socket = self._listen()
+        for index in range(self.workers):
+            self._delays[index] = self.restartDelay
+            self._startWorker(index)
+
+    def stopService(self):
+        """
+        Stop the workers, killing those that have not exited after
+        C{killTimeout} seconds, and stop listening once they all have exited
+        """
+        service.Service.stopService(self)
+        for call in self._restarts.values():
+            call.cancel()
+        self._restarts.clear()
+
+        ended = []
+        for worker in self._workers.values():
+            ended.append(worker.ended)
+            try:
+                worker.transport.signalProcess('TERM')
+            except error.ProcessExitedAlready:
+                pass
+
+        kill = self.reactor.callLater(self.killTimeout, self._killWorkers)
+
+        def stopped(_):
+            if kill.active():
+                kill.cancel()
+            self._socket.close()
+
+        d = defer.gatherResults(ended)
+        d.addCallback(stopped)
+        return d
+
+    def _killWorkers(self):
+        for worker in self._workers.values():
+            log.msg("Worker {0} did not exit, killing it".format(
+                worker.index))
+            try:
+                worker.transport.signalProcess('KILL')
+            except error.ProcessExitedAlready:
+                pass
+
+    def _listen(self):
+        """
+        @return: a non-blocking C{socket.socket} listening on the port
+        """
+        family = socket.AF_INET
+        if isIPv6Address(self.interface):
+            family = socket.AF_INET6
+        listening = socket.socket(family, socket.SOCK_STREAM)
+        listening.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listening.bind((self.interface, self.port))
+        listening.listen(self.backlog)
+        listening.setblocking(False)
+        return listening
+
+    def _startWorker(self, index):
+        self._restarts.pop(index, None)
+        worker = _WorkerProtocol(self, index)
+        self._workers[index] = worker
+        env = dict(os.environ,
+                   PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+        env[_WORKER_INDEX] = str(index)
+        env[_WORKER_FAMILY] = str(self._socket.family)
+        self.reactor.spawnProcess(
+            worker, sys.executable,
+            [sys.executable, '-m', 'ess.prefork', str(_WORKER_FD),
+             self.factoryName] + self.args,
+            env=env,
+            childFDs={0: 'w', 1: 'r', 2: 'r',
+                      _WORKER_FD: self._socket.fileno()})
+
+    def _workerEnded(self, worker, reason):
+        if self._workers.get(worker.index) is worker:
+            del self._workers[worker.index]
+        if not self.running:
+            return
+
+        lived = self.reactor.seconds() - worker.started
+        if lived < self.maxRestartDelay:
+            delay = self._delays[worker.index]
+            self._delays[worker.index] = min(delay * 2, self.maxRestartDelay)
+        else:
+            delay = self._delays[worker.index] = self.restartDelay
+        log.msg("Worker {0} exited ({1}), restarting in {2} seconds".format(
+            worker.index, reason.getErrorMessage(), delay))
+        self._restarts[worker.index] = self.reactor.callLater(
+            delay, self._startWorker, worker.index)
+
+
+def main(argv=None, reactor=None):
+    """
+    Run a worker: adopt the listening socket and serve it until stopped
+
+    @param argv: C{list} of C{[FD, FACTORY, ARGS...]} - the default is
+        C{sys.argv[1:]}
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if reactor is None:
+        from twisted.internet import reactor
+
+    log.startLogging(sys.stdout, setStdout=False)
+    fd, factoryName, args = int(argv[0]), argv[1], argv[2:]
+    factory = reflect.namedAny(factoryName)(args)
+    family = int(os.environ.get(_WORKER_FAMILY, socket.AF_INET))
+    reactor.adoptStreamPort(fd, family, factory)
+    os.close(fd)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
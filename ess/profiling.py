@@ -0,0 +1,173 @@
+"""
+Module that profiles the SFTP sessions of chosen users, switched on and off
+at runtime through an admin socket, and writes a profile per session
+"""
+import cProfile
+import os
+import re
+import time
+
+from twisted.internet import protocol
+from twisted.protocols import basic
+from twisted.python import log
+
+from ess.backpressure import FlowControlledFileTransferServer
+
+
+class SessionProfiler(object):
+    """
+    Object that keeps track of which users' sessions should be profiled,
+    and writes their profiles (in the L{pstats} format) to a directory, as
+    C{AVATARID-TIME-PID-N.prof}.
+
+    @ivar directory: C{str} path of the directory to write profiles to
+    @ivar avatarIds: C{set} of the avatar IDs whose sessions are profiled
+    @ivar everyone: whether every session is profiled
+    @ivar timer: a callable that returns the current time in seconds, mainly
+        to be used for testing.  The default is L{time.time}.
+    """
+    def __init__(self, directory, timer=time.time):
+        self.directory = directory
+        self.avatarIds = set()
+        self.everyone = False
+        self.timer = timer
+        self._written = 0
+
+    def enable(self, avatarId=None):
+        """
+        Profile the sessions of a user (including sessions already open,
+        from their next request), or of everyone
+
+        @param avatarId: the avatar ID of the user, or C{None} for everyone
+        """
+        if avatarId is None:
+            self.everyone = True
+        else:
+            self.avatarIds.add(avatarId)
+
+    def disable(self, avatarId=None):
+        """
+        Stop profiling the sessions of a user, or of anyone
+
+        @param avatarId: the avatar ID of the user, or C{None} for anyone
+        """
+        if avatarId is None:
+            self.everyone = False
+            self.avatarIds.clear()
+        else:
+            self.avatarIds.discard(avatarId)
+
+    def isProfiled(self, avatarId):
+        """
+        @return: whether the sessions of a user should be profiled
+        """
+        return self.everyone or avatarId in self.avatarIds
+
+    def write(self, avatarId, profile):
+        """
+        Write the profile of a session
+
+        @param avatarId: the avatar ID of the user whose session it was
+        @param profile: the L{cProfile.Profile} of the session
+
+        @return: C{str} path of the file written
+        """
+        self._written += 1
+        name = '{0}-{1}-{2}-{3}.prof'.format(
+            re.sub(r'[^\w.@-]', '_', str(avatarId)), int(self.timer()),
+            os.getpid(), self._written)
+        path = os.path.join(self.directory, name)
+        profile.dump_stats(path)
+        log.msg("Wrote profile of session of {0!r} to {1}".format(
+            avatarId, path))
+        return path
+
+
+class ProfilingFileTransferServer(FlowControlledFileTransferServer):
+    """
+    SFTP server protocol that profiles the handling of every request of the
+    session while the avatar's C{profiler} (a L{SessionProfiler}) says the
+    user's sessions should be, and writes the profile when the session ends.
+    Only the work done while handling requests is profiled, not the time
+    between them.
+    """
+    def __init__(self, data=None, avatar=None):
+        FlowControlledFileTransferServer.__init__(self, data, avatar)
+        self.avatar = avatar
+        self.profile = None
+
+    def dataReceived(self, data):
+        profiler = self.avatar.profiler
+        if not profiler.isProfiled(self.avatar.avatarId):
+            return FlowControlledFileTransferServer.dataReceived(self, data)
+
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+        self.profile.enable()
+        try:
+            return FlowControlledFileTransferServer.dataReceived(self, data)
+        finally:
+            self.profile.disable()
+
+    def connectionLost(self, reason):
+        FlowControlledFileTransferServer.connectionLost(self, reason)
+        if self.profile is not None:
+            self.avatar.profiler.write(self.avatar.avatarId, self.profile)
+            self.profile = None
+
+
+class AdminProtocol(basic.LineReceiver):
+    """
+    Line-based admin protocol, to switch profiling on and off::
+
+        profile AVATARID    profile the sessions of a user
+        profile *           profile every session
+        unprofile AVATARID  stop profiling the sessions of a user
+        unprofile *         stop profiling any session
+        status              list what is profiled
+
+    Every command is answered with one line, starting with C{ok} or
+    C{error}.
+    """
+    delimiter = '\n'
+
+    def lineReceived(self, line):
+        words = line.strip().split(None, 1)
+        command = words[0] if words else ''
+        argument = words[1] if len(words) > 1 else None
+        handler = getattr(self, 'command_' + command, None)
+        if handler is None:
+            self.sendLine('error unknown command {0!r}'.format(command))
+        else:
+            self.sendLine(handler(argument))
+
+    def command_profile(self, avatarId):
+        if avatarId is None:
+            return 'error missing avatar ID'
+        self.factory.profiler.enable(None if avatarId == '*' else avatarId)
+        return 'ok'
+
+    def command_unprofile(self, avatarId):
+        if avatarId is None:
+            return 'error missing avatar ID'
+        self.factory.profiler.disable(None if avatarId == '*' else avatarId)
+        return 'ok'
+
+    def command_status(self, ignored):
+        profiler = self.factory.profiler
+        profiled = sorted(profiler.avatarIds)
+        if profiler.everyone:
+            profiled.insert(0, '*')
+        return ' '.join(['ok'] + profiled)
+
+
+class AdminFactory(protocol.ServerFactory):
+    """
+    Factory for L{AdminProtocol}
+
+    @ivar profiler: the L{SessionProfiler} to control
+    """
+    protocol = AdminProtocol
+
+    def __init__(self, profiler):
+        self.profiler = profiler
@@ -0,0 +1,232 @@
+"""
+Module that shapes the bandwidth of file reads and writes: token bucket
+rate limits per user and for the whole server, and a weighted fair
+scheduler that decides whose reads and writes are done next, so that a few
+users transferring in bulk cannot crowd out everyone else.
+"""
+import weakref
+from collections import deque, namedtuple
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from ess.throttle import TokenBucket
+
+
+class BandwidthLimit(namedtuple('BandwidthLimit',
+                                ['rate', 'burst', 'weight'])):
+    """
+    How much bandwidth a user may have
+
+    @ivar rate: number of bytes per second the user may read and write, or
+        C{None} for no limit
+    @ivar burst: number of bytes the user may read and write at once, or
+        C{None} for one second's worth
+    @ivar weight: the user's share of the bandwidth, relative to other
+        users', when there is not enough for everyone
+    """
+    __slots__ = ()
+
+
+def _bucket(rate, burst, now):
+    if rate is None:
+        return None
+    return TokenBucket(rate, burst or rate, now)
+
+
+class Flow(object):
+    """
+    The reads and writes of one user, waiting for their turn in a
+    L{BandwidthScheduler}
+
+    @ivar key: what the flow is for (the user's avatar ID)
+    @ivar weight: the flow's share of the bandwidth, relative to other
+        flows'
+    @ivar bucket: L{TokenBucket} of the flow's own limit, or C{None}
+    @ivar queue: C{deque} of the flow's waiting requests
+    @ivar finish: the virtual time at which the last request queued finishes
+    """
+    def __init__(self, scheduler, key, weight, bucket):
+        self.scheduler = scheduler
+        self.key = key
+        self.weight = weight
+        self.bucket = bucket
+        self.queue = deque()
+        self.finish = 0.0
+
+    def submit(self, size, f, *args, **kwargs):
+        """
+        Call a function that reads or writes C{size} bytes when the flow's
+        turn comes, and its limits (and the scheduler's) allow it
+
+        @return: a L{defer.Deferred} that fires with the result of the call
+        """
+        return self.scheduler.submit(self, size, f, *args, **kwargs)
+
+
+class BandwidthScheduler(object):
+    """
+    Weighted fair queueing scheduler for reads and writes, with token bucket
+    limits on each L{Flow} and on all of them together.
+
+    Every request is tagged with a virtual start and finish time, its finish
+    being its size divided by its flow's weight after its start, and the
+    request with the earliest finish among those whose limits allow them
+    goes next.  Virtual time is the start tag of the last request to go,
+    rather than the time of a simulated fluid system.  When no request is
+    allowed yet, the scheduler waits until one is.  A request bigger than a
+    limit's burst waits for a full bucket, and leaves it in debt.
+
+    Each process schedules only its own requests: with several worker
+    processes (see L{ess.prefork}), each has its own limits and shares them
+    out among its own flows.
+
+    @ivar bucket: L{TokenBucket} of the limit on all flows together, or
+        C{None}
+    @ivar virtualTime: the start time of the last request to go
+    @ivar clock: L{twisted.internet.interfaces.IReactorTime} provider, mainly
+        to be used for testing.  The default is the reactor.
+    """
+    def __init__(self, rate=None, burst=None, clock=None):
+        """
+        @param rate: number of bytes per second all flows together may read
+            and write, or C{None} for no limit
+        @param burst: number of bytes all flows together may read and write
+            at once, or C{None} for one second's worth
+        """
+        self.clock = clock
+        if clock is None:
+            from twisted.internet import reactor
+            self.clock = reactor
+        self.bucket = _bucket(rate, burst, self.clock.seconds())
+        self.virtualTime = 0.0
+        self._flows = weakref.WeakValueDictionary()
+        self._active = set()
+        self._wakeup = None
+        self._running = False
+
+    def flow(self, key, limit=None):
+        """
+        @param key: what the flow is for - flows are shared by key, for as
+            long as anything uses them
+        @param limit: the L{BandwidthLimit} of the flow, if it is new
+
+        @return: the L{Flow} for C{key}
+        """
+        flow = self._flows.get(key)
+        if flow is None:
+            limit = limit or BandwidthLimit(None, None, 1)
+            flow = Flow(self, key, limit.weight,
+                        _bucket(limit.rate, limit.burst,
+                                self.clock.seconds()))
+            self._flows[key] = flow
+        return flow
+
+    def submit(self, flow, size, f, *args, **kwargs):
+        """
+        @see: L{Flow.submit}
+        """
+        d = defer.Deferred()
+        start = max(self.virtualTime, flow.finish)
+        flow.finish = start + size / float(flow.weight)
+        flow.queue.append((start, flow.finish, size, f, args, kwargs, d))
+        self._active.add(flow)
+        self._run()
+        return d
+
+    def _delay(self, flow, size, now):
+        delay = 0
+        for bucket in (self.bucket, flow.bucket):
+            if bucket is not None:
+                delay = max(delay, bucket.delay(now, size))
+        return delay
+
+    def _run(self):
+        """
+        Let requests go, earliest finish first, for as long as their limits
+        allow, then wait until another one is allowed
+        """
+        if self._running:
+            return
+        self._running = True
+        try:
+            while self._active:
+                now = self.clock.seconds()
+                chosen, wait = None, None
+                for flow in self._active:
+                    start, finish, size = flow.queue[0][:3]
+                    if chosen is not None and finish >= chosen.queue[0][1]:
+                        continue
+                    delay = self._delay(flow, size, now)
+                    if delay:
+                        wait = delay if wait is None else min(wait, delay)
+                    else:
+                        chosen = flow
+                if chosen is None:
+                    self._wait(wait)
+                    return
+                self._go(chosen, now)
+        finally:
+            self._running = False
+
+    def _go(self, flow, now):
+        start, finish, size, f, args, kwargs, d = flow.queue.popleft()
+        if not flow.queue:
+            self._active.discard(flow)
+        self.virtualTime = start
+        for bucket in (self.bucket, flow.bucket):
+            if bucket is not None:
+                bucket.take(now, size)
+        try:
+            result = f(*args, **kwargs)
+        except:
+            d.errback(Failure())
+        else:
+            d.callback(result)
+
+    def _wait(self, delay):
+        if self._wakeup is not None:
+            if self._wakeup.getTime() <= self.clock.seconds() + delay:
+                return
+            self._wakeup.cancel()
+        self._wakeup = self.clock.callLater(delay, self._wake)
+
+    def _wake(self):
+        self._wakeup = None
+        self._run()
+
+
+def readBandwidthLimits(f):
+    """
+    Read users' bandwidth limits from a file with lines like::
+
+        # avatar ID   bytes per second   weight
+        alice         1048576            2
+        bob           -                  1
+        *             65536
+
+    where C{-} is no limit, the weight is optional (1 by default) and C{*}
+    is everyone not listed.  Blank lines and lines starting with C{#} are
+    ignored.
+
+    @param f: a file object to read lines from
+
+    @return: C{dict} mapping avatar IDs (and C{None}, for everyone else) to
+        L{BandwidthLimit}s, for L{ess.essftp.EssFTPRealm}
+
+    @raise ValueError: if a line cannot be parsed
+    """
+    limits = {}
+    for line in f:
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+        if len(fields) not in (2, 3):
+            raise ValueError('Bad bandwidth limit line: {0!r}'.format(line))
+        avatarId = None if fields[0] == '*' else fields[0]
+        rate = None if fields[1] == '-' else int(fields[1])
+        weight = float(fields[2]) if len(fields) == 3 else 1
+        if weight <= 0:
+            raise ValueError('Bad bandwidth weight: {0!r}'.format(line))
+        limits[avatarId] = BandwidthLimit(rate, None, weight)
+    return limits
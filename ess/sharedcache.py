@@ -0,0 +1,190 @@
+"""
+Module that provides a cache shared between processes (such as the workers
+started by L{ess.prefork}), in a memory-mapped file, so that what one
+process looked up does not have to be looked up again by every other one
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import stat
+import struct
+import zlib
+
+
+_MAGIC = 'ESSSHMC1'
+
+# magic, number of slots, slot size, generation
+_HEADER = struct.Struct('>8sIIQ')
+_GENERATION_OFFSET = 16
+
+# sequence number, checksum, generation, expiry time, key length,
+# value length
+_SLOT = struct.Struct('>IIQdHI')
+
+
+class SharedMemoryCache(object):
+    """
+    Object that caches C{str} values by C{str} key, with an expiry time, in a
+    file that every process using the cache maps into memory.
+
+    The file is a fixed-size hash table of C{slots} slots of C{slotSize}
+    bytes: each key can only be cached in one slot, so a key evicts any other
+    key cached in the same slot, and keys and values too big for a slot are
+    not cached at all.
+
+    Writers lock the slot they write (with C{fcntl} record locks, which the
+    kernel releases if the process dies) and mark it as being written with a
+    sequence number, like a seqlock.  Readers do not lock: a slot that is
+    being written, or that changed or does not match its checksum by the
+    time it has been read - for instance because a worker died half-way
+    through writing it - is just a cache miss, and the next writer
+    overwrites it.
+
+    Every slot records the generation of the cache it was written in, so
+    that L{clear} only has to bump the generation in the file header.
+
+    @ivar path: C{str} path of the file - it is created (readable and
+        writable by the owner only) if it does not exist, and (re)initialised
+        if it is not a cache file of the same geometry.  An existing file is
+        refused unless it is owned by this process's user, with mode 0600,
+        since anyone who can write it can choose the cached authorized keys.
+    @ivar slots: C{int} number of slots
+    @ivar slotSize: C{int} size of a slot, in bytes
+    """
+    def __init__(self, path, slots=4096, slotSize=2048):
+        self.path = path
+        self.slots = slots
+        self.slotSize = slotSize
+        size = _HEADER.size + slots * slotSize
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            info = os.fstat(self._fd)
+            if (info.st_uid != os.geteuid() or
+                    stat.S_IMODE(info.st_mode) != 0600):
+                raise ValueError(
+                    "{0} must be owned by uid {1} and have mode 0600".format(
+                        path, os.geteuid()))
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, _HEADER.size, 0)
+            try:
+                header = os.read(self._fd, _HEADER.size)
+                if (len(header) != _HEADER.size or os.fstat(self._fd).st_size
+                        != size or _HEADER.unpack(header)[:3] !=
+                        (_MAGIC, slots, slotSize)):
+                    os.ftruncate(self._fd, 0)
+                    os.ftruncate(self._fd, size)
+                    os.lseek(self._fd, 0, os.SEEK_SET)
+                    os.write(self._fd,
+                             _HEADER.pack(_MAGIC, slots, slotSize, 0))
+                self._map = mmap.mmap(self._fd, size)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, _HEADER.size, 0)
+        except:
+            os.close(self._fd)
+            raise
+
+    def get(self, key, now):
+        """
+        @param key: C{str} key
+        @param now: the current time, in seconds since the epoch
+
+        @return: a C{tuple} of the C{str} value cached for the key and the
+            time it expires, or C{None} if there is no unexpired value
+        """
+        offset = self._offset(key)
+        sequence, = struct.unpack_from('>I', self._map, offset)
+        if sequence % 2:
+            return None
+        slot = self._map[offset:offset + self.slotSize]
+        if struct.unpack_from('>I', self._map, offset)[0] != sequence:
+            return None
+
+        (_, checksum, generation, expires, keyLength,
+         valueLength) = _SLOT.unpack_from(slot)
+        end = _SLOT.size + keyLength + valueLength
+        if (generation != self._generation() or expires <= now or
+                keyLength != len(key) or end > self.slotSize):
+            return None
+        data = slot[_SLOT.size:end]
+        if (data[:keyLength] != key or
+                zlib.crc32(data) & 0xffffffff != checksum):
+            return None
+        return data[keyLength:], expires
+
+    def set(self, key, value, expires):
+        """
+        Cache a value, replacing whatever was cached in its slot
+
+        @param key: C{str} key
+        @param value: C{str} value
+        @param expires: the time the value expires, in seconds since the
+            epoch
+
+        @return: C{True} if the value was cached, C{False} if it was too big
+        """
+        data = key + value
+        if _SLOT.size + len(data) > self.slotSize:
+            return False
+        self._write(key, _SLOT.pack(
+            0, zlib.crc32(data) & 0xffffffff, self._generation(), expires,
+            len(key), len(value)) + data)
+        return True
+
+    def delete(self, key):
+        """
+        Discard the value cached for a key, if any
+
+        @param key: C{str} key
+        """
+        self._write(key, None)
+
+    def clear(self):
+        """
+        Discard every cached value
+        """
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, _HEADER.size, 0)
+        try:
+            struct.pack_into('>Q', self._map, _GENERATION_OFFSET,
+                             self._generation() + 1)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, _HEADER.size, 0)
+
+    def close(self):
+        """
+        Unmap and close the file
+        """
+        self._map.close()
+        os.close(self._fd)
+
+    def _offset(self, key):
+        hashed, = struct.unpack('>Q', hashlib.sha1(key).digest()[:8])
+        return _HEADER.size + (hashed % self.slots) * self.slotSize
+
+    def _generation(self):
+        return struct.unpack_from('>Q', self._map, _GENERATION_OFFSET)[0]
+
+    def _write(self, key, slot):
+        """
+        Write a slot (or, if C{slot} is C{None}, empty it if it holds the
+        key), holding its lock and with an odd sequence number meanwhile
+        """
+        offset = self._offset(key)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self.slotSize, offset)
+        try:
+            if slot is None:
+                keyLength = struct.unpack_from('>H', self._map,
+                                               offset + 24)[0]
+                start = offset + _SLOT.size
+                if self._map[start:start + keyLength] != key:
+                    return
+                slot = _SLOT.pack(0, 0, 0, 0, 0, 0)
+            sequence, = struct.unpack_from('>I', self._map, offset)
+            # the sequence number is left odd if a writer died, so skip to
+            # the next odd one either way
+            sequence = ((sequence + 1) | 1) & 0xffffffff
+            struct.pack_into('>I', self._map, offset, sequence)
+            self._map[offset + 4:offset + len(slot)] = slot[4:]
+            struct.pack_into('>I', self._map, offset,
+                             (sequence + 1) & 0xffffffff)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self.slotSize, offset)
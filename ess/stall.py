@@ -0,0 +1,152 @@
+"""
+Module that detects when the reactor thread is blocked (by a slow
+filesystem or user database, say), and logs what it was doing
+"""
+import sys
+import threading
+import time
+import traceback
+
+from twisted.application import service
+from twisted.cred.credentials import ICredentials
+from twisted.internet import task
+from twisted.python import log
+
+from ess.metrics import metrics as _metrics
+
+
+def describeOperation(operation, args):
+    """
+    Describe a timed operation (see L{ess.metrics.Metrics.timed}) by the
+    path and session it is for, where they can be found in its arguments.
+    Authentication is described by the username of the credentials among
+    its arguments, if any.
+
+    @param operation: C{str} name of the operation
+    @param args: C{tuple} of the arguments the operation was called with -
+        for methods, starting with the object they were called on
+
+    @return: C{str} description
+    """
+    target = args[0] if args else None
+    description = [operation]
+
+    path = getattr(getattr(target, 'filePath', None), 'path', None)
+    if path is None and len(args) > 1 and isinstance(args[1], str):
+        path = args[1]
+    if path is not None:
+        description.append('path={0!r}'.format(path))
+
+    server = getattr(target, 'server', target)
+    avatarId = getattr(getattr(server, 'avatar', None), 'avatarId', None)
+    if avatarId is None:
+        for arg in args[1:]:
+            if ICredentials.providedBy(arg):
+                avatarId = getattr(arg, 'username', None)
+                break
+    if avatarId is not None:
+        description.append('avatar={0!r}'.format(avatarId))
+    return ' '.join(description)
+
+
+class StallDetector(service.Service):
+    """
+    Service that measures how late the reactor runs a call scheduled every
+    C{interval} seconds, and watches from another thread for the reactor
+    thread getting stuck: if the call has not run for more than C{threshold}
+    seconds longer than it should have, the timed operation that is running
+    (see L{ess.metrics.Metrics.current}) and the stack of the reactor thread
+    are logged, once per stall.
+
+    The lag of every call is also recorded in C{metrics}, as the
+    C{reactor.lag} operation.
+
+    @ivar threshold: number of seconds of lag that count as a stall
+    @ivar interval: number of seconds between checks
+    @ivar metrics: the L{ess.metrics.Metrics} to find the running operation
+        in, and to record lag in (the default is the server's)
+    @ivar describe: a callable that takes the name and the arguments of the
+        running operation and returns a C{str} description of it (the
+        default is L{describeOperation})
+    @ivar reactor: the reactor to watch, mainly to be used for testing.  The
+        default is the reactor.
+    @ivar timer: a callable that returns the current time in seconds, mainly
+        to be used for testing.  The default is L{time.time}.
+    """
+    def __init__(self, threshold=0.5, interval=0.1, metrics=_metrics,
+                 describe=describeOperation, reactor=None, timer=time.time):
+        self.threshold = threshold
+        self.interval = interval
+        self.metrics = metrics
+        self.describe = describe
+        self.reactor = reactor
+        self.timer = timer
+        if reactor is None:
+            from twisted.internet import reactor
+            self.reactor = reactor
+        self._beat = None
+        self._reported = False
+        self._reactorThreadId = None
+        self._stopping = None
+        self._thread = None
+        self._loop = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self._reactorThreadId = threading.current_thread().ident
+        self._beat = self.timer()
+        self._loop = task.LoopingCall(self._heartbeat)
+        self._loop.clock = self.reactor
+        self._loop.start(self.interval, now=False)
+
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._watch,
+                                        name='ess stall detector')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        self._loop.stop()
+        self._stopping.set()
+        self._thread.join()
+
+    def _heartbeat(self):
+        """
+        Called by the reactor every C{interval} seconds
+        """
+        now = self.timer()
+        self.metrics.record('reactor.lag',
+                            max(0, now - self._beat - self.interval))
+        self._beat = now
+        self._reported = False
+
+    def _watch(self):
+        while not self._stopping.wait(self.interval):
+            self.check()
+
+    def check(self):
+        """
+        Log the running operation and the stack of the reactor thread if it
+        is stalled, and this stall has not already been logged.  Called
+        every C{interval} seconds from the watchdog thread.
+
+        @return: C{True} if a stall was logged
+        """
+        lag = self.timer() - self._beat - self.interval
+        if lag <= self.threshold or self._reported:
+            return False
+        self._reported = True
+
+        current = self.metrics.current
+        if current is None:
+            operation = 'no timed operation'
+        else:
+            operation = '{0}, running for {1:.3f}s'.format(
+                self.describe(current[0], current[1]),
+                self.timer() - current[2])
+        frame = sys._current_frames().get(self._reactorThreadId)
+        stack = ''.join(traceback.format_stack(frame)) if frame else ''
+        log.msg("Reactor stalled for {0:.3f}s: {1}\n{2}".format(
+            lag, operation, stack))
+        return True
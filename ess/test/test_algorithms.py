@@ -0,0 +1,178 @@
+"""
+Tests for L{ess.algorithms}.
+"""
+from twisted.conch.ssh import transport
+from twisted.conch.ssh.common import NS
+from twisted.conch.ssh.keys import Key
+from twisted.conch.test.keydata import privateRSA_openssh
+from twisted.internet import defer
+from twisted.protocols import loopback
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from ess.algorithms import (PROFILES, FastSSHCiphers, TunedServerTransport,
+                            makeTransport, parseAlgorithms)
+
+
+def kexInit(ciphers, macs):
+    """
+    @return: the payload of a client's KEXINIT message offering C{ciphers}
+        and C{macs}
+    """
+    return ('\x00' * 16 +
+            NS('diffie-hellman-group1-sha1') + NS('ssh-rsa') +
+            NS(ciphers) + NS(ciphers) + NS(macs) + NS(macs) +
+            NS('none') + NS('none') + NS('') + NS('') +
+            '\x00' + '\x00\x00\x00\x00')
+
+
+class FastSSHCiphersTestCase(TestCase):
+    """
+    Tests for L{FastSSHCiphers}
+    """
+    def assertSameAsConch(self, cipher, iv):
+        key = '\x01' * 32
+        data = ''.join(chr(i % 256) for i in range(4096))
+        conch = transport.SSHCiphers(cipher, cipher, 'none', 'none')
+        fast = FastSSHCiphers(cipher, cipher, 'none', 'none')
+        for ciphers in conch, fast:
+            ciphers.setKeys(iv, key, iv, key, '', '')
+        for _ in range(3):
+            encrypted = conch.encrypt(data)
+            self.assertEqual(encrypted, fast.encrypt(data))
+            self.assertEqual(data, fast.decrypt(encrypted))
+
+    def test_counter_mode(self):
+        """
+        Counter mode ciphers produce the same key stream as Conch's
+        """
+        for cipher in ('aes128-ctr', 'aes256-ctr', 'blowfish-ctr'):
+            self.assertSameAsConch(cipher, '\x02' * 16)
+
+    def test_wraparound(self):
+        """
+        The counter wraps around to zero, as Conch's does
+        """
+        self.assertSameAsConch('aes128-ctr', '\xff' * 16)
+
+    def test_other_modes(self):
+        """
+        Ciphers not in counter mode are left to Conch
+        """
+        self.assertSameAsConch('aes128-cbc', '\x02' * 16)
+        self.assertSameAsConch('none', '')
+
+
+class TunedServerTransportTestCase(TestCase):
+    """
+    Tests for L{makeTransport} and L{TunedServerTransport}
+    """
+    def test_profiles(self):
+        """
+        The transport offers the algorithms of a profile, or the ones given
+        instead
+        """
+        proto = makeTransport('throughput')
+        self.assertTrue(issubclass(proto, TunedServerTransport))
+        self.assertEqual(PROFILES['throughput']['ciphers'],
+                         proto.supportedCiphers)
+        self.assertEqual(transport.SSHTransportBase.supportedMACs,
+                         makeTransport().supportedMACs)
+
+        proto = makeTransport('throughput', macs=['hmac-sha1'],
+                              keyExchanges=['diffie-hellman-group1-sha1'])
+        self.assertEqual((['hmac-sha1'], ['diffie-hellman-group1-sha1']),
+                         (proto.supportedMACs, proto.supportedKeyExchanges))
+        self.assertNotIdentical(transport.SSHTransportBase.supportedCiphers,
+                                makeTransport().supportedCiphers)
+
+    def test_negotiation(self):
+        """
+        The ciphers negotiated are the client's first of the ones offered,
+        and are L{FastSSHCiphers}
+        """
+        server = makeTransport('throughput')()
+        server.makeConnection(StringTransport())
+        self.assertIn('aes128-ctr,aes192-ctr,aes256-ctr',
+                      server.transport.value())
+        server.ssh_KEXINIT(kexInit('aes256-cbc,aes256-ctr,aes128-ctr',
+                                   'hmac-sha1,hmac-md5'))
+        chosen = server.nextEncryptions
+        self.assertIsInstance(chosen, FastSSHCiphers)
+        self.assertEqual(('aes256-ctr', 'aes256-ctr', 'hmac-sha1'),
+                         (chosen.outCipType, chosen.inCipType,
+                          chosen.outMACType))
+
+
+class _Factory(object):
+    """
+    Stands in for the SSH factory of a server transport
+    """
+    privateKeys = {'ssh-rsa': Key.fromString(privateRSA_openssh)}
+    publicKeys = {'ssh-rsa': privateKeys['ssh-rsa'].public()}
+
+    def getDHPrime(self, bits):
+        return transport.DH_GENERATOR, transport.DH_PRIME
+
+
+class _ClientTransport(transport.SSHClientTransport):
+    """
+    Client transport that trusts any host key, and disconnects once the key
+    exchange is done
+    """
+    def __init__(self):
+        self.secure = defer.Deferred()
+
+    def verifyHostKey(self, hostKey, fingerprint):
+        return defer.succeed(True)
+
+    def connectionSecure(self):
+        self.secure.callback(self.kexAlg)
+        self.loseConnection()
+
+
+class GroupExchangeTestCase(TestCase):
+    """
+    Tests for the Diffie-Hellman group exchange of L{TunedServerTransport}
+    """
+    def test_short_exponent(self):
+        """
+        The group exchange uses C{exponentBits} bit exponents, and the
+        client accepts what it is sent
+        """
+        exponents = []
+        generateX = transport._generateX
+
+        def _generateX(random, bits):
+            exponents.append(bits)
+            return generateX(random, bits)
+        self.patch(transport, '_generateX', _generateX)
+
+        server = makeTransport()()
+        server.factory = _Factory()
+        server.supportedPublicKeys = ['ssh-rsa']
+        client = _ClientTransport()
+        client.supportedKeyExchanges = ['diffie-hellman-group-exchange-sha1']
+        loopback.loopbackAsync(server, client)
+        d = client.secure
+        d.addCallback(self.assertEqual, 'diffie-hellman-group-exchange-sha1')
+        d.addCallback(lambda _: self.assertIn(512, exponents))
+        return d
+
+
+class ParseAlgorithmsTestCase(TestCase):
+    """
+    Tests for L{parseAlgorithms}
+    """
+    def test_parse(self):
+        """
+        Comma separated names are returned in order
+        """
+        self.assertEqual(['b', 'a'], parseAlgorithms('b,a', ['a', 'b', 'c']))
+
+    def test_unsupported(self):
+        """
+        Unsupported names, or none at all, are errors
+        """
+        self.assertRaises(ValueError, parseAlgorithms, 'a,d', ['a', 'b'])
+        self.assertRaises(ValueError, parseAlgorithms, '', ['a', 'b'])
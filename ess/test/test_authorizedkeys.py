@@ -0,0 +1,85 @@
+"""
+Tests for L{ess.authorizedkeys}.
+"""
+from twisted.conch.ssh.keys import Key
+from twisted.conch.test.keydata import publicRSA_openssh, publicDSA_openssh
+from twisted.python.fakepwd import UserDatabase
+from twisted.python.filepath import FilePath
+from twisted.python.usage import UsageError
+from twisted.trial.unittest import TestCase
+
+from ess import authorizedkeys
+from ess.checkers import SQLiteAuthorizedKeysDB, MappedAuthorizedKeysIndex
+
+
+class AuthorizedKeysTestCase(TestCase):
+    """
+    Tests for L{authorizedkeys.main}
+    """
+    def setUp(self):
+        self.rsa = Key.fromString(publicRSA_openssh)
+        self.dsa = Key.fromString(publicDSA_openssh)
+        self.root = FilePath(self.mktemp())
+        self.pwd = UserDatabase()
+        for username, key in [('alice', publicRSA_openssh),
+                              ('bob', publicDSA_openssh)]:
+            ssh = self.root.child(username).child('.ssh')
+            ssh.makedirs()
+            ssh.child('authorized_keys').setContent(key)
+            self.pwd.addUser(username, 'password', 1, 2, username,
+                             self.root.child(username).path, '/bin/sh')
+
+    def runCommand(self, *argv):
+        options = authorizedkeys.Options()
+        options.parseOptions(argv)
+        authorizedkeys.main(options, self.pwd)
+
+    def test_files(self):
+        """
+        L{authorizedkeys.authorizedKeysFiles} maps the users given, or every
+        user, to their authorized keys files
+        """
+        ssh = self.root.child('alice').child('.ssh')
+        expected = [ssh.child('authorized_keys').path,
+                    ssh.child('authorized_keys2').path]
+        self.assertEqual(
+            {'alice': expected},
+            authorizedkeys.authorizedKeysFiles(['alice'], self.pwd))
+        self.assertEqual(
+            ['alice', 'bob'],
+            sorted(authorizedkeys.authorizedKeysFiles(pwd=self.pwd)))
+
+    def test_import(self):
+        """
+        The C{import} command loads every user's keys into an SQLite
+        database, or only the keys of the users given
+        """
+        path = self.mktemp()
+        self.runCommand('import', path, 'bob')
+        keydb = SQLiteAuthorizedKeysDB(path)
+        self.addCleanup(keydb.close)
+        self.assertEqual([], keydb.getAuthorizedKeys('alice'))
+        self.assertEqual([self.dsa], keydb.getAuthorizedKeys('bob'))
+
+        self.runCommand('import', path)
+        self.assertEqual([self.rsa], keydb.getAuthorizedKeys('alice'))
+
+    def test_compile(self):
+        """
+        The C{compile} command compiles an index of every user's keys, or of
+        only the keys of the users given
+        """
+        path = self.mktemp()
+        self.runCommand('compile', path, 'bob')
+        keydb = MappedAuthorizedKeysIndex(path)
+        self.assertEqual([], keydb.getAuthorizedKeys('alice'))
+        self.assertEqual([self.dsa], keydb.getAuthorizedKeys('bob'))
+
+        self.runCommand('compile', path)
+        self.assertEqual([self.rsa], keydb.getAuthorizedKeys('alice'))
+
+    def test_no_command(self):
+        """
+        A command must be given
+        """
+        self.assertRaises(UsageError, self.runCommand)
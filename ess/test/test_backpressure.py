@@ -0,0 +1,268 @@
+"""
+Tests for L{ess.backpressure}.
+"""
+import errno
+import struct
+
+from twisted.conch.ssh import filetransfer
+from twisted.conch.ssh.common import NS
+from twisted.conch.ssh.session import SSHSessionProcessProtocol
+from twisted.internet import defer
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import TestCase
+
+from ess import essftp
+from ess.backpressure import (FlowControlledConnection, FlowControlledSession,
+                              FlowControlledFileTransferServer)
+
+
+def packet(kind, payload):
+    return struct.pack('!LB', len(payload) + 1, kind) + payload
+
+
+def init():
+    return packet(filetransfer.FXP_INIT, struct.pack('!L', 3))
+
+
+def stat(requestId, path='/'):
+    return packet(filetransfer.FXP_STAT,
+                  struct.pack('!L', requestId) + NS(path))
+
+
+class _Connection(object):
+    """
+    Stands in for the SSH connection of a channel
+    """
+    def __init__(self):
+        self.sent = []
+        self.adjusted = []
+
+    def sendData(self, channel, data):
+        self.sent.append(data)
+
+    def adjustWindow(self, channel, bytesToAdd):
+        self.adjusted.append(bytesToAdd)
+        channel.localWindowLeft += bytesToAdd
+
+
+class FlowControlledFileTransferServerTestCase(TestCase):
+    """
+    Tests for L{FlowControlledFileTransferServer}, over a
+    L{FlowControlledSession}
+    """
+    def setUp(self):
+        self.root = FilePath(self.mktemp())
+        self.root.makedirs()
+        self.conn = _Connection()
+        self.session = FlowControlledSession(
+            localWindow=1000, remoteWindow=1000000, remoteMaxPacket=32768,
+            conn=self.conn)
+
+    def connect(self, **limits):
+        """
+        Start an SFTP session for a user with limits
+        """
+        avatar = essftp.EssFTPUser(self.root.path, **limits)
+        self.server = FlowControlledFileTransferServer(avatar=avatar)
+        self.server.makeConnection(SSHSessionProcessProtocol(self.session))
+        self.stats = []
+
+        def getAttrs(path, followLinks=True):
+            d = defer.Deferred()
+            self.stats.append(d)
+            return d
+        self.patch(self.server.client, 'getAttrs', getAttrs)
+        self.server.dataReceived(init())
+
+    def test_max_requests(self):
+        """
+        Requests are not handled while C{maxRequests} of them are waiting for
+        responses, and the window is withheld in the meantime
+        """
+        self.connect(maxRequests=2)
+        self.server.dataReceived(stat(1) + stat(2) + stat(3))
+        self.assertEqual(2, len(self.stats))
+        self.assertTrue(self.session.readingPaused)
+
+        self.stats[0].callback({})
+        self.assertEqual(3, len(self.stats))
+        self.assertTrue(self.session.readingPaused)
+
+        self.session.localWindowLeft = 0
+        self.stats[1].callback({})
+        self.assertFalse(self.session.readingPaused)
+        self.assertEqual([1000], self.conn.adjusted)
+
+    def test_failed_requests_count_as_answered(self):
+        """
+        Requests that fail are answered with a status, and stop counting
+        """
+        self.connect(maxRequests=1)
+        self.server.dataReceived(stat(1) + stat(2))
+        self.stats[0].errback(OSError(errno.ENOENT, 'No such file'))
+        self.assertEqual(2, len(self.stats))
+        self.assertEqual({struct.pack('!L', 2): 1}, self.server.requests)
+
+    def test_reused_ids_counted(self):
+        """
+        Requests that share an ID are each counted, and each response
+        answers one of them
+        """
+        self.connect(maxRequests=2)
+        self.server.dataReceived(''.join(stat(7) for _ in range(50)))
+        self.assertEqual(2, len(self.stats))
+        self.assertEqual(2, self.server.outstanding)
+        self.assertTrue(self.session.readingPaused)
+
+        self.stats[0].callback({})
+        self.assertEqual(3, len(self.stats))
+        self.assertEqual({struct.pack('!L', 7): 2}, self.server.requests)
+        self.assertTrue(self.session.readingPaused)
+
+    def test_broken_requests_not_counted(self):
+        """
+        Requests whose handler raises are never answered, so stop counting
+        """
+        self.connect(maxRequests=1)
+        self.server.dataReceived(
+            packet(filetransfer.FXP_OPEN, struct.pack('!L', 1)) + stat(2))
+        self.assertEqual(1, len(self.flushLoggedErrors(struct.error)))
+        self.assertEqual(1, len(self.stats))
+        self.assertEqual({struct.pack('!L', 2): 1}, self.server.requests)
+
+    def test_unknown_requests_not_counted(self):
+        """
+        Packets of unknown types are dropped, and not counted
+        """
+        self.connect(maxRequests=1)
+        self.server.dataReceived(packet(250, struct.pack('!L', 1)) + stat(2))
+        self.assertEqual(1, len(self.stats))
+        self.assertEqual({struct.pack('!L', 2): 1}, self.server.requests)
+
+    def test_unsupported_requests_answered(self):
+        """
+        Requests of types the server does not handle are answered with a
+        status, and stop counting
+        """
+        self.connect(maxRequests=1)
+        self.server.dataReceived(
+            packet(filetransfer.FXP_DATA, struct.pack('!L', 1)) + stat(2))
+        self.assertEqual(1, len(self.stats))
+        self.assertIn(struct.pack('!BLL', filetransfer.FXP_STATUS, 1,
+                                  filetransfer.FX_OP_UNSUPPORTED),
+                      ''.join(self.conn.sent))
+
+    def test_shortest_packet(self):
+        """
+        A packet of just a length and a type is handled, not left waiting
+        for more data
+        """
+        self.connect(maxRequests=10)
+        self.server.dataReceived(packet(filetransfer.FXP_STAT, ''))
+        self.assertEqual(1, len(self.flushLoggedErrors(struct.error)))
+        self.assertEqual({}, self.server.requests)
+        self.server.dataReceived(stat(1))
+        self.assertEqual(1, len(self.stats))
+
+    def test_max_buffered_bytes(self):
+        """
+        Requests are not handled while C{maxBufferedBytes} of responses are
+        waiting for the client's window to open, and are handled once they
+        have been sent
+        """
+        self.connect(maxBufferedBytes=10)
+        self.session.remoteWindowLeft = 0
+        self.server.dataReceived(stat(1))
+        self.stats[0].callback({})
+        self.server.dataReceived(stat(2))
+        self.assertEqual(1, len(self.stats))
+        self.assertTrue(self.session.readingPaused)
+
+        self.session.addWindowBytes(1000000)
+        self.assertEqual('', self.session.buf)
+        self.assertEqual(2, len(self.stats))
+        self.assertFalse(self.session.readingPaused)
+
+    def test_no_limits(self):
+        """
+        Without limits, every request is handled as soon as it is received
+        """
+        self.connect()
+        self.server.dataReceived(''.join(stat(i) for i in range(100)))
+        self.assertEqual(100, len(self.stats))
+        self.assertFalse(self.session.readingPaused)
+
+    def test_partial_requests(self):
+        """
+        Requests received in pieces are handled once they are whole
+        """
+        self.connect(maxRequests=10)
+        data = stat(1)
+        self.server.dataReceived(data[:7])
+        self.assertEqual([], self.stats)
+        self.server.dataReceived(data[7:])
+        self.assertEqual(1, len(self.stats))
+
+    def test_lost(self):
+        """
+        When the session ends, the channel forgets about it
+        """
+        self.connect(maxRequests=10)
+        self.assertIdentical(self.server, self.session.flowObserver)
+        self.server.connectionLost(None)
+        self.assertIdentical(None, self.session.flowObserver)
+
+
+class FlowControlledConnectionTestCase(TestCase):
+    """
+    Tests for L{FlowControlledConnection}
+    """
+    def test_window_withheld(self):
+        """
+        The window of a channel is not opened while its reading is paused
+        """
+        sent = []
+
+        class _Transport(object):
+            def sendPacket(self, kind, data):
+                sent.append((kind, data))
+
+        conn = FlowControlledConnection()
+        conn.transport = _Transport()
+        session = FlowControlledSession(localWindow=1000, conn=conn)
+        session.id = 0
+        session.localWindowLeft = 0
+        conn.channelsToRemoteChannel[session] = 5
+
+        session.pauseReading()
+        conn.adjustWindow(session, 1000)
+        self.assertEqual([], sent)
+        session.resumeReading()
+        self.assertEqual(1, len(sent))
+        self.assertEqual(1000, session.localWindowLeft)
+
+
+class EssFTPUserTestCase(TestCase):
+    """
+    Tests for the flow control of L{essftp.EssFTPUser}
+    """
+    def test_limits(self):
+        """
+        Users with limits from their realm get flow controlled sessions
+        """
+        realm = essftp.EssFTPRealm('/', maxRequests=10)
+        user = realm.requestAvatar('alice', None, None)[1]
+        self.assertEqual((10, None),
+                         (user.maxRequests, user.maxBufferedBytes))
+        self.assertIdentical(FlowControlledSession,
+                             user.channelLookup['session'])
+        self.assertIdentical(FlowControlledFileTransferServer,
+                             user.subsystemLookup['sftp'])
+
+    def test_no_limits(self):
+        """
+        Users without limits get plain sessions
+        """
+        user = essftp.EssFTPUser('/')
+        self.assertIdentical(filetransfer.FileTransferServer,
+                             user.subsystemLookup['sftp'])
@@ -2,15 +2,21 @@
 Tests for L{ess.checkers}.
 """
 
+import struct
+import sys
+import threading
 from collections import namedtuple
 from cStringIO import StringIO
 
 from zope.interface.verify import verifyObject
 
 from twisted.conch.error import ValidPublicKey
+from twisted.conch.ssh.common import NS
 from twisted.conch.ssh.keys import BadKeyError
 from twisted.cred.credentials import SSHPrivateKey
 from twisted.cred.error import UnauthorizedLogin
+from twisted.internet import defer
+from twisted.internet.task import Clock
 from twisted.python.filepath import FilePath
 from twisted.trial.unittest import TestCase
 
@@ -19,9 +25,19 @@ from twisted.conch.test.keydata import (publicRSA_openssh, privateRSA_openssh,
 from twisted.python.fakepwd import UserDatabase
 from twisted.test.test_process import MockOS
 
+from ess import checkers
+from ess.sharedcache import SharedMemoryCache
 from ess.checkers import (readAuthorizedKeyFile, IAuthorizedKeysDB,
-                          AuthorizedKeysFilesMapping,
-                          UNIXAuthorizedKeysFiles, SSHPublicKeyChecker, Key)
+                          IAuthorizedKeyLookup,
+                          AuthorizedKeysFilesMapping, SQLiteAuthorizedKeysDB,
+                          compileAuthorizedKeysIndex,
+                          MappedAuthorizedKeysIndex,
+                          CachingUserDatabase,
+                          UNIXAuthorizedKeysFiles, CachingAuthorizedKeysDB,
+                          CoalescingAuthorizedKeysDB,
+                          SSHPublicKeyChecker, Key, parseCertificate,
+                          SSHCertificateChecker, AuthorizedKeysCommand,
+                          AuthorizedKeysCommandError)
 
 
 class AuthorizedKeyFileReaderTestCase(TestCase):
@@ -130,6 +146,360 @@ class AuthorizedKeysFilesMappingTestCase(TestCase):
                          list(keydb.getAuthorizedKeys('alice')))
 
 
+class SQLiteAuthorizedKeysDBTestCase(TestCase):
+    """
+    Tests for L{SQLiteAuthorizedKeysDB}
+    """
+    def setUp(self):
+        self.rsa = Key.fromString(publicRSA_openssh)
+        self.dsa = Key.fromString(publicDSA_openssh)
+        self.path = self.mktemp()
+        self.keydb = SQLiteAuthorizedKeysDB(self.path)
+        self.addCleanup(self.keydb.close)
+
+    def test_implements_interface(self):
+        """
+        L{SQLiteAuthorizedKeysDB} implements L{IAuthorizedKeysDB} and
+        L{IAuthorizedKeyLookup}
+        """
+        verifyObject(IAuthorizedKeysDB, self.keydb)
+        verifyObject(IAuthorizedKeyLookup, self.keydb)
+
+    def test_is_authorized_key(self):
+        """
+        L{SQLiteAuthorizedKeysDB.isAuthorizedKey} is C{True} only for the
+        keys authorized for the user
+        """
+        self.keydb.addKey('alice', self.rsa)
+        self.keydb.addKey('bob', self.dsa)
+        self.assertTrue(self.keydb.isAuthorizedKey('alice', self.rsa.blob()))
+        self.assertFalse(self.keydb.isAuthorizedKey('alice', self.dsa.blob()))
+        self.assertFalse(self.keydb.isAuthorizedKey('carol', self.rsa.blob()))
+
+    def test_other_threads(self):
+        """
+        L{SQLiteAuthorizedKeysDB} can be used from threads other than the
+        one that created it
+        """
+        self.keydb.addKey('alice', self.rsa)
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            self.keydb.isAuthorizedKey('alice', self.rsa.blob())))
+        thread.start()
+        thread.join()
+        self.assertEqual([True], results)
+
+    def test_no_keys_for_unknown_user(self):
+        """
+        L{SQLiteAuthorizedKeysDB.getAuthorizedKeys} returns no keys for a
+        user that is not in the database
+        """
+        self.keydb.addKey('alice', self.rsa)
+        self.assertEqual([], list(self.keydb.getAuthorizedKeys('bob')))
+
+    def test_add_and_remove_keys(self):
+        """
+        Keys added with L{SQLiteAuthorizedKeysDB.addKey} are returned by
+        L{SQLiteAuthorizedKeysDB.getAuthorizedKeys} until they are removed
+        with L{SQLiteAuthorizedKeysDB.removeKey}, and adding a key twice
+        does not duplicate it
+        """
+        self.keydb.addKey('alice', self.rsa)
+        self.keydb.addKey('alice', self.dsa)
+        self.keydb.addKey('alice', self.rsa)
+        self.assertEqual(
+            sorted([self.rsa.blob(), self.dsa.blob()]),
+            sorted(k.blob() for k in self.keydb.getAuthorizedKeys('alice')))
+        self.keydb.removeKey('alice', self.rsa)
+        self.assertEqual([self.dsa],
+                         list(self.keydb.getAuthorizedKeys('alice')))
+
+    def test_set_keys_and_remove_user(self):
+        """
+        L{SQLiteAuthorizedKeysDB.setKeys} replaces all of a user's keys and
+        L{SQLiteAuthorizedKeysDB.removeUser} removes them, without affecting
+        other users
+        """
+        self.keydb.addKey('alice', self.rsa)
+        self.keydb.addKey('bob', self.rsa)
+        self.keydb.setKeys('alice', [self.dsa])
+        self.assertEqual([self.dsa],
+                         list(self.keydb.getAuthorizedKeys('alice')))
+        self.keydb.removeUser('alice')
+        self.assertEqual([], list(self.keydb.getAuthorizedKeys('alice')))
+        self.assertEqual([self.rsa], list(self.keydb.getAuthorizedKeys('bob')))
+
+    def test_import_authorized_keys_files(self):
+        """
+        L{SQLiteAuthorizedKeysDB.importAuthorizedKeysFiles} replaces the keys
+        of every user in the mapping with the parsable keys in their
+        authorized keys files
+        """
+        root = FilePath(self.mktemp())
+        root.makedirs()
+        root.child('alice').setContent(
+            '# comment\n{0}\nnot a key\n'.format(publicRSA_openssh))
+        root.child('bob').setContent(publicDSA_openssh)
+
+        self.keydb.addKey('alice', self.dsa)
+        self.keydb.importAuthorizedKeysFiles(
+            {'alice': [root.child('alice').path],
+             'bob': [root.child('bob').path, root.child('nope').path]})
+        self.assertEqual([self.rsa],
+                         list(self.keydb.getAuthorizedKeys('alice')))
+        self.assertEqual([self.dsa], list(self.keydb.getAuthorizedKeys('bob')))
+
+    def test_persistent(self):
+        """
+        Keys are stored in the database file, not in memory
+        """
+        self.keydb.addKey('alice', self.rsa)
+        keydb = SQLiteAuthorizedKeysDB(self.path)
+        self.addCleanup(keydb.close)
+        self.assertEqual([self.rsa], list(keydb.getAuthorizedKeys('alice')))
+
+
+class MappedAuthorizedKeysIndexTestCase(TestCase):
+    """
+    Tests for L{compileAuthorizedKeysIndex} and L{MappedAuthorizedKeysIndex}
+    """
+    def setUp(self):
+        self.rsa = Key.fromString(publicRSA_openssh)
+        self.dsa = Key.fromString(publicDSA_openssh)
+        self.root = FilePath(self.mktemp())
+        self.root.makedirs()
+        self.root.child('rsa').setContent(publicRSA_openssh)
+        self.root.child('dsa').setContent(
+            '# comment\n{0}\nnot a key'.format(publicDSA_openssh))
+        self.index = self.root.child('index').path
+        self.mapping = {
+            'alice': [self.root.child('rsa').path,
+                      self.root.child('dsa').path],
+            'bob': [self.root.child('dsa').path,
+                    self.root.child('nope').path]}
+
+    def blobs(self, keydb, username):
+        return sorted(key.blob() for key in keydb.getAuthorizedKeys(username))
+
+    def test_implements_interface(self):
+        """
+        L{MappedAuthorizedKeysIndex} implements L{IAuthorizedKeysDB} and
+        L{IAuthorizedKeyLookup}
+        """
+        compileAuthorizedKeysIndex(self.mapping, self.index)
+        keydb = MappedAuthorizedKeysIndex(self.index)
+        verifyObject(IAuthorizedKeysDB, keydb)
+        verifyObject(IAuthorizedKeyLookup, keydb)
+
+    def test_keys_for_users(self):
+        """
+        L{MappedAuthorizedKeysIndex.getAuthorizedKeys} returns the keys in
+        all the authorized files compiled into the index for a user, and no
+        keys for users that are not in the index
+        """
+        compileAuthorizedKeysIndex(self.mapping, self.index)
+        keydb = MappedAuthorizedKeysIndex(self.index)
+        self.assertEqual(sorted([self.rsa.blob(), self.dsa.blob()]),
+                         self.blobs(keydb, 'alice'))
+        self.assertEqual([self.dsa.blob()], self.blobs(keydb, 'bob'))
+        self.assertEqual([], self.blobs(keydb, 'carol'))
+
+    def test_hash_collisions(self):
+        """
+        Users whose usernames hash to the same value only get their own keys
+        """
+        self.patch(checkers, '_usernameHash', lambda username: 0)
+        self.patch(checkers, '_keyHash', lambda username, blob: 0)
+        self.test_keys_for_users()
+        self.test_is_authorized_key()
+
+    def test_is_authorized_key(self):
+        """
+        L{MappedAuthorizedKeysIndex.isAuthorizedKey} is C{True} only for the
+        keys compiled into the index for the user, and does not parse any
+        keys
+        """
+        compileAuthorizedKeysIndex(self.mapping, self.index)
+        keydb = MappedAuthorizedKeysIndex(self.index)
+        self.patch(Key, 'fromString', None)
+        self.assertTrue(keydb.isAuthorizedKey('alice', self.rsa.blob()))
+        self.assertTrue(keydb.isAuthorizedKey('bob', self.dsa.blob()))
+        self.assertFalse(keydb.isAuthorizedKey('bob', self.rsa.blob()))
+        self.assertFalse(keydb.isAuthorizedKey('carol', self.dsa.blob()))
+
+    def test_empty_index(self):
+        """
+        An index compiled from no users has no keys for anyone
+        """
+        compileAuthorizedKeysIndex({}, self.index)
+        keydb = MappedAuthorizedKeysIndex(self.index)
+        self.assertEqual([], self.blobs(keydb, 'alice'))
+        self.assertFalse(keydb.isAuthorizedKey('alice', self.rsa.blob()))
+
+    def test_recompiled_index_picked_up(self):
+        """
+        If the index is recompiled, the next lookup uses the new index
+        """
+        compileAuthorizedKeysIndex(self.mapping, self.index)
+        keydb = MappedAuthorizedKeysIndex(self.index)
+        self.assertEqual([self.dsa.blob()], self.blobs(keydb, 'bob'))
+        compileAuthorizedKeysIndex(
+            {'bob': [self.root.child('rsa').path]}, self.index)
+        self.assertEqual([self.rsa.blob()], self.blobs(keydb, 'bob'))
+        self.assertEqual([], self.blobs(keydb, 'alice'))
+
+    def test_not_an_index(self):
+        """
+        L{MappedAuthorizedKeysIndex} raises L{ValueError} if the file is not
+        an authorized keys index
+        """
+        self.assertRaises(ValueError, MappedAuthorizedKeysIndex,
+                          self.root.child('rsa').path)
+        self.root.child('empty').setContent('')
+        self.assertRaises(ValueError, MappedAuthorizedKeysIndex,
+                          self.root.child('empty').path)
+
+
+class _CountingUserDatabase(UserDatabase):
+    """
+    L{UserDatabase} that records the usernames looked up
+    """
+    def __init__(self):
+        UserDatabase.__init__(self)
+        self.lookups = []
+
+    def getpwnam(self, username):
+        self.lookups.append(username)
+        return UserDatabase.getpwnam(self, username)
+
+
+class _BrokenUserDatabase(object):
+    """
+    User database that is unreachable
+    """
+    def getpwnam(self, username):
+        raise _DummyException()
+
+
+class CachingUserDatabaseTestCase(TestCase):
+    """
+    Tests for L{CachingUserDatabase}
+    """
+    def setUp(self):
+        self.userdb = _CountingUserDatabase()
+        self.userdb.addUser('alice', 'password', 1, 2, 'alice lastname',
+                            '/home/alice', '/bin/shell')
+        self.clock = Clock()
+        self.cache = CachingUserDatabase(self.userdb, positiveTTL=10,
+                                         negativeTTL=5, maxSize=2,
+                                         clock=self.clock)
+
+    def test_caches_existing_user(self):
+        """
+        L{CachingUserDatabase.getpwnam} only looks up an existing user once
+        within C{positiveTTL} seconds
+        """
+        first = self.cache.getpwnam('alice')
+        self.clock.advance(9)
+        self.assertIdentical(first, self.cache.getpwnam('alice'))
+        self.assertEqual(['alice'], self.userdb.lookups)
+
+    def test_caches_nonexistent_user(self):
+        """
+        L{CachingUserDatabase.getpwnam} raises L{KeyError} for nonexistent
+        users, and only looks them up once within C{negativeTTL} seconds
+        """
+        self.assertRaises(KeyError, self.cache.getpwnam, 'bob')
+        self.clock.advance(4)
+        self.assertRaises(KeyError, self.cache.getpwnam, 'bob')
+        self.assertEqual(['bob'], self.userdb.lookups)
+
+    def test_entries_expire(self):
+        """
+        L{CachingUserDatabase.getpwnam} looks users up again once their
+        cache entries expire
+        """
+        self.cache.getpwnam('alice')
+        self.assertRaises(KeyError, self.cache.getpwnam, 'bob')
+        self.clock.advance(5)
+        self.assertRaises(KeyError, self.cache.getpwnam, 'bob')
+        self.cache.getpwnam('alice')
+        self.clock.advance(5)
+        self.cache.getpwnam('alice')
+        self.assertEqual(['alice', 'bob', 'bob', 'alice'],
+                         self.userdb.lookups)
+
+    def test_least_recently_used_evicted(self):
+        """
+        L{CachingUserDatabase} caches at most C{maxSize} users, evicting the
+        least recently used one first
+        """
+        self.cache.getpwnam('alice')
+        self.assertRaises(KeyError, self.cache.getpwnam, 'bob')
+        self.cache.getpwnam('alice')
+        self.assertRaises(KeyError, self.cache.getpwnam, 'carol')
+        self.cache.getpwnam('alice')
+        self.assertRaises(KeyError, self.cache.getpwnam, 'bob')
+        self.assertEqual(['alice', 'bob', 'carol', 'bob'],
+                         self.userdb.lookups)
+
+    def test_invalidate(self):
+        """
+        L{CachingUserDatabase.invalidate} discards the cached entry for one
+        user, or for all users if no username is given
+        """
+        self.cache.getpwnam('alice')
+        self.assertRaises(KeyError, self.cache.getpwnam, 'bob')
+        self.cache.invalidate('alice')
+        self.cache.getpwnam('alice')
+        self.assertRaises(KeyError, self.cache.getpwnam, 'bob')
+        self.cache.invalidate()
+        self.cache.getpwnam('alice')
+        self.assertRaises(KeyError, self.cache.getpwnam, 'bob')
+        self.assertEqual(['alice', 'bob', 'alice', 'alice', 'bob'],
+                         self.userdb.lookups)
+
+    def test_other_errors_not_cached(self):
+        """
+        Errors other than L{KeyError} are raised by
+        L{CachingUserDatabase.getpwnam} and not cached
+        """
+        self.cache.pwd = _BrokenUserDatabase()
+        self.assertRaises(_DummyException, self.cache.getpwnam, 'alice')
+        self.cache.pwd = self.userdb
+        self.cache.getpwnam('alice')
+        self.assertEqual(['alice'], self.userdb.lookups)
+
+    def test_shared(self):
+        """
+        Entries, and their expiry times, are shared through C{shared} with
+        other L{CachingUserDatabase}s, which then do not look them up
+        """
+        path = self.mktemp()
+        self.cache.shared = SharedMemoryCache(path, 16, 256)
+        self.addCleanup(self.cache.shared.close)
+        other = CachingUserDatabase(self.userdb, clock=self.clock,
+                                    shared=SharedMemoryCache(path, 16, 256))
+        self.addCleanup(other.shared.close)
+
+        first = self.cache.getpwnam('alice')
+        self.assertRaises(KeyError, self.cache.getpwnam, 'bob')
+        self.clock.advance(4)
+        passwd = other.getpwnam('alice')
+        self.assertEqual(
+            tuple(first[:7]),
+            (passwd.pw_name, passwd.pw_passwd, passwd.pw_uid, passwd.pw_gid,
+             passwd.pw_gecos, passwd.pw_dir, passwd.pw_shell))
+        self.assertRaises(KeyError, other.getpwnam, 'bob')
+        self.clock.advance(1)
+        self.assertRaises(KeyError, other.getpwnam, 'bob')
+        other.invalidate('alice')
+        self.cache.invalidate('alice')
+        self.cache.getpwnam('alice')
+        self.assertEqual(['alice', 'bob', 'bob', 'alice'],
+                         self.userdb.lookups)
+
+
 class UNIXAuthorizedKeysFilesTestCase(TestCase):
     """
     Tests for L{UNIXAuthorizedKeysFiles}
@@ -214,6 +584,18 @@ class UNIXAuthorizedKeysFilesTestCase(TestCase):
         self.assertEqual(['key 1', 'key 2', 'key 3'],
                          list(keydb.getAuthorizedKeys('alice')))
 
+    def test_unknown_user_cached(self):
+        """
+        L{UNIXAuthorizedKeysFiles.getAuthorizedKeys}, given a
+        L{CachingUserDatabase}, only looks up an unknown user once
+        """
+        userdb = _CountingUserDatabase()
+        keydb = UNIXAuthorizedKeysFiles(
+            CachingUserDatabase(userdb, clock=Clock()), parsekey=lambda x: x)
+        self.assertEqual([], list(keydb.getAuthorizedKeys('bob')))
+        self.assertEqual([], list(keydb.getAuthorizedKeys('bob')))
+        self.assertEqual(['bob'], userdb.lookups)
+
 
 _KeyDB = namedtuple('KeyDB', ['getAuthorizedKeys'])
 
@@ -222,6 +604,422 @@ class _DummyException(Exception):
     pass
 
 
+class _DeferredKeyDB(object):
+    """
+    Key DB whose lookups only complete when the test fires them
+    """
+    def __init__(self):
+        self.loads = []
+
+    def getAuthorizedKeys(self, username):
+        d = defer.Deferred()
+        self.loads.append((username, d))
+        return d
+
+
+class _FileKeyDB(object):
+    """
+    Key DB that counts loads, and reads keys from one file per user
+    """
+    def __init__(self, root, deferred=False):
+        self.root = root
+        self.deferred = deferred
+        self.loads = []
+
+    def getAuthorizedKeysFiles(self, username):
+        return [self.root.child(username)]
+
+    def getAuthorizedKeys(self, username):
+        self.loads.append(username)
+        keys = iter(['{0} key'.format(username)])
+        if self.deferred:
+            return defer.succeed(keys)
+        return keys
+
+
+class _FakeWatcher(object):
+    """
+    Watcher that records what is watched, and can only watch some files
+    """
+    def __init__(self, unwatchable=()):
+        self.unwatchable = unwatchable
+        self.watched = {}
+
+    def watch(self, filePath, callback):
+        if filePath.basename() in self.unwatchable:
+            return False
+        self.watched[filePath] = callback
+        return True
+
+    def unwatch(self, filePath, callback):
+        if self.watched.get(filePath) == callback:
+            del self.watched[filePath]
+
+    def change(self, filePath):
+        self.watched[filePath](filePath)
+
+
+class CachingAuthorizedKeysDBTestCase(TestCase):
+    """
+    Tests for L{CachingAuthorizedKeysDB}
+    """
+    def setUp(self):
+        self.root = FilePath(self.mktemp())
+        self.backend = _FileKeyDB(self.root)
+        self.clock = Clock()
+        self.watcher = _FakeWatcher(unwatchable=['bob'])
+        self.keydb = CachingAuthorizedKeysDB(self.backend, ttl=10,
+                                             maxSize=2, clock=self.clock,
+                                             watcher=self.watcher)
+
+    def test_implements_interface(self):
+        """
+        L{CachingAuthorizedKeysDB} implements L{IAuthorizedKeysDB}
+        """
+        verifyObject(IAuthorizedKeysDB, self.keydb)
+
+    def test_watched_keys_cached_until_changed(self):
+        """
+        Keys read from files that can be watched are cached until one of the
+        files changes
+        """
+        self.assertEqual(['alice key'],
+                         self.keydb.getAuthorizedKeys('alice'))
+        self.clock.advance(1000)
+        self.assertEqual(['alice key'],
+                         self.keydb.getAuthorizedKeys('alice'))
+        self.assertEqual(['alice'], self.backend.loads)
+        self.watcher.change(self.root.child('alice'))
+        self.keydb.getAuthorizedKeys('alice')
+        self.assertEqual(['alice', 'alice'], self.backend.loads)
+
+    def test_unwatched_keys_expire(self):
+        """
+        Keys read from files that cannot be watched are cached for C{ttl}
+        seconds
+        """
+        self.keydb.getAuthorizedKeys('bob')
+        self.clock.advance(9)
+        self.keydb.getAuthorizedKeys('bob')
+        self.clock.advance(1)
+        self.keydb.getAuthorizedKeys('bob')
+        self.assertEqual(['bob', 'bob'], self.backend.loads)
+
+    def test_no_watcher(self):
+        """
+        Without a watcher, cached keys expire after C{ttl} seconds
+        """
+        keydb = CachingAuthorizedKeysDB(self.backend, ttl=10,
+                                        clock=self.clock)
+        keydb.getAuthorizedKeys('alice')
+        self.clock.advance(10)
+        keydb.getAuthorizedKeys('alice')
+        self.assertEqual(['alice', 'alice'], self.backend.loads)
+
+    def test_least_recently_used_evicted(self):
+        """
+        Keys are cached for at most C{maxSize} users, evicting the least
+        recently used one first
+        """
+        for username in ('alice', 'bob', 'alice', 'carol', 'alice', 'bob'):
+            self.keydb.getAuthorizedKeys(username)
+        self.assertEqual(['alice', 'bob', 'carol', 'bob'], self.backend.loads)
+
+    def test_evicted_keys_unwatched(self):
+        """
+        The files of users whose keys are evicted or invalidated are no
+        longer watched
+        """
+        for username in ('alice', 'carol', 'dave'):
+            self.keydb.getAuthorizedKeys(username)
+        self.assertEqual([self.root.child('carol'), self.root.child('dave')],
+                         sorted(self.watcher.watched))
+        self.keydb.invalidate('carol')
+        self.assertEqual([self.root.child('dave')],
+                         self.watcher.watched.keys())
+        self.keydb.invalidate()
+        self.assertEqual({}, self.watcher.watched)
+
+    def test_invalidate(self):
+        """
+        L{CachingAuthorizedKeysDB.invalidate} discards the cached keys for
+        one user, or for all users if no username is given
+        """
+        self.keydb.getAuthorizedKeys('alice')
+        self.keydb.getAuthorizedKeys('bob')
+        self.keydb.invalidate('alice')
+        self.keydb.getAuthorizedKeys('alice')
+        self.keydb.getAuthorizedKeys('bob')
+        self.keydb.invalidate()
+        self.keydb.getAuthorizedKeys('alice')
+        self.keydb.getAuthorizedKeys('bob')
+        self.assertEqual(['alice', 'bob', 'alice', 'alice', 'bob'],
+                         self.backend.loads)
+
+    def test_deferred_keys_cached(self):
+        """
+        Keys from a provider that returns a L{defer.Deferred} are cached too
+        """
+        self.backend.deferred = True
+        d = self.keydb.getAuthorizedKeys('alice')
+        self.assertEqual(['alice key'], self.successResultOf(d))
+        self.assertEqual(['alice key'],
+                         self.keydb.getAuthorizedKeys('alice'))
+        self.assertEqual(['alice'], self.backend.loads)
+
+    def test_invalidated_while_loading(self):
+        """
+        Keys are not cached if the cache was invalidated while they were
+        being loaded
+        """
+        backend = _DeferredKeyDB()
+        keydb = CachingAuthorizedKeysDB(backend, clock=self.clock)
+        d = keydb.getAuthorizedKeys('alice')
+        keydb.invalidate('alice')
+        backend.loads[0][1].callback(['old key'])
+        self.assertEqual(['old key'], self.successResultOf(d))
+        keydb.getAuthorizedKeys('alice')
+        self.assertEqual(2, len(backend.loads))
+
+    def test_shared(self):
+        """
+        Keys are shared through C{shared} with other
+        L{CachingAuthorizedKeysDB}s, which then do not load them, until they
+        expire after C{ttl} seconds or are invalidated
+        """
+        path = self.mktemp()
+        backend = _DeferredKeyDB()
+        keydbs = [CachingAuthorizedKeysDB(
+            backend, ttl=10, clock=self.clock,
+            shared=SharedMemoryCache(path, 16, 2048)) for _ in range(3)]
+        for keydb in keydbs:
+            self.addCleanup(keydb.shared.close)
+        key = Key.fromString(publicRSA_openssh)
+
+        d = keydbs[0].getAuthorizedKeys('alice')
+        backend.loads[-1][1].callback([key])
+        self.successResultOf(d)
+        self.clock.advance(9)
+        self.assertEqual([key], keydbs[1].getAuthorizedKeys('alice'))
+        self.clock.advance(1)
+        keydbs[2].getAuthorizedKeys('alice')
+        self.assertEqual(2, len(backend.loads))
+
+        backend.loads[-1][1].callback([key])
+        keydbs[2].invalidate('alice')
+        keydbs[0].getAuthorizedKeys('alice')
+        self.assertEqual(3, len(backend.loads))
+
+        backend.loads[-1][1].callback([key])
+        keydbs[1].invalidate()
+        keydbs[2].getAuthorizedKeys('alice')
+        self.assertEqual(4, len(backend.loads))
+
+    def test_unix_authorized_keys_files_watched(self):
+        """
+        The authorized keys files of L{UNIXAuthorizedKeysFiles} are watched
+        """
+        userdb = UserDatabase()
+        userdb.addUser('alice', 'password', 1, 2, 'alice lastname',
+                       self.root.path, '/bin/shell')
+        keydb = CachingAuthorizedKeysDB(UNIXAuthorizedKeysFiles(userdb),
+                                        clock=self.clock,
+                                        watcher=self.watcher)
+        self.assertEqual([], keydb.getAuthorizedKeys('alice'))
+        sshDir = self.root.child('.ssh')
+        self.assertEqual(
+            sorted([sshDir.child('authorized_keys'),
+                    sshDir.child('authorized_keys2')]),
+            sorted(self.watcher.watched.keys()))
+
+
+class CoalescingAuthorizedKeysDBTestCase(TestCase):
+    """
+    Tests for L{CoalescingAuthorizedKeysDB}
+    """
+    def setUp(self):
+        self.backend = _DeferredKeyDB()
+        self.keydb = CoalescingAuthorizedKeysDB(self.backend)
+
+    def test_implements_interface(self):
+        """
+        L{CoalescingAuthorizedKeysDB} implements L{IAuthorizedKeysDB}
+        """
+        verifyObject(IAuthorizedKeysDB, self.keydb)
+
+    def test_concurrent_logins_share_one_load(self):
+        """
+        N concurrent calls to L{SSHPublicKeyChecker.requestAvatarId} for the
+        same user trigger a single load from the wrapped provider, and all
+        succeed once it completes
+        """
+        credentials = SSHPrivateKey(
+            'alice', 'ssh-rsa', publicRSA_openssh, 'foo',
+            Key.fromString(privateRSA_openssh).sign('foo'))
+        checker = SSHPublicKeyChecker(self.keydb)
+
+        results = [checker.requestAvatarId(credentials) for _ in range(10)]
+        self.assertEqual(1, len(self.backend.loads))
+        self.backend.loads[0][1].callback(
+            iter([Key.fromString(publicRSA_openssh)]))
+        self.assertEqual(['alice'] * 10,
+                         [self.successResultOf(d) for d in results])
+
+    def test_different_users_loaded_separately(self):
+        """
+        Concurrent lookups for different users are not coalesced
+        """
+        alice = self.keydb.getAuthorizedKeys('alice')
+        bob = self.keydb.getAuthorizedKeys('bob')
+        self.assertEqual(['alice', 'bob'],
+                         [username for username, _ in self.backend.loads])
+        self.backend.loads[0][1].callback(['alice key'])
+        self.backend.loads[1][1].callback(['bob key'])
+        self.assertEqual(['alice key'], self.successResultOf(alice))
+        self.assertEqual(['bob key'], self.successResultOf(bob))
+
+    def test_new_load_after_completion(self):
+        """
+        Once a load completes, the next lookup for that user loads again
+        """
+        first = self.keydb.getAuthorizedKeys('alice')
+        self.backend.loads[0][1].callback(['key 1'])
+        second = self.keydb.getAuthorizedKeys('alice')
+        self.backend.loads[1][1].callback(['key 2'])
+        self.assertEqual(['key 1'], self.successResultOf(first))
+        self.assertEqual(['key 2'], self.successResultOf(second))
+
+    def test_failure_shared(self):
+        """
+        If the shared load fails, every lookup waiting on it fails
+        """
+        lookups = [self.keydb.getAuthorizedKeys('alice') for _ in range(3)]
+        self.backend.loads[0][1].errback(_DummyException())
+        for d in lookups:
+            self.failureResultOf(d, _DummyException)
+
+    def test_runner_used_for_blocking_provider(self):
+        """
+        Keys from a provider that does not return a L{defer.Deferred} are
+        loaded into a list by calling C{runner}
+        """
+        calls = []
+
+        def runner(f, *args):
+            calls.append(args)
+            return defer.maybeDeferred(f, *args)
+
+        keydb = CoalescingAuthorizedKeysDB(
+            _KeyDB(lambda _: iter(['key 1', 'key 2'])), runner)
+        d = keydb.getAuthorizedKeys('alice')
+        self.assertEqual(['key 1', 'key 2'], self.successResultOf(d))
+        self.assertEqual([('alice',)], calls)
+
+
+_HELPER = """
+import os, sys, time
+
+while True:
+    username = sys.stdin.readline().strip()
+    if not username:
+        break
+    if username == 'hang':
+        time.sleep(60)
+    elif username == 'crash':
+        sys.exit(1)
+    elif username == 'pid':
+        sys.stdout.write('pid {0}\\n'.format(os.getpid()))
+    elif username == 'alice':
+        sys.stdout.write('# comment\\nkey 1\\n  key 2\\n')
+    sys.stdout.write('\\n')
+    sys.stdout.flush()
+"""
+
+
+class AuthorizedKeysCommandTestCase(TestCase):
+    """
+    Tests for L{AuthorizedKeysCommand}, using a stub helper script
+    """
+    def setUp(self):
+        script = FilePath(self.mktemp())
+        script.setContent(_HELPER)
+        self.keydb = AuthorizedKeysCommand(sys.executable, [script.path],
+                                           poolSize=2, timeout=2,
+                                           parsekey=lambda x: x)
+        self.addCleanup(self.keydb.stop)
+
+    def test_implements_interface(self):
+        """
+        L{AuthorizedKeysCommand} implements L{IAuthorizedKeysDB}
+        """
+        verifyObject(IAuthorizedKeysDB, self.keydb)
+
+    def test_keys_from_helper(self):
+        """
+        L{AuthorizedKeysCommand.getAuthorizedKeys} fires with the keys the
+        helper answers with, ignoring comments and whitespace, and with no
+        keys if the helper has none
+        """
+        d = defer.gatherResults([self.keydb.getAuthorizedKeys('alice'),
+                                 self.keydb.getAuthorizedKeys('bob')])
+        return d.addCallback(self.assertEqual, [['key 1', 'key 2'], []])
+
+    def test_helpers_reused(self):
+        """
+        Lookups are answered by at most C{poolSize} helper processes, which
+        are reused for later lookups
+        """
+        d = defer.gatherResults(
+            [self.keydb.getAuthorizedKeys('pid') for _ in range(6)])
+
+        def check(results):
+            pids = set(lines[0] for lines in results)
+            self.assertEqual(2, len(pids))
+            return self.keydb.getAuthorizedKeys('pid').addCallback(
+                lambda lines: self.assertIn(lines[0], pids))
+
+        return d.addCallback(check)
+
+    def test_timeout(self):
+        """
+        If a helper does not answer within C{timeout} seconds, the lookup
+        fails with L{AuthorizedKeysCommandError} and the helper is replaced
+        """
+        self.keydb.timeout = 0.5
+        d = self.assertFailure(self.keydb.getAuthorizedKeys('hang'),
+                               AuthorizedKeysCommandError)
+        d.addCallback(lambda _: self.keydb.getAuthorizedKeys('alice'))
+        return d.addCallback(self.assertEqual, ['key 1', 'key 2'])
+
+    def test_crash(self):
+        """
+        If a helper exits, its lookup fails with
+        L{AuthorizedKeysCommandError} and later lookups use a new helper
+        """
+        d = self.assertFailure(self.keydb.getAuthorizedKeys('crash'),
+                               AuthorizedKeysCommandError)
+        d.addCallback(lambda _: self.keydb.getAuthorizedKeys('alice'))
+        return d.addCallback(self.assertEqual, ['key 1', 'key 2'])
+
+    def test_newline_in_username(self):
+        """
+        Usernames with newlines have no keys, and are not sent to helpers
+        """
+        d = self.keydb.getAuthorizedKeys('alice\nalice')
+        self.assertEqual([], self.successResultOf(d))
+
+    def test_invalid_usernames(self):
+        """
+        Usernames that are empty, or have whitespace or control characters
+        in them, have no keys, and are not sent to helpers
+        """
+        for username in ['', 'alice ', 'al\tice', 'alice\r', 'al\x00ice',
+                         'alice\x1b', 'alice\x7f', '\x0balice']:
+            d = self.keydb.getAuthorizedKeys(username)
+            self.assertEqual([], self.successResultOf(d))
+        self.assertEqual([], self.keydb._processes)
+
+
 class SSHPublicKeyCheckerTestCase(TestCase):
     """
     Tests for L{SSHPublicKeyChecker}
@@ -306,3 +1104,286 @@ class SSHPublicKeyCheckerTestCase(TestCase):
         """
         d = self.checker.requestAvatarId(self.credentials)
         self.assertEqual('alice', self.successResultOf(d))
+
+    def test_key_lookup(self):
+        """
+        If the key DB provides L{IAuthorizedKeyLookup},
+        L{SSHPublicKeyChecker.requestAvatarId} asks it about the key in the
+        credentials rather than getting all the user's keys
+        """
+        def fail(_):
+            raise _DummyException()
+
+        keydb = SQLiteAuthorizedKeysDB(self.mktemp())
+        self.addCleanup(keydb.close)
+        keydb.addKey('alice', Key.fromString(publicRSA_openssh))
+        keydb.getAuthorizedKeys = fail
+        self.checker = SSHPublicKeyChecker(keydb)
+        d = self.checker.requestAvatarId(self.credentials)
+        self.assertEqual('alice', self.successResultOf(d))
+
+        self.credentials.blob = publicDSA_openssh
+        self.failureResultOf(self.checker.requestAvatarId(self.credentials),
+                             UnauthorizedLogin)
+
+    def test_probe_not_checked_by_default(self):
+        """
+        Calling L{SSHPublicKeyChecker.requestAvatarId} with credentials that
+        do not have a signature fails with L{ValidPublicKey} without looking
+        up the authorized keys, unless C{checkProbes} is set
+        """
+        def fail(_):
+            raise _DummyException()
+
+        self.checker = SSHPublicKeyChecker(_KeyDB(fail))
+        self.credentials.signature = None
+        self.failureResultOf(self.checker.requestAvatarId(self.credentials),
+                             ValidPublicKey)
+
+
+class SSHPublicKeyCheckerProbeTestCase(TestCase):
+    """
+    Tests for L{SSHPublicKeyChecker} with C{checkProbes} set
+    """
+    def setUp(self):
+        self.credentials = SSHPrivateKey(
+            'alice', 'ssh-rsa', publicRSA_openssh, None, None)
+        self.keydb = _KeyDB(lambda _: [Key.fromString(publicRSA_openssh)])
+        self.checker = SSHPublicKeyChecker(self.keydb, checkProbes=True)
+
+    def test_authorized_key_without_signature(self):
+        """
+        Calling L{SSHPublicKeyChecker.requestAvatarId} with credentials that
+        do not have a signature, but whose key is authorized, fails with
+        L{ValidPublicKey}
+        """
+        self.failureResultOf(self.checker.requestAvatarId(self.credentials),
+                             ValidPublicKey)
+
+    def test_unauthorized_key_without_signature(self):
+        """
+        Calling L{SSHPublicKeyChecker.requestAvatarId} with credentials that
+        do not have a signature, and whose key is not authorized, fails with
+        L{UnauthorizedLogin} so the client never signs with that key
+        """
+        self.credentials.blob = publicDSA_openssh
+        self.failureResultOf(self.checker.requestAvatarId(self.credentials),
+                             UnauthorizedLogin)
+
+    def test_bad_key_without_signature(self):
+        """
+        Calling L{SSHPublicKeyChecker.requestAvatarId} with credentials that
+        do not have a signature and have a bad key fails with L{BadKeyError}
+        """
+        self.credentials.blob = ''
+        self.failureResultOf(self.checker.requestAvatarId(self.credentials),
+                             BadKeyError)
+
+    def test_username_returned_on_success(self):
+        """
+        L{SSHPublicKeyChecker.requestAvatarId} still callbacks with the
+        username when given signed credentials
+        """
+        self.credentials.sigData = 'foo'
+        self.credentials.signature = (
+            Key.fromString(privateRSA_openssh).sign('foo'))
+        d = self.checker.requestAvatarId(self.credentials)
+        self.assertEqual('alice', self.successResultOf(d))
+
+
+def makeCertificate(key, ca, certType=1, principals=('alice',),
+                    validAfter=0, validBefore=2 ** 64 - 1,
+                    criticalOptions=None, serial=7):
+    """
+    Make an OpenSSH certificate
+
+    @param key: the public L{Key} to certify
+    @param ca: the private L{Key} of the certificate authority
+
+    @return: C{str} certificate blob
+    """
+    keyType = key.sshType()
+    body = (NS(keyType + '-cert-v01@openssh.com') + NS('nonce') +
+            key.blob()[len(NS(keyType)):] +
+            struct.pack('>QL', serial, certType) + NS('key id') +
+            NS(''.join(NS(p) for p in principals)) +
+            struct.pack('>QQ', validAfter, validBefore) +
+            NS(''.join(NS(name) + NS(NS(value)) for name, value in
+                       sorted((criticalOptions or {}).items()))) +
+            NS(NS('permit-pty') + NS('')) + NS('') +
+            NS(ca.public().blob()))
+    return body + NS(ca.sign(body))
+
+
+class ParseCertificateTestCase(TestCase):
+    """
+    Tests for L{parseCertificate}
+    """
+    def test_parses_certificate(self):
+        """
+        L{parseCertificate} returns the certified key and all the fields of
+        the certificate
+        """
+        ca = Key.fromString(privateDSA_openssh)
+        blob = makeCertificate(Key.fromString(publicRSA_openssh), ca,
+                               principals=['alice', 'bob'],
+                               validAfter=10, validBefore=20,
+                               criticalOptions={'force-command': 'ls'})
+        certificate = parseCertificate(blob)
+        self.assertEqual(Key.fromString(publicRSA_openssh), certificate.key)
+        self.assertEqual(
+            (7, 1, 'key id', ['alice', 'bob'], 10, 20,
+             {'force-command': 'ls'}, {'permit-pty': ''},
+             ca.public().blob()),
+            certificate[1:10])
+        self.assertTrue(ca.verify(certificate.signature, certificate.signed))
+
+    def test_unsupported_type(self):
+        """
+        L{parseCertificate} raises L{BadKeyError} if given a plain key
+        """
+        self.assertRaises(BadKeyError, parseCertificate,
+                          Key.fromString(publicRSA_openssh).blob())
+
+    def test_truncated(self):
+        """
+        L{parseCertificate} raises L{BadKeyError} if given a truncated
+        certificate
+        """
+        blob = makeCertificate(Key.fromString(publicRSA_openssh),
+                               Key.fromString(privateDSA_openssh))
+        self.assertRaises(BadKeyError, parseCertificate, blob[:-30])
+
+
+class SSHCertificateCheckerTestCase(TestCase):
+    """
+    Tests for L{SSHCertificateChecker}
+    """
+    def setUp(self):
+        self.ca = Key.fromString(privateDSA_openssh)
+        self.user = Key.fromString(privateRSA_openssh)
+        self.clock = Clock()
+        self.clock.advance(100)
+        self.checker = SSHCertificateChecker([self.ca.public()],
+                                             clock=self.clock)
+
+    def login(self, blob, signed=True, username='alice'):
+        credentials = SSHPrivateKey(
+            username, 'ssh-rsa-cert-v01@openssh.com', blob, 'foo',
+            self.user.sign('foo') if signed else None)
+        return self.checker.requestAvatarId(credentials)
+
+    def assertRejected(self, blob, **kwargs):
+        self.failureResultOf(self.login(blob, **kwargs), UnauthorizedLogin)
+
+    def test_username_returned_on_success(self):
+        """
+        L{SSHCertificateChecker.requestAvatarId} callbacks with the username
+        if given a valid certificate and signature
+        """
+        blob = makeCertificate(self.user.public(), self.ca)
+        self.assertEqual('alice', self.successResultOf(self.login(blob)))
+
+    def test_without_signature(self):
+        """
+        L{SSHCertificateChecker.requestAvatarId} fails with
+        L{ValidPublicKey} if given a valid certificate without a signature
+        """
+        blob = makeCertificate(self.user.public(), self.ca)
+        self.failureResultOf(self.login(blob, signed=False), ValidPublicKey)
+
+    def test_invalid_signature(self):
+        """
+        L{SSHCertificateChecker.requestAvatarId} fails with
+        L{UnauthorizedLogin} if the signature was not made by the certified
+        key
+        """
+        blob = makeCertificate(Key.fromString(publicDSA_openssh), self.ca)
+        self.assertRejected(blob)
+
+    def test_untrusted_ca(self):
+        """
+        Certificates signed by a CA that is not trusted are rejected, even
+        without a signature
+        """
+        blob = makeCertificate(self.user.public(), self.user)
+        self.assertRejected(blob, signed=False)
+
+    def test_forged_ca_signature(self):
+        """
+        Certificates whose CA signature does not match are rejected
+        """
+        blob = makeCertificate(self.user.public(), self.ca)
+        blob = blob.replace('key id', 'key ID')
+        self.assertRejected(blob)
+
+    def test_host_certificate(self):
+        """
+        Host certificates are rejected
+        """
+        blob = makeCertificate(self.user.public(), self.ca, certType=2)
+        self.assertRejected(blob)
+
+    def test_not_a_principal(self):
+        """
+        Certificates are rejected if the user is not one of their
+        principals, or if they have no principals
+        """
+        blob = makeCertificate(self.user.public(), self.ca,
+                               principals=['bob'])
+        self.assertRejected(blob)
+        blob = makeCertificate(self.user.public(), self.ca, principals=[])
+        self.assertRejected(blob)
+
+    def test_validity_period(self):
+        """
+        Certificates are only accepted from their valid after time, until
+        their valid before time
+        """
+        for after, before in ((101, 200), (0, 100)):
+            blob = makeCertificate(self.user.public(), self.ca,
+                                   validAfter=after, validBefore=before)
+            self.assertRejected(blob)
+        blob = makeCertificate(self.user.public(), self.ca,
+                               validAfter=100, validBefore=101)
+        self.assertEqual('alice', self.successResultOf(self.login(blob)))
+
+    def test_critical_options(self):
+        """
+        Certificates are rejected if they have critical options that are
+        not understood or not satisfied
+        """
+        blob = makeCertificate(self.user.public(), self.ca,
+                               criticalOptions={'source-address': 'nope'})
+        self.assertRejected(blob)
+
+        self.checker.criticalOptions = {
+            'source-address': lambda value, credentials: value == 'ok'}
+        self.assertRejected(blob)
+        blob = makeCertificate(self.user.public(), self.ca,
+                               criticalOptions={'source-address': 'ok'})
+        self.assertEqual('alice', self.successResultOf(self.login(blob)))
+
+    def test_bad_certificate(self):
+        """
+        L{SSHCertificateChecker.requestAvatarId} fails with L{BadKeyError}
+        if the certificate cannot be parsed
+        """
+        self.failureResultOf(self.login('garbage'), BadKeyError)
+
+    def test_plain_keys(self):
+        """
+        Keys that are not certificates are rejected, unless there is a
+        fallback checker, which is then used
+        """
+        credentials = SSHPrivateKey(
+            'alice', 'ssh-rsa', publicRSA_openssh, 'foo',
+            self.user.sign('foo'))
+        self.failureResultOf(self.checker.requestAvatarId(credentials),
+                             UnauthorizedLogin)
+
+        self.checker.fallback = SSHPublicKeyChecker(
+            _KeyDB(lambda _: [self.user.public()]))
+        self.assertEqual(
+            'alice',
+            self.successResultOf(self.checker.requestAvatarId(credentials)))
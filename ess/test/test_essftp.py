@@ -4,6 +4,7 @@ from twisted.conch.ssh import filetransfer
 from twisted.trial import unittest
 
 from ess import essftp, filepath
+from ess.metrics import metrics
 from ess.test.test_shelless import execCommand, TestSecured
 
 
@@ -356,6 +357,22 @@ class TestChrootedFile(TestChrooted, unittest.TestCase):
         self.assertEquals(f.read(), fp.path[:5] + "NEWDATA" + fp.path[12:])
         f.close()
 
+    def test_bytes_counted(self):
+        """
+        The bytes read and written are counted in the server's metrics
+        """
+        def transferred():
+            return [metrics.operations[name].bytes
+                    if name in metrics.operations else 0
+                    for name in ('file.readChunk', 'file.writeChunk')]
+        before = transferred()
+        sftpf = essftp.ChrootedFile(self.rootdir.child("fileRoot"),
+                                    self.read | self.write)
+        sftpf.readChunk(0, 3)
+        sftpf.writeChunk(0, "NEWDATA")
+        sftpf.close()
+        self.assertEquals([before[0] + 3, before[1] + 7], transferred())
+
 
 class TestEssFTP(TestSecured, unittest.TestCase):
     """
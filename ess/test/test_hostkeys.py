@@ -0,0 +1,134 @@
+"""
+Tests for L{ess.hostkeys}.
+"""
+import os
+
+from twisted.conch.openssh_compat import primes
+from twisted.conch.ssh.keys import Key
+from twisted.conch.test.keydata import privateRSA_openssh
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import TestCase
+
+from ess import hostkeys
+
+
+PRIME = 0xFFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD1
+MODULI = '20130101000000 2 6 100 1023 2 {0:X}\n'.format(PRIME)
+
+
+class GenerateHostKeysTestCase(TestCase):
+    """
+    Tests for L{hostkeys.generateHostKeys}
+    """
+    def setUp(self):
+        self.key = Key.fromString(privateRSA_openssh)
+        self.patch(hostkeys, '_GENERATORS',
+                   {'rsa': lambda: self.key.keyObject})
+        self.directory = FilePath(self.mktemp())
+        self.directory.makedirs()
+
+    def test_generate(self):
+        """
+        Missing keys are written in OpenSSH's format and naming, with the
+        private key only readable by its owner
+        """
+        private = self.directory.child('ssh_host_rsa_key')
+        self.assertEqual([private.path],
+                         hostkeys.generateHostKeys(self.directory.path))
+        self.assertEqual(self.key, Key.fromFile(private.path))
+        self.assertEqual(self.key.public(),
+                         Key.fromFile(private.path + '.pub'))
+        self.assertEqual(0600, os.stat(private.path).st_mode & 0777)
+        self.assertEqual(['ssh_host_rsa_key', 'ssh_host_rsa_key.pub'],
+                         sorted(self.directory.listdir()))
+
+    def test_existing(self):
+        """
+        Keys that are already there are left alone
+        """
+        private = self.directory.child('ssh_host_rsa_key')
+        private.setContent('existing')
+        public = self.directory.child('ssh_host_rsa_key.pub')
+        public.setContent('existing public')
+        self.assertEqual([], hostkeys.generateHostKeys(self.directory.path))
+        self.assertEqual('existing', private.getContent())
+        self.assertEqual('existing public', public.getContent())
+
+    def test_missing_public(self):
+        """
+        A public key missing next to its private key is written from it
+        """
+        private = self.directory.child('ssh_host_rsa_key')
+        private.setContent(privateRSA_openssh)
+        self.assertEqual([], hostkeys.generateHostKeys(self.directory.path))
+        self.assertEqual(privateRSA_openssh, private.getContent())
+        self.assertEqual(self.key.public(),
+                         Key.fromFile(private.path + '.pub'))
+
+    def test_missing_public_unreadable(self):
+        """
+        A private key that cannot be parsed is left alone, without a public
+        key
+        """
+        private = self.directory.child('ssh_host_rsa_key')
+        private.setContent('existing')
+        self.assertEqual([], hostkeys.generateHostKeys(self.directory.path))
+        self.assertEqual(['ssh_host_rsa_key'], self.directory.listdir())
+
+    def test_factory(self):
+        """
+        Keys generated are the ones an L{hostkeys.EssOpenSSHFactory} serves
+        """
+        hostkeys.generateHostKeys(self.directory.path)
+        factory = hostkeys.EssOpenSSHFactory()
+        factory.dataRoot = self.directory.path
+        factory.startFactory()
+        self.assertEqual({'ssh-rsa': self.key}, factory.privateKeys)
+        self.assertEqual({'ssh-rsa': self.key.public()}, factory.publicKeys)
+
+
+class LoadModuliTestCase(TestCase):
+    """
+    Tests for L{hostkeys.loadModuli}
+    """
+    def setUp(self):
+        self.moduli = FilePath(self.mktemp())
+        self.moduli.setContent(MODULI)
+        self.parsed = []
+        parseModuliFile = primes.parseModuliFile
+
+        def parse(path):
+            self.parsed.append(path)
+            return parseModuliFile(path)
+        self.patch(primes, 'parseModuliFile', parse)
+
+    def test_cached(self):
+        """
+        A moduli file is parsed once, and again only once it has changed
+        """
+        expected = {1024: [(2, PRIME)]}
+        self.assertEqual(expected, hostkeys.loadModuli(self.moduli.path))
+        self.assertEqual(expected, hostkeys.loadModuli(self.moduli.path))
+        self.assertEqual(1, len(self.parsed))
+
+        self.moduli.setContent(MODULI * 2)
+        self.assertEqual(2, len(hostkeys.loadModuli(self.moduli.path)[1024]))
+        self.assertEqual(2, len(self.parsed))
+
+    def test_missing(self):
+        """
+        A missing moduli file is no moduli
+        """
+        self.assertIdentical(None, hostkeys.loadModuli(self.mktemp()))
+
+    def test_factory(self):
+        """
+        L{hostkeys.EssOpenSSHFactory} reads moduli from the key directory,
+        unless told otherwise
+        """
+        factory = hostkeys.EssOpenSSHFactory()
+        factory.dataRoot = self.moduli.dirname()
+        self.moduli.moveTo(self.moduli.sibling('moduli'))
+        self.assertIn(1024, factory.getPrimes())
+        factory.moduliRoot = self.mktemp()
+        self.assertIdentical(None, factory.getPrimes())
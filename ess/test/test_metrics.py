@@ -0,0 +1,187 @@
+"""
+Tests for L{ess.metrics}.
+"""
+from twisted.conch.error import ValidPublicKey
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+from twisted.web.test.test_web import DummyRequest
+
+from ess.metrics import Histogram, Metrics, MetricsResource
+
+
+class _DummyException(Exception):
+    pass
+
+
+class _Timer(object):
+    """
+    Timer that only moves when told to
+    """
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class HistogramTestCase(TestCase):
+    """
+    Tests for L{Histogram}
+    """
+    def test_observe(self):
+        """
+        Values are counted in the first bucket whose upper bound they do not
+        exceed, or in the extra bucket
+        """
+        histogram = Histogram((1, 2))
+        for value in (0.5, 1, 1.5, 3):
+            histogram.observe(value)
+        self.assertEqual([2, 1, 1], list(histogram.counts))
+        self.assertEqual(6, histogram.sum)
+
+
+class MetricsTestCase(TestCase):
+    """
+    Tests for L{Metrics}
+    """
+    def setUp(self):
+        self.timer = _Timer()
+        self.metrics = Metrics(buckets=(1, 2), timer=self.timer)
+
+    def call(self, result=None, duration=1.5):
+        """
+        Timed function that takes C{duration} seconds, and returns (or
+        raises) C{result}
+        """
+        self.timer.now += duration
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def stats(self, operation='op'):
+        stats = self.metrics.operations[operation]
+        return (stats.calls, stats.errors, stats.bytes,
+                list(stats.latency.counts))
+
+    def test_timed(self):
+        """
+        Calls of a function decorated with L{Metrics.timed} are counted, with
+        how long they took
+        """
+        timed = self.metrics.timed('op')(self.call)
+        self.assertEqual('result', timed('result'))
+        timed(duration=0.5)
+        self.assertEqual((2, 0, 0, [1, 1, 0]), self.stats())
+
+    def test_timed_size(self):
+        """
+        The number of bytes transferred is counted, as given by the C{size}
+        callable
+        """
+        timed = self.metrics.timed(
+            'op', size=lambda *args, **kwargs: len(kwargs['result'])
+        )(self.call)
+        timed('four')
+        timed('three', duration=0.5)
+        self.assertEqual((2, 0, 9, [1, 1, 0]), self.stats())
+
+    def test_timed_error(self):
+        """
+        Calls that raise are counted as errors, except for
+        L{StopIteration}
+        """
+        timed = self.metrics.timed('op')(self.call)
+        self.assertRaises(_DummyException, timed, _DummyException())
+        self.assertRaises(StopIteration, timed, StopIteration())
+        self.assertEqual((2, 1, 0, [0, 2, 0]), self.stats())
+
+    def test_timed_deferred(self):
+        """
+        Calls that return a L{defer.Deferred} end when it fires, and are
+        counted as errors if it fails
+        """
+        timed = self.metrics.timed(
+            'op', size=lambda d, result: len(result))(lambda d: d)
+        succeeding = defer.Deferred()
+        self.assertIdentical(succeeding, timed(succeeding))
+        failing = defer.Deferred()
+        timed(failing)
+        self.timer.now = 3
+        succeeding.callback('four')
+        failing.errback(_DummyException())
+        self.failureResultOf(failing, _DummyException)
+        self.assertEqual((2, 1, 4, [0, 0, 2]), self.stats())
+
+    def test_timed_key_probe(self):
+        """
+        Public key probes, answered with L{ValidPublicKey} whether directly
+        or by a L{defer.Deferred}, are not counted as errors
+        """
+        timed = self.metrics.timed('op')(self.call)
+        self.assertRaises(ValidPublicKey, timed, ValidPublicKey())
+        timed(defer.fail(ValidPublicKey())).addErrback(
+            lambda failure: failure.trap(ValidPublicKey))
+        self.assertEqual((2, 0, 0, [0, 2, 0]), self.stats())
+
+    def test_current(self):
+        """
+        L{Metrics.current} is the innermost timed operation running, with its
+        arguments and when it started
+        """
+        seen = []
+        inner = self.metrics.timed('inner')(
+            lambda: seen.append(self.metrics.current))
+        outer = self.metrics.timed('outer')(
+            lambda arg: (inner(), seen.append(self.metrics.current)))
+        self.timer.now = 5
+        outer('arg')
+        self.assertEqual([('inner', (), 5), ('outer', ('arg',), 5)], seen)
+        self.assertIdentical(None, self.metrics.current)
+
+    def test_render(self):
+        """
+        L{Metrics.render} renders counters and histograms in the Prometheus
+        text format
+        """
+        self.metrics.record('op', 1.5, size=10)
+        self.metrics.record('op', 0.5, failed=True)
+        self.assertEqual(
+            '# HELP ess_operations_total Number of operations performed\n'
+            '# TYPE ess_operations_total counter\n'
+            'ess_operations_total{operation="op"} 2\n'
+            '# HELP ess_operation_errors_total Number of operations that '
+            'failed\n'
+            '# TYPE ess_operation_errors_total counter\n'
+            'ess_operation_errors_total{operation="op"} 1\n'
+            '# HELP ess_operation_bytes_total Number of bytes transferred by '
+            'operations\n'
+            '# TYPE ess_operation_bytes_total counter\n'
+            'ess_operation_bytes_total{operation="op"} 10\n'
+            '# HELP ess_operation_duration_seconds How long operations took\n'
+            '# TYPE ess_operation_duration_seconds histogram\n'
+            'ess_operation_duration_seconds_bucket{operation="op",le="1.0"} '
+            '1\n'
+            'ess_operation_duration_seconds_bucket{operation="op",le="2.0"} '
+            '2\n'
+            'ess_operation_duration_seconds_bucket{operation="op",le="+Inf"} '
+            '2\n'
+            'ess_operation_duration_seconds_sum{operation="op"} 2.0\n'
+            'ess_operation_duration_seconds_count{operation="op"} 2\n',
+            self.metrics.render())
+
+
+class MetricsResourceTestCase(TestCase):
+    """
+    Tests for L{MetricsResource}
+    """
+    def test_render(self):
+        """
+        L{MetricsResource} renders its metrics as Prometheus text
+        """
+        metrics = Metrics()
+        metrics.record('op', 1)
+        request = DummyRequest([''])
+        body = MetricsResource(metrics).render_GET(request)
+        self.assertEqual(metrics.render(), body)
+        self.assertEqual(['text/plain; version=0.0.4'],
+                         request.outgoingHeaders.values())
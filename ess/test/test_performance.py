@@ -0,0 +1,265 @@
+"""
+Performance regression tests: budgets on the system calls, allocations and
+(roughly) the time that hot paths of L{ess.essftp} and L{ess.checkers}
+take.
+
+System calls are counted by patching the functions in L{os} (and the
+builtin C{open}) that they go through, and only calls on paths inside the
+served tree are counted, so the counts do not depend on the machine or on
+where the tests are run.  Allocations are counted as objects left behind
+for the garbage collector.  Wall-clock budgets compare a hot path with the
+bare system calls it needs, measured in the same process, and are generous.
+
+These tests are opt-in: set C{ESS_PERFORMANCE_TESTS=1} to run them.
+"""
+import __builtin__
+import gc
+import os
+import time
+from collections import Counter
+
+from twisted.conch.ssh import filetransfer
+from twisted.conch.test.keydata import publicRSA_openssh, privateRSA_openssh
+from twisted.cred.credentials import SSHPrivateKey
+from twisted.python import filepath as twistedFilepath
+from twisted.python.fakepwd import UserDatabase
+from twisted.trial.unittest import TestCase
+
+from ess import essftp
+from ess.checkers import (Key, UNIXAuthorizedKeysFiles,
+                          CachingAuthorizedKeysDB, SSHPublicKeyChecker)
+from ess.filepath import FilePath
+
+
+_ENABLED = os.environ.get('ESS_PERFORMANCE_TESTS')
+
+
+class SyscallCounter(object):
+    """
+    Patches the file system functions in L{os}, and the builtin C{open},
+    for the duration of a test, to count calls on paths under a directory
+
+    @ivar counts: L{Counter} of calls by function name
+    """
+    functions = ('stat', 'lstat', 'open', 'listdir', 'readlink')
+
+    def __init__(self, testCase, root):
+        self.root = root
+        self.counts = Counter()
+        for name in self.functions:
+            wrapper = self._wrap(name, getattr(os, name))
+            testCase.patch(os, name, wrapper)
+            # twisted.python.filepath imported some of them by name
+            if hasattr(twistedFilepath, name):
+                testCase.patch(twistedFilepath, name, wrapper)
+        testCase.patch(__builtin__, 'open',
+                       self._wrap('open', __builtin__.open))
+
+    def _wrap(self, name, function):
+        def wrapper(path, *args, **kwargs):
+            if isinstance(path, str) and path.startswith(self.root):
+                self.counts[name] += 1
+            return function(path, *args, **kwargs)
+        return wrapper
+
+    def reset(self):
+        self.counts.clear()
+
+
+def leftBehind(function, repeat=100):
+    """
+    @return: the number of objects tracked by the garbage collector that
+        calling C{function} C{repeat} more times leaves behind, after a
+        call to warm up
+    """
+    function()
+    gc.collect()
+    before = len(gc.get_objects())
+    for _ in xrange(repeat):
+        function()
+    gc.collect()
+    return len(gc.get_objects()) - before
+
+
+def fastest(function, repeat=5):
+    """
+    @return: the fewest seconds C{function} took in C{repeat} calls
+    """
+    times = []
+    for _ in xrange(repeat):
+        started = time.time()
+        function()
+        times.append(time.time() - started)
+    return min(times)
+
+
+class PerformanceTestCase(TestCase):
+    """
+    Base class for the opt-in performance tests
+    """
+    if not _ENABLED:
+        skip = "Set ESS_PERFORMANCE_TESTS=1 to run the performance tests"
+
+    def assertWithinBudget(self, budget, counts):
+        """
+        Assert that every count is within its budget, and that there are no
+        calls that have no budget
+        """
+        over = dict((name, count) for name, count in counts.items()
+                    if count > budget.get(name, 0))
+        self.assertEqual({}, over, 'Over the budget of {0!r}: {1!r}'
+                         .format(budget, dict(counts)))
+
+
+class _Avatar(object):
+    def __init__(self, root):
+        self.root = root
+
+
+class EssFTPServerBudgetTestCase(PerformanceTestCase):
+    """
+    Budgets for L{essftp.EssFTPServer} operations, on a tree like the one
+    in L{ess.test.test_essftp.TestChrooted}
+    """
+    # system calls to get the attributes of a file, and of a link
+    getAttrsBudget = {'stat': 2, 'lstat': 3}
+    getAttrsLinkBudget = {'stat': 2, 'lstat': 6, 'readlink': 1}
+    # system calls to open and close a file
+    openFileBudget = {'open': 1}
+    # system calls to list the directory in the fixture (130 entries)
+    listingBudget = {'listdir': 1, 'stat': 251, 'lstat': 860,
+                     'readlink': 40}
+    # objects left behind by 100 operations
+    leftBehindBudget = 10
+    # how many times slower than the bare system calls listing may be
+    listingSlowdownBudget = 100
+
+    entries = 100
+
+    def setUp(self):
+        self.tempdir = FilePath(self.mktemp())
+        self.rootdir = self.tempdir.child('root')
+        self.listing = self.rootdir.child('listing')
+        self.listing.makedirs()
+        altdir = self.tempdir.child('alt')
+        altdir.makedirs()
+        self.rootdir.child('file').setContent('file')
+        self.rootdir.child('file').linkTo(self.rootdir.child('link'))
+        altdir.child('file').setContent('alt')
+        for i in range(self.entries):
+            self.listing.child('file{0}'.format(i)).setContent('file')
+        for i in range(self.entries // 10):
+            self.listing.child('dir{0}'.format(i)).makedirs()
+            self.rootdir.child('file').linkTo(
+                self.listing.child('link{0}'.format(i)))
+            altdir.child('file').linkTo(
+                self.listing.child('alt{0}'.format(i)))
+
+        self.server = essftp.EssFTPServer(_Avatar(self.rootdir.path))
+        self.syscalls = SyscallCounter(self, self.tempdir.path)
+
+    def listAll(self):
+        directory = self.server.openDirectory('/listing')
+        for entry in directory:
+            pass
+        directory.close()
+
+    def test_getAttrs(self):
+        """
+        Getting the attributes of a file or a link takes a few system calls
+        """
+        self.server.getAttrs('/file')
+        self.assertWithinBudget(self.getAttrsBudget, self.syscalls.counts)
+        self.syscalls.reset()
+        self.server.getAttrs('/link')
+        self.assertWithinBudget(self.getAttrsLinkBudget,
+                                self.syscalls.counts)
+
+    def test_openFile(self):
+        """
+        Opening a file opens it once
+        """
+        self.server.openFile('/file', filetransfer.FXF_READ, {}).close()
+        self.assertWithinBudget(self.openFileBudget, self.syscalls.counts)
+
+    def test_listing(self):
+        """
+        Listing a directory lists it once, and takes a few system calls per
+        entry
+        """
+        self.listAll()
+        self.assertWithinBudget(self.listingBudget, self.syscalls.counts)
+
+    def test_left_behind(self):
+        """
+        Getting attributes and listing directories do not leave objects
+        behind
+        """
+        self.assertTrue(leftBehind(lambda: self.server.getAttrs('/link')) <=
+                        self.leftBehindBudget)
+        self.assertTrue(leftBehind(self.listAll, 10) <=
+                        self.leftBehindBudget)
+
+    def test_listing_time(self):
+        """
+        Listing a directory takes a bounded multiple of the time that the
+        system calls it needs take
+        """
+        path = self.listing.path
+
+        def bare():
+            for name in os.listdir(path):
+                child = os.path.join(path, name)
+                os.lstat(child)
+                os.stat(child)
+
+        slowdown = fastest(self.listAll) / fastest(bare)
+        self.assertTrue(slowdown <= self.listingSlowdownBudget,
+                        'Listing is {0:.0f} times slower than the bare '
+                        'system calls'.format(slowdown))
+
+
+class LoginBudgetTestCase(PerformanceTestCase):
+    """
+    Budgets for logging in with a public key, with keys in users'
+    C{~/.ssh/authorized_keys} files
+    """
+    # system calls per login
+    loginBudget = {'open': 1, 'stat': 1}
+    # system calls per login once the keys are cached
+    cachedLoginBudget = {}
+
+    def setUp(self):
+        self.home = FilePath(self.mktemp())
+        self.home.child('.ssh').makedirs()
+        self.home.child('.ssh').child('authorized_keys').setContent(
+            publicRSA_openssh)
+        userdb = UserDatabase()
+        userdb.addUser('alice', 'password', 1, 2, 'alice', self.home.path,
+                       '/bin/sh')
+        self.keydb = UNIXAuthorizedKeysFiles(userdb, runas=None)
+        self.credentials = SSHPrivateKey(
+            'alice', 'ssh-rsa', publicRSA_openssh, 'foo',
+            Key.fromString(privateRSA_openssh).sign('foo'))
+        self.syscalls = SyscallCounter(self, self.home.path)
+
+    def login(self, checker):
+        self.assertEqual('alice', self.successResultOf(
+            checker.requestAvatarId(self.credentials)))
+
+    def test_login(self):
+        """
+        Logging in reads the user's authorized keys files once
+        """
+        self.login(SSHPublicKeyChecker(self.keydb))
+        self.assertWithinBudget(self.loginBudget, self.syscalls.counts)
+
+    def test_cached_login(self):
+        """
+        Logging in again with cached keys makes no system calls
+        """
+        checker = SSHPublicKeyChecker(CachingAuthorizedKeysDB(self.keydb))
+        self.login(checker)
+        self.syscalls.reset()
+        self.login(checker)
+        self.assertEqual(self.cachedLoginBudget, dict(self.syscalls.counts))
@@ -0,0 +1,223 @@
+"""
+Tests for L{ess.prefork}.
+"""
+import os
+import socket
+
+from twisted.internet import defer, error, protocol, reactor
+from twisted.internet.task import Clock, deferLater
+from twisted.python.failure import Failure
+from twisted.protocols.basic import LineReceiver
+from twisted.trial.unittest import SkipTest, TestCase
+
+from ess.prefork import WorkerSupervisor
+
+
+class _PidServer(protocol.Protocol):
+    """
+    Answers every connection with the pid of the worker, and exits the
+    worker if asked to
+    """
+    def connectionMade(self):
+        self.transport.write('{0}\r\n'.format(os.getpid()))
+
+    def dataReceived(self, data):
+        if data.startswith('exit'):
+            os._exit(1)
+
+
+def makePidFactory(args):
+    """
+    Worker factory for these tests
+    """
+    return protocol.Factory.forProtocol(_PidServer)
+
+
+class _PidClient(LineReceiver):
+    def __init__(self):
+        self.pid = defer.Deferred()
+
+    def lineReceived(self, line):
+        self.pid.callback(int(line))
+
+
+@defer.inlineCallbacks
+def getPid(port, exit=False, host='127.0.0.1'):
+    """
+    Connect to the workers and get the pid of the worker that answered,
+    telling it to exit if C{exit} is set
+    """
+    client = yield protocol.ClientCreator(
+        reactor, _PidClient).connectTCP(host, port)
+    pid = yield client.pid
+    if exit:
+        client.transport.write('exit\r\n')
+    client.transport.loseConnection()
+    defer.returnValue(pid)
+
+
+class WorkerSupervisorTestCase(TestCase):
+    """
+    Tests for L{WorkerSupervisor}, with real worker processes
+    """
+    timeout = 30
+
+    def setUp(self):
+        self.supervisor = WorkerSupervisor(
+            0, 2, 'ess.test.test_prefork.makePidFactory',
+            interface='127.0.0.1', restartDelay=0.1)
+        self.supervisor.startService()
+        self.addCleanup(self.supervisor.stopService)
+
+    @defer.inlineCallbacks
+    def getPids(self, count):
+        pids = set()
+        for _ in range(count):
+            pid = yield getPid(self.supervisor.getPort())
+            pids.add(pid)
+        defer.returnValue(pids)
+
+    @defer.inlineCallbacks
+    def test_workers_serve_port(self):
+        """
+        Connections to the port are served by worker processes, not by the
+        supervisor
+        """
+        pids = yield self.getPids(10)
+        self.assertNotIn(os.getpid(), pids)
+        self.assertTrue(1 <= len(pids) <= 2)
+        self.assertEqual(2, len(self.supervisor._workers))
+
+    @defer.inlineCallbacks
+    def test_crashed_worker_restarted(self):
+        """
+        A worker that exits is replaced by a new one
+        """
+        crashed = yield getPid(self.supervisor.getPort(), exit=True)
+        while crashed in [w.transport.pid
+                          for w in self.supervisor._workers.values()]:
+            yield deferLater(reactor, 0.05, lambda: None)
+        while len(self.supervisor._workers) < 2:
+            yield deferLater(reactor, 0.05, lambda: None)
+        pids = yield self.getPids(10)
+        self.assertNotIn(crashed, pids)
+
+
+class _StubbornProcess(object):
+    """
+    Transport of a worker process that ignores C{SIGTERM}
+    """
+    def __init__(self, proto):
+        self.proto = proto
+        self.signals = []
+
+    def signalProcess(self, signal):
+        self.signals.append(signal)
+        if signal == 'KILL':
+            self.proto.processEnded(
+                Failure(error.ProcessTerminated(signal=9)))
+
+
+class _ProcessClock(Clock):
+    """
+    Clock that starts L{_StubbornProcess}es
+    """
+    def __init__(self):
+        Clock.__init__(self)
+        self.processes = []
+
+    def spawnProcess(self, proto, *args, **kwargs):
+        proto.transport = _StubbornProcess(proto)
+        self.processes.append(proto.transport)
+
+
+class StoppingTestCase(TestCase):
+    """
+    Tests for how L{WorkerSupervisor} stops its workers
+    """
+    def setUp(self):
+        self.clock = _ProcessClock()
+        self.supervisor = WorkerSupervisor(
+            0, 2, 'ess.test.test_prefork.makePidFactory',
+            interface='127.0.0.1', killTimeout=5, reactor=self.clock)
+        self.supervisor.startService()
+
+    def test_killed(self):
+        """
+        Workers that have not exited C{killTimeout} seconds after being
+        stopped are killed
+        """
+        d = self.supervisor.stopService()
+        self.assertEqual([['TERM'], ['TERM']],
+                         [p.signals for p in self.clock.processes])
+        self.clock.advance(4)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.assertEqual([['TERM', 'KILL'], ['TERM', 'KILL']],
+                         [p.signals for p in self.clock.processes])
+        self.successResultOf(d)
+        self.assertEqual({}, self.supervisor._workers)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_exited(self):
+        """
+        Workers that exit when stopped are not killed
+        """
+        d = self.supervisor.stopService()
+        for process in self.clock.processes:
+            process.proto.processEnded(
+                Failure(error.ProcessTerminated(signal=15)))
+        self.successResultOf(d)
+        self.assertEqual([], self.clock.getDelayedCalls())
+        self.assertEqual([['TERM'], ['TERM']],
+                         [p.signals for p in self.clock.processes])
+
+
+def _supportsIPv6():
+    try:
+        socket.socket(socket.AF_INET6, socket.SOCK_STREAM).bind(('::1', 0))
+    except socket.error:
+        return False
+    return True
+
+
+class ListeningTestCase(TestCase):
+    """
+    Tests for how L{WorkerSupervisor} listens
+    """
+    timeout = 30
+
+    def makeSupervisor(self, interface):
+        supervisor = WorkerSupervisor(
+            0, 1, 'ess.test.test_prefork.makePidFactory',
+            interface=interface, restartDelay=0.1)
+        self.addCleanup(lambda: supervisor.running and
+                        supervisor.stopService())
+        return supervisor
+
+    def test_privileged_start(self):
+        """
+        The port is bound by L{WorkerSupervisor.privilegedStartService},
+        before any worker is started, and kept by
+        L{WorkerSupervisor.startService}
+        """
+        supervisor = self.makeSupervisor('127.0.0.1')
+        supervisor.privilegedStartService()
+        port = supervisor.getPort()
+        self.assertEqual({}, supervisor._workers)
+        supervisor.startService()
+        self.assertEqual(port, supervisor.getPort())
+        self.assertEqual(1, len(supervisor._workers))
+        return getPid(port)
+
+    def test_ipv6(self):
+        """
+        Workers serve IPv6 interfaces
+        """
+        if not _supportsIPv6():
+            raise SkipTest("IPv6 is not supported on this host")
+        supervisor = self.makeSupervisor('::1')
+        supervisor.startService()
+        self.assertEqual(socket.AF_INET6, supervisor._socket.family)
+        d = getPid(supervisor.getPort(), host='::1')
+        return d.addCallback(self.assertNotEqual, os.getpid())
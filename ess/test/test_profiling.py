@@ -0,0 +1,158 @@
+"""
+Tests for L{ess.profiling}.
+"""
+import pstats
+import struct
+
+from twisted.conch.ssh import filetransfer
+from twisted.python.failure import Failure
+from twisted.internet.error import ConnectionDone
+from twisted.python.filepath import FilePath
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from ess import essftp
+from ess.profiling import (SessionProfiler, ProfilingFileTransferServer,
+                           AdminFactory)
+
+
+class SessionProfilerTestCase(TestCase):
+    """
+    Tests for L{SessionProfiler}
+    """
+    def setUp(self):
+        self.directory = FilePath(self.mktemp())
+        self.directory.makedirs()
+        self.profiler = SessionProfiler(self.directory.path,
+                                        timer=lambda: 1234.5)
+
+    def test_enable_disable(self):
+        """
+        Sessions are profiled for the users profiling is enabled for, or for
+        everyone
+        """
+        self.profiler.enable('alice')
+        self.assertEqual((True, False), (self.profiler.isProfiled('alice'),
+                                         self.profiler.isProfiled('bob')))
+        self.profiler.enable()
+        self.profiler.disable('alice')
+        self.assertTrue(self.profiler.isProfiled('bob'))
+        self.profiler.enable('alice')
+        self.profiler.disable()
+        self.assertEqual((False, False), (self.profiler.isProfiled('alice'),
+                                          self.profiler.isProfiled('bob')))
+
+    def test_write(self):
+        """
+        Profiles are written to files named by avatar ID (made safe), time,
+        pid and a counter
+        """
+        class _Profile(object):
+            def dump_stats(self, path):
+                FilePath(path).setContent('profile')
+        path = self.profiler.write('../alice', _Profile())
+        self.assertEqual(self.directory.path,
+                         FilePath(path).parent().path)
+        self.assertTrue(FilePath(path).basename().startswith(
+            '.._alice-1234-'))
+        self.assertTrue(path.endswith('-1.prof'))
+
+
+class ProfilingFileTransferServerTestCase(TestCase):
+    """
+    Tests for L{ProfilingFileTransferServer}
+    """
+    def setUp(self):
+        self.directory = FilePath(self.mktemp())
+        self.directory.makedirs()
+        self.profiler = SessionProfiler(self.directory.path)
+        realm = essftp.EssFTPRealm(self.directory.path, self.profiler)
+        self.avatar = realm.requestAvatar('alice', None, None)[1]
+        self.server = self.avatar.lookupSubsystem('sftp', '')
+        self.server.makeConnection(StringTransport())
+
+    def request(self):
+        """
+        Send an INIT request to the server
+        """
+        payload = chr(filetransfer.FXP_INIT) + struct.pack('!L', 3)
+        self.server.dataReceived(struct.pack('!L', len(payload)) + payload)
+
+    def test_subsystem(self):
+        """
+        Users of a realm with a profiler get a
+        L{ProfilingFileTransferServer}, with their avatar ID
+        """
+        self.assertIsInstance(self.server, ProfilingFileTransferServer)
+        self.assertEqual('alice', self.avatar.avatarId)
+        avatar = essftp.EssFTPRealm('/').requestAvatar('alice', None,
+                                                       None)[1]
+        self.assertIdentical(filetransfer.FileTransferServer,
+                             avatar.subsystemLookup['sftp'])
+
+    def test_not_profiled(self):
+        """
+        Sessions of users not being profiled are not profiled
+        """
+        self.profiler.enable('bob')
+        self.request()
+        self.server.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual([], self.directory.children())
+
+    def test_profiled(self):
+        """
+        Requests handled while the user is profiled are profiled, and the
+        profile is written when the session ends
+        """
+        self.request()
+        self.profiler.enable('alice')
+        self.request()
+        self.profiler.disable('alice')
+        self.request()
+        self.server.connectionLost(Failure(ConnectionDone()))
+        [path] = self.directory.children()
+        stats = pstats.Stats(path.path).stats
+        [calls] = [value[0] for key, value in stats.items()
+                   if key[2] == 'packet_INIT']
+        self.assertEqual(1, calls)
+
+
+class AdminProtocolTestCase(TestCase):
+    """
+    Tests for L{ess.profiling.AdminProtocol}
+    """
+    def setUp(self):
+        self.profiler = SessionProfiler('/')
+        self.protocol = AdminFactory(self.profiler).buildProtocol(None)
+        self.transport = StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def command(self, line):
+        self.transport.clear()
+        self.protocol.dataReceived(line + '\n')
+        return self.transport.value()
+
+    def test_profile(self):
+        """
+        The C{profile} and C{unprofile} commands switch profiling on and off,
+        for a user or everyone, and C{status} says who is profiled
+        """
+        self.assertEqual('ok\n', self.command('profile alice'))
+        self.assertEqual('ok\n', self.command('profile bob'))
+        self.assertEqual('ok\n', self.command('profile *'))
+        self.assertEqual('ok * alice bob\n', self.command('status'))
+        self.assertEqual('ok\n', self.command('unprofile alice'))
+        self.assertEqual('ok * bob\n', self.command('status'))
+        self.assertEqual('ok\n', self.command('unprofile *'))
+        self.assertEqual('ok\n', self.command('status'))
+
+    def test_errors(self):
+        """
+        Unknown commands and missing arguments are errors
+        """
+        self.assertEqual("error unknown command 'foo'\n",
+                         self.command('foo bar'))
+        self.assertEqual('error missing avatar ID\n',
+                         self.command('profile'))
+        self.assertEqual('error missing avatar ID\n',
+                         self.command('unprofile'))
@@ -0,0 +1,204 @@
+"""
+Tests for L{ess.shaping}.
+"""
+from cStringIO import StringIO
+
+from twisted.conch.ssh import filetransfer
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import TestCase
+
+from ess import essftp
+from ess.shaping import (BandwidthScheduler, BandwidthLimit,
+                         readBandwidthLimits)
+
+
+class BandwidthSchedulerTestCase(TestCase):
+    """
+    Tests for L{BandwidthScheduler}
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.done = []
+
+    def submit(self, flow, size, name):
+        return flow.submit(size, self.done.append, name)
+
+    def test_no_limits(self):
+        """
+        Without limits, requests go as soon as they are submitted
+        """
+        scheduler = BandwidthScheduler(clock=self.clock)
+        flow = scheduler.flow('alice')
+        d = flow.submit(1000000, lambda: 'result')
+        self.assertEqual('result', self.successResultOf(d))
+
+    def test_flow_rate(self):
+        """
+        Requests of a flow wait until its rate allows them, in order
+        """
+        scheduler = BandwidthScheduler(clock=self.clock)
+        flow = scheduler.flow('alice', BandwidthLimit(10, None, 1))
+        for name in 'abc':
+            self.submit(flow, 10, name)
+        self.assertEqual(['a'], self.done)
+        self.clock.advance(0.5)
+        self.assertEqual(['a'], self.done)
+        self.clock.advance(0.5)
+        self.assertEqual(['a', 'b'], self.done)
+        self.clock.advance(1)
+        self.assertEqual(['a', 'b', 'c'], self.done)
+
+    def test_flows_independent(self):
+        """
+        The limit of one flow does not hold back another
+        """
+        scheduler = BandwidthScheduler(clock=self.clock)
+        slow = scheduler.flow('alice', BandwidthLimit(10, None, 1))
+        fast = scheduler.flow('bob')
+        self.submit(slow, 10, 'a1')
+        self.submit(slow, 10, 'a2')
+        self.submit(fast, 1000, 'b1')
+        self.assertEqual(['a1', 'b1'], self.done)
+
+    def test_global_rate(self):
+        """
+        All flows together are limited by the scheduler's rate
+        """
+        scheduler = BandwidthScheduler(10, clock=self.clock)
+        self.submit(scheduler.flow('alice'), 10, 'a')
+        self.submit(scheduler.flow('bob'), 10, 'b')
+        self.assertEqual(['a'], self.done)
+        self.clock.advance(1)
+        self.assertEqual(['a', 'b'], self.done)
+
+    def test_larger_than_burst(self):
+        """
+        A request larger than the burst waits for a full bucket, and the
+        debt it leaves is repaid before anything else goes
+        """
+        scheduler = BandwidthScheduler(10, clock=self.clock)
+        flow = scheduler.flow('alice')
+        self.submit(flow, 5, 'a')
+        self.submit(flow, 25, 'b')
+        self.submit(flow, 5, 'c')
+        self.assertEqual(['a'], self.done)
+        self.clock.advance(0.5)
+        self.assertEqual(['a', 'b'], self.done)
+        self.clock.advance(1.5)
+        self.assertEqual(['a', 'b'], self.done)
+        self.clock.advance(0.5)
+        self.assertEqual(['a', 'b', 'c'], self.done)
+
+    def test_weighted_fairness(self):
+        """
+        When there is not enough bandwidth, flows get it in proportion to
+        their weights
+        """
+        scheduler = BandwidthScheduler(10, clock=self.clock)
+        light = scheduler.flow('alice')
+        heavy = scheduler.flow('bob', BandwidthLimit(None, None, 3))
+        for i in range(6):
+            self.submit(light, 10, 'a')
+            self.submit(heavy, 10, 'b')
+        for _ in range(5):
+            self.clock.advance(1)
+        self.assertEqual(['a', 'b', 'b', 'b', 'b', 'b'], self.done)
+
+    def test_failure(self):
+        """
+        If a request fails, its L{Deferred} fails, and the others go on
+        """
+        scheduler = BandwidthScheduler(clock=self.clock)
+        flow = scheduler.flow('alice')
+        d = flow.submit(10, lambda: 1 // 0)
+        self.failureResultOf(d, ZeroDivisionError)
+        self.assertEqual(2, self.successResultOf(flow.submit(10, lambda: 2)))
+
+    def test_flows_shared(self):
+        """
+        Flows are shared by key, and forgotten when unused
+        """
+        scheduler = BandwidthScheduler(clock=self.clock)
+        flow = scheduler.flow('alice', BandwidthLimit(10, None, 2))
+        self.assertIdentical(flow, scheduler.flow('alice'))
+        self.assertEqual(2, flow.weight)
+        del flow
+        self.assertEqual(1, scheduler.flow('alice').weight)
+
+
+class ShapedFileTestCase(TestCase):
+    """
+    Tests for the bandwidth shaping of L{essftp.ChrootedFile}
+    """
+    def setUp(self):
+        self.root = FilePath(self.mktemp())
+        self.root.makedirs()
+        self.clock = Clock()
+        scheduler = BandwidthScheduler(clock=self.clock)
+        realm = essftp.EssFTPRealm(
+            self.root.path, bandwidth=scheduler,
+            bandwidthLimits={'alice': BandwidthLimit(10, None, 1),
+                             None: BandwidthLimit(100, None, 1)})
+        self.avatar = realm.requestAvatar('alice', None, None)[1]
+        self.server = essftp.EssFTPServer(self.avatar)
+
+    def test_limits(self):
+        """
+        Users get the flows of their limits, or the default limit
+        """
+        self.assertEqual(10, self.avatar.flow.bucket.rate)
+        realm = essftp.EssFTPRealm(self.root.path,
+                                   bandwidth=BandwidthScheduler(
+                                       clock=self.clock),
+                                   bandwidthLimits={
+                                       None: BandwidthLimit(100, None, 1)})
+        bob = realm.requestAvatar('bob', None, None)[1]
+        self.assertEqual(100, bob.flow.bucket.rate)
+
+    def test_shaped(self):
+        """
+        Reads and writes wait for their turn, and closing the file waits for
+        them
+        """
+        f = self.server.openFile('file', filetransfer.FXF_WRITE |
+                                 filetransfer.FXF_READ |
+                                 filetransfer.FXF_CREAT, {})
+        first = f.writeChunk(0, 'x' * 10)
+        second = f.writeChunk(10, 'y' * 10)
+        read = f.readChunk(0, 20)
+        closed = f.close()
+        self.successResultOf(first)
+        self.assertNoResult(second)
+        self.clock.advance(1)
+        self.successResultOf(second)
+        self.assertNoResult(read)
+        self.clock.advance(1)
+        self.assertEqual('x' * 10 + 'y' * 10, self.successResultOf(read))
+        self.assertNoResult(closed)
+        self.clock.advance(1)
+        self.successResultOf(closed)
+
+
+class ReadBandwidthLimitsTestCase(TestCase):
+    """
+    Tests for L{readBandwidthLimits}
+    """
+    def test_read(self):
+        """
+        Lines give avatar IDs, rates and optional weights, with C{-} for no
+        limit and C{*} for everyone else
+        """
+        f = StringIO('# comment\n\nalice 1024 2\nbob - 0.5\n* 100\n')
+        self.assertEqual({'alice': BandwidthLimit(1024, None, 2),
+                          'bob': BandwidthLimit(None, None, 0.5),
+                          None: BandwidthLimit(100, None, 1)},
+                         readBandwidthLimits(f))
+
+    def test_bad_lines(self):
+        """
+        Lines that cannot be parsed are errors
+        """
+        for line in ['alice', 'alice 10 1 1', 'alice many', 'alice 10 0']:
+            self.assertRaises(ValueError, readBandwidthLimits,
+                              StringIO(line))
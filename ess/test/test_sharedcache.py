@@ -0,0 +1,160 @@
+"""
+Tests for L{ess.sharedcache}.
+"""
+import os
+import struct
+import subprocess
+import sys
+
+from twisted.trial.unittest import TestCase
+
+from ess import sharedcache
+from ess.sharedcache import SharedMemoryCache
+
+
+class SharedMemoryCacheTestCase(TestCase):
+    """
+    Tests for L{SharedMemoryCache}
+    """
+    def setUp(self):
+        self.path = self.mktemp()
+        self.cache = self.open()
+
+    def open(self, slots=16, slotSize=128):
+        cache = SharedMemoryCache(self.path, slots, slotSize)
+        self.addCleanup(cache.close)
+        return cache
+
+    def slotOffset(self, key):
+        return self.cache._offset(key)
+
+    def test_set_get(self):
+        """
+        L{SharedMemoryCache.get} returns the value set for a key and its
+        expiry time, until it expires
+        """
+        self.assertIdentical(None, self.cache.get('alice', 0))
+        self.assertTrue(self.cache.set('alice', 'value', 10))
+        self.assertEqual(('value', 10), self.cache.get('alice', 9))
+        self.assertIdentical(None, self.cache.get('alice', 10))
+
+    def test_shared(self):
+        """
+        Values set through one L{SharedMemoryCache} can be got through
+        another one using the same file
+        """
+        self.cache.set('alice', 'value', 10)
+        self.assertEqual(('value', 10), self.open().get('alice', 0))
+
+    def test_shared_between_processes(self):
+        """
+        Values set by another process can be got
+        """
+        env = dict(os.environ,
+                   PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+        subprocess.check_call(
+            [sys.executable, '-c',
+             'from ess.sharedcache import SharedMemoryCache; '
+             'SharedMemoryCache({0!r}, 16, 128).set("alice", "value", 10)'
+             .format(os.path.abspath(self.path))], env=env)
+        self.assertEqual(('value', 10), self.cache.get('alice', 0))
+
+    def test_colliding_key_replaced(self):
+        """
+        Setting a key replaces any other key cached in the same slot
+        """
+        colliding = next(
+            'bob{0}'.format(i) for i in range(1000)
+            if self.slotOffset('bob{0}'.format(i)) ==
+            self.slotOffset('alice'))
+        self.cache.set('alice', 'value', 10)
+        self.cache.set(colliding, 'other', 10)
+        self.assertIdentical(None, self.cache.get('alice', 0))
+        self.assertEqual(('other', 10), self.cache.get(colliding, 0))
+
+    def test_too_big(self):
+        """
+        Values too big for a slot are not cached
+        """
+        self.assertFalse(self.cache.set('alice', 'x' * 128, 10))
+        self.assertIdentical(None, self.cache.get('alice', 0))
+
+    def test_delete(self):
+        """
+        L{SharedMemoryCache.delete} discards the value for a key, and leaves
+        any other key cached in the same slot alone
+        """
+        self.cache.set('alice', 'value', 10)
+        self.cache.delete('bob')
+        self.assertEqual(('value', 10), self.cache.get('alice', 0))
+        self.cache.delete('alice')
+        self.assertIdentical(None, self.cache.get('alice', 0))
+
+    def test_clear(self):
+        """
+        L{SharedMemoryCache.clear} discards every value, including for other
+        users of the file, and values can be set again afterwards
+        """
+        other = self.open()
+        self.cache.set('alice', 'value', 10)
+        self.cache.set('bob', 'value', 10)
+        other.clear()
+        self.assertIdentical(None, self.cache.get('alice', 0))
+        self.assertIdentical(None, self.cache.get('bob', 0))
+        self.cache.set('alice', 'new value', 10)
+        self.assertEqual(('new value', 10), other.get('alice', 0))
+
+    def test_interrupted_write(self):
+        """
+        A slot left half-written (with an odd sequence number) by a writer
+        that died is a miss, and can be written again
+        """
+        self.cache.set('alice', 'value', 10)
+        offset = self.slotOffset('alice')
+        sequence, = struct.unpack_from('>I', self.cache._map, offset)
+        struct.pack_into('>I', self.cache._map, offset, sequence + 1)
+        self.assertIdentical(None, self.cache.get('alice', 0))
+        self.cache.set('alice', 'new value', 10)
+        self.assertEqual(('new value', 10), self.cache.get('alice', 0))
+
+    def test_corrupt_slot(self):
+        """
+        A slot whose contents do not match its checksum is a miss
+        """
+        self.cache.set('alice', 'value', 10)
+        offset = self.slotOffset('alice') + sharedcache._SLOT.size + 5
+        self.cache._map[offset] = 'V'
+        self.assertIdentical(None, self.cache.get('alice', 0))
+
+    def test_reinitialised(self):
+        """
+        A file that does not have the same geometry (or is not a cache file
+        at all) is reinitialised
+        """
+        self.cache.set('alice', 'value', 10)
+        self.assertIdentical(None, self.open(slots=8).get('alice', 0))
+        with open(self.path, 'w') as f:
+            f.write('garbage')
+        cache = self.open()
+        self.assertIdentical(None, cache.get('alice', 0))
+        cache.set('alice', 'value', 10)
+        self.assertEqual(('value', 10), cache.get('alice', 0))
+
+    def test_permissions(self):
+        """
+        The file is created readable and writable by its owner only, and a
+        file that is readable or writable by anyone else is refused
+        """
+        self.assertEqual(0600, os.stat(self.path).st_mode & 0777)
+        os.chmod(self.path, 0644)
+        self.assertRaises(ValueError, SharedMemoryCache, self.path, 16, 128)
+        os.chmod(self.path, 0660)
+        self.assertRaises(ValueError, SharedMemoryCache, self.path, 16, 128)
+
+    def test_owner(self):
+        """
+        A file owned by another user is refused
+        """
+        uid = os.geteuid()
+        self.patch(os, 'geteuid', lambda: uid + 1)
+        self.assertRaises(ValueError, SharedMemoryCache, self.path, 16, 128)
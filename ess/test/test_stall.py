@@ -0,0 +1,183 @@
+"""
+Tests for L{ess.stall}.
+"""
+import time
+
+from twisted.cred.credentials import SSHPrivateKey
+from twisted.internet import reactor
+from twisted.internet.task import deferLater
+from twisted.python import log
+from twisted.trial.unittest import TestCase
+
+from ess import essftp
+from ess.filepath import FilePath
+from ess.metrics import Metrics
+from ess.stall import StallDetector, describeOperation
+
+
+class _Timer(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class _KeyLike(object):
+    """
+    An argument that has a username, but is not credentials
+    """
+    username = 'mallory'
+
+
+class DescribeOperationTestCase(TestCase):
+    """
+    Tests for L{describeOperation}
+    """
+    def setUp(self):
+        root = FilePath(self.mktemp())
+        root.makedirs()
+        root.child('file').setContent('data')
+        user = essftp.EssFTPUser(root.path, 'alice')
+        self.server = essftp.EssFTPServer(user)
+
+    def test_server_operation(self):
+        """
+        Operations of the SFTP server are described by the path they were
+        given and the avatar ID of the user
+        """
+        self.assertEqual(
+            "sftp.openFile path='/file' avatar='alice'",
+            describeOperation('sftp.openFile', (self.server, '/file')))
+
+    def test_file_operation(self):
+        """
+        Operations on files are described by the path of the file and the
+        avatar ID of the user that opened it
+        """
+        f = self.server.openFile('/file', essftp.filetransfer.FXF_READ, {})
+        self.addCleanup(f.close)
+        self.assertEqual(
+            "file.readChunk path={0!r} avatar='alice'".format(
+                f.filePath.path),
+            describeOperation('file.readChunk', (f, 0, 10)))
+
+    def test_auth_operation(self):
+        """
+        Authentication is described by the username being authenticated
+        """
+        credentials = SSHPrivateKey('bob', 'ssh-rsa', 'blob', None, None)
+        self.assertEqual(
+            "auth.publickey avatar='bob'",
+            describeOperation('auth.publickey', (object(), credentials)))
+
+    def test_auth_operation_credentials_not_first(self):
+        """
+        The credentials of an authentication need not be its first argument,
+        and other arguments are not mistaken for them
+        """
+        credentials = SSHPrivateKey('bob', 'ssh-rsa', 'blob', None, None)
+        key = _KeyLike()
+        self.assertEqual(
+            "auth.keyLookup avatar='bob'",
+            describeOperation('auth.keyLookup', (object(), key, credentials)))
+        self.assertEqual("auth.keyLookup",
+                         describeOperation('auth.keyLookup', (object(), key)))
+
+
+class StallDetectorTestCase(TestCase):
+    """
+    Tests for L{StallDetector}
+    """
+    def setUp(self):
+        self.timer = _Timer()
+        self.metrics = Metrics(timer=self.timer)
+        self.detector = StallDetector(threshold=1, interval=0.5,
+                                      metrics=self.metrics, timer=self.timer)
+        self.detector._beat = self.timer.now
+        self.messages = []
+        log.addObserver(self.observe)
+        self.addCleanup(log.removeObserver, self.observe)
+
+    def observe(self, event):
+        if not event.get('isError'):
+            self.messages.append(log.textFromEventDict(event))
+
+    def test_no_stall(self):
+        """
+        Nothing is logged if the reactor is not late by more than
+        C{threshold} seconds
+        """
+        self.timer.now += 1.5
+        self.assertFalse(self.detector.check())
+        self.assertEqual([], self.messages)
+
+    def test_stall(self):
+        """
+        A stall is logged once, with the running operation
+        """
+        def stalled(*args):
+            self.timer.now += 2
+            self.assertTrue(self.detector.check())
+            self.assertFalse(self.detector.check())
+        self.metrics.timed('op')(stalled)(1, 2)
+        self.assertEqual(1, len(self.messages))
+        self.assertIn('Reactor stalled for 1.500s: op, running for 2.000s',
+                      self.messages[0])
+
+    def test_no_operation(self):
+        """
+        A stall is logged even if no timed operation is running
+        """
+        self.timer.now += 2
+        self.detector._reactorThreadId = None
+        self.assertTrue(self.detector.check())
+        self.assertIn('no timed operation', self.messages[0])
+
+    def test_heartbeat(self):
+        """
+        Every heartbeat records the lag of the reactor, and lets the next
+        stall be logged
+        """
+        self.timer.now += 2
+        self.detector.check()
+        self.detector._heartbeat()
+        self.timer.now += 2
+        self.assertTrue(self.detector.check())
+        self.assertEqual(1.5, self.metrics.operations['reactor.lag']
+                         .latency.sum)
+
+
+class StallDetectorThreadTestCase(TestCase):
+    """
+    Tests for L{StallDetector} watching the real reactor from its thread
+    """
+    def test_stall_logged(self):
+        """
+        Blocking the reactor thread for longer than C{threshold} seconds
+        logs the operation that blocked it, and the stack of the reactor
+        thread
+        """
+        metrics = Metrics()
+        detector = StallDetector(threshold=0.1, interval=0.02,
+                                 metrics=metrics)
+        messages = []
+        log.addObserver(messages.append)
+        self.addCleanup(log.removeObserver, messages.append)
+
+        @metrics.timed('slow')
+        def slow():
+            time.sleep(0.5)
+
+        detector.startService()
+        self.addCleanup(detector.stopService)
+        d = deferLater(reactor, 0.05, slow)
+        d.addCallback(lambda _: deferLater(reactor, 0.05, lambda: None))
+
+        def check(_):
+            stalls = [log.textFromEventDict(m) for m in messages
+                      if 'Reactor stalled' in log.textFromEventDict(m)]
+            self.assertEqual(1, len(stalls))
+            self.assertIn(': slow, running for', stalls[0])
+            self.assertIn('time.sleep(0.5)', stalls[0])
+        return d.addCallback(check)
@@ -0,0 +1,162 @@
+"""
+Tests for L{ess.throttle}.
+"""
+
+from twisted.internet.address import IPv4Address
+from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from ess.throttle import TokenBucket, SourceThrottle, ThrottlingFactory
+
+
+class TokenBucketTestCase(TestCase):
+    """
+    Tests for L{TokenBucket}
+    """
+    def test_burst(self):
+        """
+        A L{TokenBucket} starts with C{burst} tokens
+        """
+        bucket = TokenBucket(1, 3, 0)
+        self.assertEqual([True, True, True, False],
+                         [bucket.consume(0) for _ in range(4)])
+
+    def test_refill(self):
+        """
+        Tokens are added at C{rate} per second, up to C{burst}
+        """
+        bucket = TokenBucket(2, 3, 0)
+        self.assertTrue(bucket.consume(0, 3))
+        self.assertFalse(bucket.consume(1, 3))
+        self.assertTrue(bucket.consume(1, 2))
+        self.assertFalse(bucket.consume(100, 4))
+        self.assertTrue(bucket.consume(100, 3))
+
+    def test_delay(self):
+        """
+        L{TokenBucket.delay} is how long until there are enough tokens, or
+        C{burst} of them when more are wanted
+        """
+        bucket = TokenBucket(2, 4, 0)
+        self.assertEqual(0, bucket.delay(0, 4))
+        bucket.consume(0, 4)
+        self.assertEqual(1, bucket.delay(0, 2))
+        self.assertEqual(2, bucket.delay(0, 100))
+
+    def test_take(self):
+        """
+        L{TokenBucket.take} takes tokens even when there are not enough,
+        leaving a debt to be repaid
+        """
+        bucket = TokenBucket(2, 4, 0)
+        bucket.take(0, 10)
+        self.assertEqual(4, bucket.delay(0, 2))
+        self.assertFalse(bucket.consume(3, 1))
+        self.assertTrue(bucket.consume(4, 2))
+
+
+class SourceThrottleTestCase(TestCase):
+    """
+    Tests for L{SourceThrottle}
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.throttle = SourceThrottle(
+            connectionRate=1, connectionBurst=2, failureRate=1,
+            failureBurst=2, banDuration=60, maxSources=2, clock=self.clock)
+
+    def test_no_limits(self):
+        """
+        By default, a L{SourceThrottle} allows everything
+        """
+        throttle = SourceThrottle(clock=self.clock)
+        for _ in range(100):
+            self.assertTrue(throttle.connectionAllowed('1.1.1.1'))
+            self.assertFalse(throttle.authenticationFailed('1.1.1.1'))
+
+    def test_connection_rate(self):
+        """
+        Connections from a source beyond the connection rate are not
+        allowed, without affecting other sources
+        """
+        self.assertEqual([True, True, False],
+                         [self.throttle.connectionAllowed('1.1.1.1')
+                          for _ in range(3)])
+        self.assertTrue(self.throttle.connectionAllowed('2.2.2.2'))
+        self.clock.advance(1)
+        self.assertTrue(self.throttle.connectionAllowed('1.1.1.1'))
+
+    def test_ban_after_failures(self):
+        """
+        A source that fails to authenticate beyond the failure rate is
+        banned for C{banDuration} seconds
+        """
+        self.assertEqual([False, False, True],
+                         [self.throttle.authenticationFailed('1.1.1.1')
+                          for _ in range(3)])
+        self.clock.advance(59)
+        self.assertFalse(self.throttle.connectionAllowed('1.1.1.1'))
+        self.clock.advance(1)
+        self.assertTrue(self.throttle.connectionAllowed('1.1.1.1'))
+
+    def test_ban_not_forgotten(self):
+        """
+        A banned source stays banned however many other sources are seen
+        """
+        for _ in range(3):
+            self.throttle.authenticationFailed('1.1.1.1')
+        for i in range(2, 10):
+            self.throttle.connectionAllowed('{0}.{0}.{0}.{0}'.format(i))
+        self.assertNotIn('1.1.1.1', self.throttle._sources)
+        self.assertFalse(self.throttle.connectionAllowed('1.1.1.1'))
+        self.clock.advance(60)
+        self.assertTrue(self.throttle.connectionAllowed('1.1.1.1'))
+        self.assertEqual({}, self.throttle._bans)
+
+    def test_expired_bans_forgotten(self):
+        """
+        Bans that have expired are forgotten when another source is banned
+        """
+        for host in ('1.1.1.1', '1.1.1.1', '1.1.1.1'):
+            self.throttle.authenticationFailed(host)
+        self.clock.advance(60)
+        for host in ('2.2.2.2', '2.2.2.2', '2.2.2.2'):
+            self.throttle.authenticationFailed(host)
+        self.assertEqual(['2.2.2.2'], list(self.throttle._bans))
+
+    def test_bounded(self):
+        """
+        Only C{maxSources} sources are remembered, forgetting the least
+        recently seen source first
+        """
+        for host in ('1.1.1.1', '1.1.1.1', '2.2.2.2', '3.3.3.3'):
+            self.throttle.connectionAllowed(host)
+        self.assertEqual(['2.2.2.2', '3.3.3.3'],
+                         list(self.throttle._sources))
+        self.assertEqual([True, True, False],
+                         [self.throttle.connectionAllowed('1.1.1.1')
+                          for _ in range(3)])
+
+
+class ThrottlingFactoryTestCase(TestCase):
+    """
+    Tests for L{ThrottlingFactory}
+    """
+    def test_drops_throttled_connections(self):
+        """
+        L{ThrottlingFactory.buildProtocol} returns C{None} for connections
+        the throttle does not allow, and otherwise builds a protocol with
+        the wrapped factory
+        """
+        wrapped = Factory()
+        wrapped.protocol = Protocol
+        throttle = SourceThrottle(connectionRate=1, connectionBurst=1,
+                                  clock=Clock())
+        factory = ThrottlingFactory(wrapped, throttle)
+        self.assertIdentical(throttle, wrapped.throttle)
+
+        addr = IPv4Address('TCP', '1.1.1.1', 1234)
+        self.assertIsInstance(factory.buildProtocol(addr).wrappedProtocol,
+                              Protocol)
+        self.assertIdentical(None, factory.buildProtocol(addr))
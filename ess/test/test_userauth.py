@@ -0,0 +1,155 @@
+"""
+Tests for L{ess.userauth}.
+"""
+
+from zope.interface import implementer
+
+from twisted.conch.ssh.common import NS
+from twisted.conch.ssh.keys import Key
+from twisted.conch.test.keydata import (publicRSA_openssh, privateRSA_openssh,
+                                        privateDSA_openssh)
+from twisted.cred.checkers import ICredentialsChecker
+from twisted.cred.credentials import ISSHPrivateKey
+from twisted.cred.error import UnauthorizedLogin
+from twisted.cred.portal import Portal
+from twisted.internet import defer
+from twisted.internet.address import IPv4Address
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.trial.unittest import TestCase
+
+from ess.shelless import ShelllessSSHRealm
+from ess.test.test_checkers import makeCertificate
+from ess.throttle import SourceThrottle
+from ess.userauth import EssUserAuthServer
+
+
+@implementer(ICredentialsChecker)
+class _RecordingChecker(object):
+    """
+    Checker that records the credentials it is given, and rejects them
+    """
+    credentialInterfaces = (ISSHPrivateKey,)
+
+    def __init__(self):
+        self.credentials = []
+
+    def requestAvatarId(self, credentials):
+        self.credentials.append(credentials)
+        return defer.fail(UnauthorizedLogin())
+
+
+class _FakeTCPTransport(object):
+    def getPeer(self):
+        return IPv4Address('TCP', '1.1.1.1', 1234)
+
+
+class _FakeFactory(object):
+    pass
+
+
+class _FakeTransport(object):
+    """
+    SSH transport that records the packets sent and disconnections
+    """
+    sessionID = 'session id'
+
+    def __init__(self):
+        self.factory = _FakeFactory()
+        self.transport = _FakeTCPTransport()
+        self.packets = []
+        self.disconnected = False
+
+    def sendPacket(self, messageType, payload):
+        self.packets.append(messageType)
+
+    def sendDisconnect(self, reason, description):
+        self.disconnected = True
+
+
+class EssUserAuthServerTestCase(TestCase):
+    """
+    Tests for L{EssUserAuthServer}
+    """
+    def setUp(self):
+        self.checker = _RecordingChecker()
+        self.server = EssUserAuthServer()
+        self.server.transport = _FakeTransport()
+        self.server.portal = Portal(ShelllessSSHRealm(), [self.checker])
+        self.server.user = 'alice'
+        self.server.nextService = 'ssh-connection'
+        self.certificate = makeCertificate(
+            Key.fromString(publicRSA_openssh),
+            Key.fromString(privateDSA_openssh))
+
+    def authenticate(self, algName, blob, signature=None):
+        packet = chr(signature is not None) + NS(algName) + NS(blob)
+        if signature is not None:
+            packet += NS(signature)
+        d = self.server.auth_publickey(packet)
+        self.failureResultOf(d, UnauthorizedLogin)
+        return self.checker.credentials[-1]
+
+    def test_certificate_signed(self):
+        """
+        Signed certificate requests are passed to the portal, with the
+        certificate algorithm name in the signed data
+        """
+        signature = Key.fromString(privateRSA_openssh).sign('foo')
+        credentials = self.authenticate('ssh-rsa-cert-v01@openssh.com',
+                                        self.certificate, signature)
+        self.assertEqual(
+            ('alice', 'ssh-rsa-cert-v01@openssh.com', self.certificate,
+             signature),
+            (credentials.username, credentials.algName, credentials.blob,
+             credentials.signature))
+        self.assertTrue(credentials.sigData.endswith(
+            NS('ssh-rsa-cert-v01@openssh.com') + NS(self.certificate)))
+
+    def test_certificate_probe(self):
+        """
+        Certificate requests without a signature are passed to the portal
+        """
+        credentials = self.authenticate('ssh-rsa-cert-v01@openssh.com',
+                                        self.certificate)
+        self.assertEqual((self.certificate, None, None),
+                         (credentials.blob, credentials.sigData,
+                          credentials.signature))
+
+    def test_plain_key(self):
+        """
+        Requests with plain keys are handled as usual
+        """
+        blob = Key.fromString(publicRSA_openssh).blob()
+        credentials = self.authenticate('ssh-rsa', blob)
+        self.assertEqual(('ssh-rsa', blob),
+                         (credentials.algName, credentials.blob))
+
+    def test_failures_throttled(self):
+        """
+        Failed authentication attempts are reported to the factory's
+        throttle, and the connection is dropped once the source is banned
+        """
+        self.server.transport.factory.throttle = SourceThrottle(
+            failureRate=1, failureBurst=2, clock=Clock())
+        self.server.method = 'publickey'
+        self.server.loginAttempts = 0
+        self.server.supportedAuthentications = ['publickey']
+        for _ in range(2):
+            self.server._ebBadAuth(Failure(UnauthorizedLogin()))
+        self.assertEqual(2, len(self.server.transport.packets))
+        self.assertFalse(self.server.transport.disconnected)
+        self.server._ebBadAuth(Failure(UnauthorizedLogin()))
+        self.assertEqual(2, len(self.server.transport.packets))
+        self.assertTrue(self.server.transport.disconnected)
+
+    def test_none_method_not_throttled(self):
+        """
+        Failures with the 'none' method are not reported to the throttle
+        """
+        self.server.transport.factory.throttle = SourceThrottle(
+            failureRate=1, failureBurst=0, clock=Clock())
+        self.server.method = 'none'
+        self.server.supportedAuthentications = ['publickey']
+        self.server._ebBadAuth(Failure(UnauthorizedLogin()))
+        self.assertFalse(self.server.transport.disconnected)
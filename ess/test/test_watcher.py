@@ -0,0 +1,169 @@
+"""
+Tests for L{ess.watcher}.
+"""
+
+from twisted.internet import defer, inotify, reactor
+from twisted.python.filepath import FilePath
+from twisted.python.runtime import platform
+from twisted.trial.unittest import TestCase
+
+from ess.watcher import FileWatcher
+
+
+class _FakeNotifier(object):
+    """
+    Notifier that records watches instead of asking the kernel for them
+    """
+    def __init__(self, limit=10):
+        self.limit = limit
+        self.watches = {}
+
+    def watch(self, path, mask, callbacks):
+        if path not in self.watches:
+            if len(self.watches) >= self.limit:
+                raise inotify.INotifyError("watch limit reached")
+            self.watches[path] = callbacks
+        return len(self.watches)
+
+    def ignore(self, path):
+        del self.watches[path]
+
+    def notify(self, path, mask=inotify.IN_MODIFY):
+        """
+        Pretend something happened to C{path}, in the watched directory
+        C{path} or C{path}'s parent
+        """
+        directory = path if path in self.watches else path.parent()
+        for callback in self.watches[directory]:
+            callback(None, path, mask)
+
+
+class FileWatcherTestCase(TestCase):
+    """
+    Tests for L{FileWatcher}
+    """
+    def setUp(self):
+        self.notifier = _FakeNotifier(limit=1)
+        self.watcher = FileWatcher(self.notifier)
+        self.root = FilePath(self.mktemp())
+        self.changed = []
+
+    def test_watches_parent_directory(self):
+        """
+        L{FileWatcher.watch} watches the parent directory of the file, and
+        calls back only when that file changes
+        """
+        self.assertTrue(self.watcher.watch(self.root.child('a'),
+                                           self.changed.append))
+        self.assertEqual([self.root], self.notifier.watches.keys())
+        self.notifier.notify(self.root.child('b'))
+        self.notifier.notify(self.root.child('a'))
+        self.notifier.notify(self.root.child('a'), inotify.IN_DELETE)
+        self.assertEqual([self.root.child('a')] * 2, self.changed)
+
+    def test_same_callback_called_once(self):
+        """
+        Watching the same file with the same callback twice only calls it
+        once per change
+        """
+        self.watcher.watch(self.root.child('a'), self.changed.append)
+        self.watcher.watch(self.root.child('a'), self.changed.append)
+        self.notifier.notify(self.root.child('a'))
+        self.assertEqual([self.root.child('a')], self.changed)
+
+    def test_watch_limit(self):
+        """
+        If the notifier cannot watch any more directories,
+        L{FileWatcher.watch} returns C{False}
+        """
+        self.watcher.watch(self.root.child('a'), self.changed.append)
+        self.assertFalse(self.watcher.watch(
+            self.root.child('dir').child('b'), self.changed.append))
+
+    def test_directory_removed(self):
+        """
+        If a watched directory is removed, every callback for files in it is
+        called and the directory is no longer watched
+        """
+        self.watcher.watch(self.root.child('a'), self.changed.append)
+        self.notifier.notify(self.root, inotify.IN_ATTRIB)
+        self.assertEqual([], self.changed)
+        self.notifier.notify(self.root, inotify.IN_DELETE_SELF)
+        self.assertEqual([self.root.child('a')], self.changed)
+        self.assertEqual({}, self.notifier.watches)
+
+    def test_unwatch(self):
+        """
+        L{FileWatcher.unwatch} stops calling back, and once no file in the
+        directory is watched, stops watching the directory
+        """
+        other = []
+        self.watcher.watch(self.root.child('a'), self.changed.append)
+        self.watcher.watch(self.root.child('a'), other.append)
+        self.watcher.watch(self.root.child('b'), self.changed.append)
+        self.watcher.unwatch(self.root.child('a'), self.changed.append)
+        self.notifier.notify(self.root.child('a'))
+        self.assertEqual(([], [self.root.child('a')]), (self.changed, other))
+
+        self.watcher.unwatch(self.root.child('a'), other.append)
+        self.watcher.unwatch(self.root.child('b'), self.changed.append)
+        self.assertEqual({}, self.notifier.watches)
+        self.assertTrue(self.watcher.watch(
+            self.root.child('dir').child('c'), self.changed.append))
+
+    def test_unwatch_unknown(self):
+        """
+        Unwatching a file that is not watched, or no longer watched because
+        its directory was removed, does nothing
+        """
+        self.watcher.unwatch(self.root.child('a'), self.changed.append)
+        self.watcher.watch(self.root.child('a'), self.changed.append)
+        self.notifier.notify(self.root, inotify.IN_DELETE_SELF)
+        self.watcher.unwatch(self.root.child('a'), self.changed.append)
+        self.assertEqual({}, self.notifier.watches)
+
+    def test_callback_errors_logged(self):
+        """
+        An exception raised by one callback is logged, and does not stop
+        other callbacks from being called
+        """
+        def fail(filePath):
+            raise ZeroDivisionError()
+
+        self.watcher.watch(self.root.child('a'), fail)
+        self.watcher.watch(self.root.child('a'), self.changed.append)
+        self.notifier.notify(self.root.child('a'))
+        self.assertEqual([self.root.child('a')], self.changed)
+        self.assertEqual(1, len(self.flushLoggedErrors(ZeroDivisionError)))
+
+
+class INotifyFileWatcherTestCase(TestCase):
+    """
+    Tests for L{FileWatcher} using inotify
+    """
+    if not platform.supportsINotify():
+        skip = "inotify is not supported on this platform"
+
+    def setUp(self):
+        self.watcher = FileWatcher()
+        self.addCleanup(self.watcher.notifier.loseConnection)
+        self.root = FilePath(self.mktemp())
+        self.root.makedirs()
+
+    def test_replaced_file(self):
+        """
+        L{FileWatcher} calls back when a file that did not exist is created
+        by renaming another file over it
+        """
+        d = defer.Deferred()
+        self.assertTrue(self.watcher.watch(self.root.child('a'), d.callback))
+        reactor.callLater(0, self.root.child('a').setContent, 'content')
+        return d.addCallback(self.assertEqual, self.root.child('a'))
+
+    def test_missing_directory(self):
+        """
+        L{FileWatcher.watch} returns C{False} if the parent directory of the
+        file does not exist
+        """
+        self.assertFalse(self.watcher.watch(
+            self.root.child('nope').child('a'), lambda _: None))
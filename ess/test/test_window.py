@@ -0,0 +1,154 @@
+"""
+Tests for L{ess.window}.
+"""
+from twisted.conch.error import ConchError
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from ess import essftp
+from ess.window import HALF, EAGER, AUTO, WindowPolicy, TunedSession
+
+
+class _Connection(object):
+    """
+    Stands in for the SSH connection of a channel
+    """
+    def __init__(self):
+        self.adjusted = []
+        self.requests = []
+
+    def adjustWindow(self, channel, bytesToAdd):
+        self.adjusted.append(bytesToAdd)
+        channel.localWindowLeft += bytesToAdd
+
+    def sendGlobalRequest(self, request, data, wantReply=0):
+        d = defer.Deferred()
+        self.requests.append((request, d))
+        return d
+
+
+class TunedSessionTestCase(TestCase):
+    """
+    Tests for L{TunedSession}
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.conn = _Connection()
+
+    def session(self, *policy):
+        """
+        Open a session for a user with a window policy
+        """
+        session = TunedSession(
+            conn=self.conn, clock=self.clock,
+            avatar=essftp.EssFTPUser('/', window=WindowPolicy(*policy)))
+        session.channelOpen('')
+        return session
+
+    def receive(self, session, length):
+        """
+        Receive data the way the connection does
+        """
+        session.localWindowLeft -= length
+        session.dataReceived('x' * length)
+
+    def test_sizes(self):
+        """
+        The window and maximum packet sizes come from the policy, or are
+        Conch's by default
+        """
+        session = self.session(1000000, 65536, HALF, None)
+        self.assertEqual((1000000, 1000000, 65536),
+                         (session.localWindowSize, session.localWindowLeft,
+                          session.localMaxPacket))
+        session = TunedSession(conn=self.conn,
+                               avatar=essftp.EssFTPUser('/'))
+        self.assertEqual((131072, 32768),
+                         (session.localWindowSize, session.localMaxPacket))
+
+    def test_half(self):
+        """
+        With L{HALF}, the window is left to the connection to reopen
+        """
+        session = self.session(1000, 10, HALF, None)
+        self.receive(session, 100)
+        self.assertEqual([], self.conn.adjusted)
+        self.assertEqual([], self.conn.requests)
+
+    def test_eager(self):
+        """
+        With L{EAGER}, the window is reopened once more than three packets
+        of it have been used
+        """
+        session = self.session(1000, 10, EAGER, None)
+        self.receive(session, 10)
+        self.receive(session, 10)
+        self.receive(session, 10)
+        self.assertEqual([], self.conn.adjusted)
+        self.receive(session, 10)
+        self.assertEqual([40], self.conn.adjusted)
+        self.assertEqual(1000, session.localWindowLeft)
+
+    def test_auto_round_trip(self):
+        """
+        With L{AUTO}, the round trip time is measured with a global request
+        when the channel opens, whether the client knows the request or not
+        """
+        session = self.session(1000, 10, AUTO, 8000)
+        [(request, d)] = self.conn.requests
+        self.assertEqual('keepalive@openssh.com', request)
+        self.clock.advance(0.5)
+        d.errback(ConchError('global request failed'))
+        self.assertEqual(0.5, session.roundTrip)
+
+    def test_auto_grows(self):
+        """
+        With L{AUTO}, the window doubles, up to its maximum, whenever the
+        client sends more than half of it per round trip, and the growth is
+        given to the client straight away
+        """
+        session = self.session(1000, 1000, AUTO, 3000)
+        self.clock.advance(1)
+        self.conn.requests[0][1].callback('')
+
+        self.receive(session, 400)
+        self.clock.advance(1)
+        self.receive(session, 200)
+        self.assertEqual(2000, session.localWindowSize)
+        self.assertEqual([1600], self.conn.adjusted)
+        self.assertEqual(2000, session.localWindowLeft)
+
+        self.clock.advance(1)
+        self.receive(session, 1500)
+        self.assertEqual(3000, session.localWindowSize)
+        self.clock.advance(1)
+        self.receive(session, 3000)
+        self.assertEqual(3000, session.localWindowSize)
+
+    def test_auto_idle(self):
+        """
+        With L{AUTO}, the window does not grow when the client sends less
+        than half of it per round trip
+        """
+        session = self.session(1000, 1000, AUTO, 3000)
+        self.clock.advance(0.1)
+        self.conn.requests[0][1].callback('')
+        self.clock.advance(10)
+        self.receive(session, 400)
+        self.assertEqual(1000, session.localWindowSize)
+
+
+class EssFTPUserTestCase(TestCase):
+    """
+    Tests for the window policy of L{essftp.EssFTPUser}
+    """
+    def test_window(self):
+        """
+        Users with a window policy from their realm get tuned sessions
+        """
+        policy = WindowPolicy(1000000, None, AUTO, None)
+        realm = essftp.EssFTPRealm('/', window=policy)
+        user = realm.requestAvatar('alice', None, None)[1]
+        self.assertIdentical(policy, user.window)
+        self.assertIdentical(TunedSession, user.channelLookup['session'])
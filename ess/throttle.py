@@ -0,0 +1,206 @@
+"""
+Module that limits how often sources may connect and fail to authenticate,
+so that abusive peers are dropped before any expensive key exchange or
+signature checking is done for them
+"""
+from collections import OrderedDict
+
+from twisted.protocols.policies import WrappingFactory
+from twisted.python import log
+
+
+class TokenBucket(object):
+    """
+    A token bucket: tokens are added at a fixed rate, up to a maximum, and
+    taken out as they are used.
+
+    @ivar rate: number of tokens added per second
+    @ivar burst: maximum number of tokens in the bucket (which it starts
+        with)
+    @ivar tokens: number of tokens in the bucket when last updated
+    @ivar updated: time at which the bucket was last updated
+    """
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def consume(self, now, amount=1):
+        """
+        Take tokens out of the bucket, if there are enough
+
+        @param now: the current time, in seconds
+        @param amount: the number of tokens to take
+
+        @return: C{True} if the tokens were taken, C{False} if there were not
+            enough of them
+        """
+        self._refill(now)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def delay(self, now, amount=1):
+        """
+        @param now: the current time, in seconds
+        @param amount: the number of tokens wanted - if more than C{burst},
+            only C{burst} of them are waited for
+
+        @return: the number of seconds until there are enough tokens in the
+            bucket (0 if there already are)
+        """
+        self._refill(now)
+        missing = min(amount, self.burst) - self.tokens
+        return max(0, missing / float(self.rate))
+
+    def take(self, now, amount=1):
+        """
+        Take tokens out of the bucket whether or not there are enough of
+        them, leaving it in debt (to be repaid before it allows anything
+        else) if there are not
+
+        @param now: the current time, in seconds
+        @param amount: the number of tokens to take
+        """
+        self._refill(now)
+        self.tokens -= amount
+
+
+class _Source(object):
+    """
+    What is known about one source address
+    """
+    def __init__(self, connections, failures):
+        self.connections = connections
+        self.failures = failures
+
+
+class SourceThrottle(object):
+    """
+    Object that limits, per source address, the rate of new connections and
+    of failed authentication attempts.  Connections beyond the limit are
+    refused, and sources that fail to authenticate beyond the limit are
+    banned (all their connections refused) for C{banDuration} seconds.
+
+    At most C{maxSources} addresses are remembered - the least recently seen
+    address is forgotten first, so memory use is bounded however many
+    addresses connect.  Bans are kept apart from them until they expire, so
+    that a banned source cannot be forgotten by connecting from other
+    addresses.
+
+    @ivar connectionRate: number of new connections allowed per second per
+        source, or C{None} for no limit
+    @ivar connectionBurst: number of new connections allowed at once per
+        source
+    @ivar failureRate: number of failed authentication attempts allowed per
+        second per source, or C{None} for no limit
+    @ivar failureBurst: number of failed authentication attempts allowed at
+        once per source
+    @ivar banDuration: number of seconds a source is banned for
+    @ivar maxSources: C{int} maximum number of source addresses remembered
+    @ivar clock: L{twisted.internet.interfaces.IReactorTime} provider, mainly
+        to be used for testing.  The default is the reactor.
+    """
+    def __init__(self, connectionRate=None, connectionBurst=10,
+                 failureRate=None, failureBurst=10, banDuration=300,
+                 maxSources=10000, clock=None):
+        self.connectionRate = connectionRate
+        self.connectionBurst = connectionBurst
+        self.failureRate = failureRate
+        self.failureBurst = failureBurst
+        self.banDuration = banDuration
+        self.maxSources = maxSources
+        self.clock = clock
+        if clock is None:
+            from twisted.internet import reactor
+            self.clock = reactor
+        self._sources = OrderedDict()
+        self._bans = {}
+
+    def connectionAllowed(self, host):
+        """
+        Record a new connection from a source
+
+        @param host: C{str} source address
+
+        @return: C{True} if the connection should be allowed, C{False} if it
+            should be dropped
+        """
+        now = self.clock.seconds()
+        bannedUntil = self._bans.get(host)
+        if bannedUntil is not None:
+            if bannedUntil > now:
+                return False
+            del self._bans[host]
+        source = self._source(host, now)
+        return source.connections is None or source.connections.consume(now)
+
+    def authenticationFailed(self, host):
+        """
+        Record a failed authentication attempt from a source
+
+        @param host: C{str} source address
+
+        @return: C{True} if the source is now banned, and its connection
+            should be dropped
+        """
+        now = self.clock.seconds()
+        source = self._source(host, now)
+        if source.failures is None or source.failures.consume(now):
+            return False
+        for banned, bannedUntil in self._bans.items():
+            if bannedUntil <= now:
+                del self._bans[banned]
+        self._bans[host] = now + self.banDuration
+        log.msg("Banning {0} for {1} seconds after too many failed "
+                "authentication attempts".format(host, self.banDuration))
+        return True
+
+    def _source(self, host, now):
+        source = self._sources.pop(host, None)
+        if source is None:
+            source = _Source(self._bucket(self.connectionRate,
+                                          self.connectionBurst, now),
+                             self._bucket(self.failureRate,
+                                          self.failureBurst, now))
+        self._sources[host] = source  # most recently seen
+        while len(self._sources) > self.maxSources:
+            self._sources.popitem(last=False)
+        return source
+
+    def _bucket(self, rate, burst, now):
+        if rate is None:
+            return None
+        return TokenBucket(rate, burst, now)
+
+
+class ThrottlingFactory(WrappingFactory):
+    """
+    Factory that drops connections from sources that a L{SourceThrottle}
+    does not allow, before the wrapped factory builds a protocol for them
+    (so before any SSH version exchange or key exchange).
+
+    The throttle is also set as the C{throttle} attribute of the wrapped
+    factory, so that L{ess.userauth.EssUserAuthServer} can report failed
+    authentication attempts to it.
+
+    @ivar throttle: the L{SourceThrottle}
+    """
+    def __init__(self, wrappedFactory, throttle):
+        WrappingFactory.__init__(self, wrappedFactory)
+        self.throttle = throttle
+        wrappedFactory.throttle = throttle
+
+    def buildProtocol(self, addr):
+        if not self.throttle.connectionAllowed(addr.host):
+            log.msg("Dropping connection from {0}".format(addr.host))
+            return None
+        return WrappingFactory.buildProtocol(self, addr)
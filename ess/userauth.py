@@ -0,0 +1,70 @@
+"""
+Module that provides an SSH user authentication service that also accepts
+OpenSSH certificates, and reports failed attempts to a throttle
+"""
+from twisted.conch import error, interfaces
+from twisted.conch.ssh import transport, userauth
+from twisted.conch.ssh.common import NS, getNS
+from twisted.cred import credentials
+
+from ess.checkers import CERTIFICATE_TYPES
+
+
+class EssUserAuthServer(userauth.SSHUserAuthServer):
+    """
+    User authentication service that passes OpenSSH certificates through to
+    the portal (for L{ess.checkers.SSHCertificateChecker}) rather than
+    failing to parse them as plain keys.
+
+    If the factory has a C{throttle} (see L{ess.throttle.ThrottlingFactory}),
+    failed authentication attempts are reported to it, and the connection is
+    dropped if the source gets banned.
+    """
+    def auth_publickey(self, packet):
+        """
+        Public key authentication.  Payload::
+            byte has signature
+            string algorithm name
+            string key blob
+            [string signature] (if has signature is True)
+
+        Keys that are not certificates are handled as usual.  For
+        certificates, the signed data includes the certificate algorithm
+        name rather than the type of the certified key.
+        """
+        hasSig = ord(packet[0])
+        algName, blob, rest = getNS(packet[1:], 2)
+        if algName not in CERTIFICATE_TYPES:
+            return userauth.SSHUserAuthServer.auth_publickey(self, packet)
+
+        if hasSig:
+            signature = getNS(rest)[0]
+            b = (NS(self.transport.sessionID) +
+                 chr(userauth.MSG_USERAUTH_REQUEST) + NS(self.user) +
+                 NS(self.nextService) + NS('publickey') + chr(hasSig) +
+                 NS(algName) + NS(blob))
+            c = credentials.SSHPrivateKey(self.user, algName, blob, b,
+                                          signature)
+            return self.portal.login(c, None, interfaces.IConchUser)
+        else:
+            c = credentials.SSHPrivateKey(self.user, algName, blob, None, None)
+            return self.portal.login(c, None, interfaces.IConchUser
+                                     ).addErrback(self._ebCheckKey,
+                                                  packet[1:])
+
+    def _ebBadAuth(self, reason):
+        """
+        Report the failed attempt to the factory's throttle, if any, unless
+        it was with the 'none' method (which clients always try first) or
+        the method has already responded.
+        """
+        throttle = getattr(self.transport.factory, 'throttle', None)
+        if (throttle is not None and self.method != 'none' and
+                not reason.check(error.IgnoreAuthentication)):
+            host = self.transport.transport.getPeer().host
+            if throttle.authenticationFailed(host):
+                self.transport.sendDisconnect(
+                    transport.DISCONNECT_NO_MORE_AUTH_METHODS_AVAILABLE,
+                    'too many bad auths')
+                return
+        return userauth.SSHUserAuthServer._ebBadAuth(self, reason)
@@ -0,0 +1,117 @@
+"""
+Module that calls back when watched files change, based on
+L{twisted.internet.inotify}, so that whatever was read from them can be
+invalidated immediately rather than after a timeout
+"""
+from twisted.internet import inotify
+from twisted.python import log
+
+_CHANGES = (inotify.IN_MODIFY | inotify.IN_ATTRIB | inotify.IN_CLOSE_WRITE |
+            inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO | inotify.IN_CREATE |
+            inotify.IN_DELETE | inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF)
+
+_GONE = inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF
+
+
+class FileWatcher(object):
+    """
+    Object that watches files for changes (including being created, removed,
+    or replaced by another file being renamed over them), and calls back
+    every time they change.
+
+    Files are watched through their parent directories, so a file that does
+    not exist yet can be watched as long as its directory exists.  Watching
+    fails if the directory does not exist, or if the inotify watch limit has
+    been reached - callers should then fall back to some other way of
+    noticing changes, such as expiring what they read after a while.
+
+    If a watched directory is removed or moved, every callback for files in
+    it is called one last time, and the files have to be watched again.
+
+    @ivar notifier: the L{twisted.internet.inotify.INotify} used to watch
+        directories - the default is a new one, reading from the reactor
+    """
+    def __init__(self, notifier=None):
+        if notifier is None:
+            notifier = inotify.INotify()
+            notifier.startReading()
+        self.notifier = notifier
+        self._callbacks = {}
+
+    def watch(self, filePath, callback):
+        """
+        Call back every time a file changes.  Watching the same file with the
+        same callback more than once has no further effect.
+
+        @param filePath: L{twisted.python.filepath.FilePath} of the file
+        @param callback: a callable that takes the
+            L{twisted.python.filepath.FilePath} that changed
+
+        @return: C{True} if the file is watched, C{False} if it could not be
+        """
+        directory = filePath.parent()
+        if directory not in self._callbacks:
+            try:
+                self.notifier.watch(directory, mask=_CHANGES,
+                                    callbacks=[self._notified])
+            except inotify.INotifyError:
+                log.msg("Unable to watch {0}".format(directory.path))
+                return False
+            self._callbacks[directory] = {}
+
+        callbacks = self._callbacks[directory].setdefault(filePath, [])
+        if callback not in callbacks:
+            callbacks.append(callback)
+        return True
+
+    def unwatch(self, filePath, callback):
+        """
+        Stop calling back when a file changes.  Once no file in its
+        directory is watched, the directory is no longer watched either, so
+        that its inotify watch can be used for another one.
+
+        @param filePath: L{twisted.python.filepath.FilePath} of the file
+        @param callback: the callable the file is watched with
+        """
+        directory = filePath.parent()
+        children = self._callbacks.get(directory)
+        if children is None:
+            return
+        callbacks = children.get(filePath, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if not callbacks:
+            children.pop(filePath, None)
+        if not children:
+            del self._callbacks[directory]
+            try:
+                self.notifier.ignore(directory)
+            except KeyError:
+                pass  # already removed by the notifier
+
+    def _notified(self, ignored, filePath, mask):
+        """
+        Called by the notifier when something changed in a watched directory,
+        or happened to the directory itself
+        """
+        if filePath in self._callbacks:
+            if not mask & _GONE:
+                return
+            children = self._callbacks.pop(filePath)
+            try:
+                self.notifier.ignore(filePath)
+            except KeyError:
+                pass  # already removed by the notifier
+            changes = [(child, callback)
+                       for child, callbacks in children.iteritems()
+                       for callback in callbacks]
+        else:
+            callbacks = self._callbacks.get(filePath.parent(), {}).get(
+                filePath, ())
+            changes = [(filePath, callback) for callback in list(callbacks)]
+
+        for changed, callback in changes:
+            try:
+                callback(changed)
+            except:
+                log.err()
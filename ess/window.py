@@ -0,0 +1,121 @@
+"""
+Module that sizes the channel windows of SFTP sessions.  A client can only
+send as much as the window the server has opened for it per round trip, so
+on links with a large bandwidth-delay product Conch's default window of
+128KiB, reopened only once it is half used up, caps upload speed well
+below what the link could carry.
+"""
+from collections import namedtuple
+
+from ess.backpressure import FlowControlledSession
+
+
+# reopen the window once less than half of it is left (what Conch does)
+HALF = 'half'
+# also reopen it once more than three packets of it have been used (what
+# OpenSSH does), so that a large window never runs dry
+EAGER = 'eager'
+# reopen it eagerly, and grow it whenever the client sends more than half of
+# it per round trip, up to a maximum
+AUTO = 'auto'
+
+STRATEGIES = (HALF, EAGER, AUTO)
+
+# global request that every client answers (with a failure if it does not
+# know it), used to time round trips
+_PING = 'keepalive@openssh.com'
+
+
+class WindowPolicy(namedtuple('WindowPolicy',
+                              ['size', 'maxPacket', 'strategy', 'maxSize'])):
+    """
+    How to size the windows of session channels
+
+    @ivar size: initial window size in bytes, or C{None} for Conch's default
+    @ivar maxPacket: the maximum number of bytes of data the client may send
+        in one packet, or C{None} for Conch's default
+    @ivar strategy: when to reopen the window: L{HALF}, L{EAGER} or L{AUTO}
+    @ivar maxSize: the size in bytes L{AUTO} may grow the window up to
+    """
+    __slots__ = ()
+
+
+class TunedSession(FlowControlledSession):
+    """
+    Session channel whose window is sized and reopened according to the
+    L{WindowPolicy} of its avatar (its C{window}, if it has one).
+
+    With the L{AUTO} strategy, the round trip time is measured with a global
+    request when the channel is opened, and from then on the client's
+    throughput per round trip is estimated over every round trip's worth of
+    data.  Whenever it is more than half of the window, the client is
+    probably held back by it, and the window is doubled.
+
+    @ivar strategy: L{HALF}, L{EAGER} or L{AUTO}
+    @ivar maxWindowSize: the size in bytes the window may grow up to
+    @ivar roundTrip: the measured round trip time in seconds, or C{None}
+    @ivar clock: L{twisted.internet.interfaces.IReactorTime} provider, mainly
+        to be used for testing.  The default is the reactor.
+    """
+    def __init__(self, *args, **kwargs):
+        clock = kwargs.pop('clock', None)
+        policy = (getattr(kwargs.get('avatar'), 'window', None) or
+                  WindowPolicy(None, None, HALF, None))
+        kwargs.setdefault('localWindow', policy.size or 0)
+        kwargs.setdefault('localMaxPacket', policy.maxPacket or 0)
+        FlowControlledSession.__init__(self, *args, **kwargs)
+        self.strategy = policy.strategy
+        self.maxWindowSize = max(policy.maxSize or 0,
+                                 self.localWindowSize)
+        self.roundTrip = None
+        self.clock = clock
+        if clock is None:
+            from twisted.internet import reactor
+            self.clock = reactor
+        self._since = None
+        self._received = 0
+
+    def channelOpen(self, specificData):
+        FlowControlledSession.channelOpen(self, specificData)
+        if self.strategy == AUTO:
+            self.measureRoundTrip()
+
+    def measureRoundTrip(self):
+        """
+        Time a global request to the client, and remember it as the round
+        trip time
+        """
+        start = self.clock.seconds()
+
+        def measured(_):
+            self._since = self.clock.seconds()
+            self._received = 0
+            self.roundTrip = self._since - start
+
+        self.conn.sendGlobalRequest(_PING, '', wantReply=True).addBoth(
+            measured)
+
+    def dataReceived(self, data):
+        if self.strategy != HALF:
+            self._tune(len(data))
+        FlowControlledSession.dataReceived(self, data)
+
+    def _tune(self, length):
+        """
+        Grow the window if the client is held back by it (L{AUTO} only), and
+        reopen it once more than three packets of it have been used
+        """
+        if self.roundTrip is not None:
+            now = self.clock.seconds()
+            self._received += length
+            elapsed = now - self._since
+            if elapsed and elapsed >= self.roundTrip:
+                perRoundTrip = self._received * self.roundTrip / elapsed
+                if perRoundTrip > self.localWindowSize // 2:
+                    self.localWindowSize = min(self.maxWindowSize,
+                                               self.localWindowSize * 2)
+                self._since, self._received = now, 0
+        used = self.localWindowSize - self.localWindowLeft
+        if (used > 3 * self.localMaxPacket or
+                self.localWindowLeft < self.localWindowSize // 2):
+            self.conn.adjustWindow(self, used)
@@ -1,16 +1,40 @@
-from twisted.application.service import IServiceMaker
+import shlex
+import sys
+
+from twisted.application.service import IServiceMaker, MultiService
 from twisted.application import internet
-from twisted.conch.openssh_compat.factory import OpenSSHFactory
+from twisted.conch.ssh import transport
 from twisted.conch.manhole_ssh import ConchFactory
 from twisted.cred import credentials, checkers, portal, strcred
 from twisted.internet import defer
-from twisted.python import usage
+from twisted.python import log, usage
+from twisted.python.filepath import FilePath
+from twisted.python.runtime import platform
 from twisted.plugin import IPlugin
+from twisted.web.server import Site
 
 from zope.interface import implements
 
 from ess import essftp
-from ess.checkers import UNIXAuthorizedKeysFiles, SSHPublicKeyChecker
+from ess.algorithms import PROFILES, makeTransport, parseAlgorithms
+from ess.backpressure import FlowControlledConnection
+from ess.checkers import (CachingUserDatabase, UNIXAuthorizedKeysFiles,
+                          CachingAuthorizedKeysDB, CoalescingAuthorizedKeysDB,
+                          AuthorizedKeysCommand, SQLiteAuthorizedKeysDB,
+                          MappedAuthorizedKeysIndex,
+                          SSHPublicKeyChecker, SSHCertificateChecker,
+                          readAuthorizedKeyFile)
+from ess.hostkeys import EssOpenSSHFactory, generateHostKeys
+from ess.metrics import MetricsResource
+from ess.prefork import WorkerSupervisor, workerIndex
+from ess.profiling import SessionProfiler, AdminFactory
+from ess.shaping import (BandwidthScheduler, BandwidthLimit,
+                         readBandwidthLimits)
+from ess.sharedcache import SharedMemoryCache
+from ess.stall import StallDetector
+from ess.throttle import SourceThrottle, ThrottlingFactory
+from ess.userauth import EssUserAuthServer
+from ess.window import HALF, STRATEGIES, WindowPolicy
 
 class AlwaysAllow(object):
     credentialInterfaces = credentials.IUsernamePassword,
@@ -28,17 +52,158 @@ class Options(usage.Options, strcred.AuthOptionMixin):
     optParameters = [
          ["root", "r", './', "Root directory, as seen by clients"],
          ["port", "p", "8888", "Port on which to listen"],
-         ["keyDirectory", "k", None, "Directory to look for host keys in.  "
-            "If this is not provided, fake keys will be used."],
+         ["interface", "", "", "IPv4 or IPv6 address of the interface on "
+            "which to listen (default: every IPv4 one)"],
+         ["keyDirectory", "k", None, "Directory to look for host keys in "
+            "(an RSA key is generated there if there is none).  If this is "
+            "not provided, fake keys will be used."],
          ["moduli", "", None, "Directory to look for moduli in "
-                              "(if different from --keyDirectory)"]
+                              "(if different from --keyDirectory)"],
+         ["userCAKeys", "", None, "File of public keys of CAs trusted to "
+            "sign OpenSSH user certificates, in authorized_keys format"],
+         ["authorizedKeysCommand", "", None, "Helper program (and "
+            "arguments) to get authorized keys from, instead of users' "
+            "~/.ssh/authorized_keys files.  It is sent usernames one per "
+            "line, and answers each with authorized_keys lines followed by "
+            "an empty line."],
+         ["authorizedKeysDB", "", None, "SQLite database to look up "
+            "authorized keys in, instead of users' ~/.ssh/authorized_keys "
+            "files (load it with 'python -m ess.authorizedkeys import')"],
+         ["authorizedKeysIndex", "", None, "Compiled index to look up "
+            "authorized keys in, instead of users' ~/.ssh/authorized_keys "
+            "files (compile it with 'python -m ess.authorizedkeys "
+            "compile')"],
+         ["connectionRate", "", None, "Maximum new connections per second "
+            "from one source address (default: unlimited)", float],
+         ["connectionBurst", "", 10, "Number of new connections one source "
+            "address may make at once", int],
+         ["authFailureRate", "", None, "Maximum failed authentication "
+            "attempts per second from one source address before it is "
+            "banned (default: unlimited)", float],
+         ["authFailureBurst", "", 10, "Number of failed authentication "
+            "attempts one source address may make at once", int],
+         ["banTime", "", 300, "Number of seconds a source address is "
+            "banned for", int],
+         ["workers", "", 1, "Number of worker processes to serve "
+            "connections with.  If more than 1, a supervisor process "
+            "listens on the port and restarts workers that exit.", int],
+         ["sharedCache", "", None, "File to cache passwd entries and "
+            "authorized keys in, shared by all worker processes"],
+         ["metricsPort", "", None, "Port on which to serve metrics, in the "
+            "Prometheus text format, on localhost.  With --workers, each "
+            "worker serves its own metrics, on this port plus its index "
+            "(from 0).", int],
+         ["stallThreshold", "", None, "Log the operation and stack of the "
+            "reactor thread whenever it is blocked for longer than this "
+            "many seconds", float],
+         ["profileDir", "", None, "Directory to write profiles of sessions "
+            "to, when profiling is switched on through --adminSocket"],
+         ["maxRequests", "", 128, "Maximum number of requests of one SFTP "
+            "session waiting for responses, before the server stops "
+            "reading the session's requests (0 for no limit)", int],
+         ["maxBufferedBytes", "", 2097152, "Maximum number of bytes of "
+            "responses of one SFTP session waiting for the client's window "
+            "to open, before the server stops reading the session's "
+            "requests (0 for no limit)", int],
+         ["bandwidth", "", None, "Maximum number of bytes per second all "
+            "users together may read and write (default: unlimited).  With "
+            "--workers, each worker has this limit, and shares it out "
+            "among its own sessions only.", int],
+         ["userBandwidth", "", None, "Maximum number of bytes per second "
+            "each user may read and write (default: unlimited).  With "
+            "--workers, this is per user per worker.", int],
+         ["bandwidthLimits", "", None, "File of per-user bandwidth limits "
+            "and weights, with lines of 'AVATARID BYTESPERSECOND [WEIGHT]' "
+            "('*' for everyone else, '-' for no limit).  When there is not "
+            "enough bandwidth, it is shared out by weight.  With --workers, "
+            "limits are per worker."],
+         ["windowSize", "", None, "Initial size in bytes of the window of "
+            "session channels: how much a client may send before waiting "
+            "for the server (default: Conch's, 131072)", int],
+         ["maxPacket", "", None, "Maximum number of bytes of data a client "
+            "may send in one packet on session channels (default: Conch's, "
+            "32768)", int],
+         ["windowStrategy", "", HALF, "When to reopen the window of session "
+            "channels: 'half' (once half of it is used), 'eager' (also once "
+            "three packets of it are used) or 'auto' (eagerly, and growing "
+            "it from the measured round trip time)"],
+         ["maxWindowSize", "", 16777216, "Size in bytes the 'auto' window "
+            "strategy may grow windows up to", int],
+         ["algorithmProfile", "", "default", "Ciphers, MACs and key "
+            "exchanges to offer: 'default' (Conch's) or 'throughput' (AES "
+            "in counter mode, and the cheapest MACs)"],
+         ["ciphers", "", None, "Comma separated ciphers to offer, most "
+            "preferred first, instead of the profile's"],
+         ["macs", "", None, "Comma separated MACs to offer, most preferred "
+            "first, instead of the profile's"],
+         ["kexAlgorithms", "", None, "Comma separated key exchanges to "
+            "offer, most preferred first, instead of the profile's"],
+         ["adminSocket", "", None, "UNIX socket on which to accept admin "
+            "commands ('profile AVATARID', 'profile *', 'unprofile "
+            "AVATARID', 'unprofile *', 'status').  With --workers, each "
+            "worker listens on this path followed by '.' and its index."]
+    ]
+    optFlags = [
+         ["cacheKeys", "", "Cache authorized keys, until the files they "
+            "were read from change (where inotify is supported) or for a "
+            "minute (elsewhere)"],
+         ["checkProbes", "", "Look up keys clients ask about before "
+            "signing with them, so that clients are told straight away "
+            "which keys are not authorized, and no signature is made or "
+            "verified for them"]
     ]
     compData = usage.Completions(optActions={
             "root": usage.CompleteDirs(descr="root directory"),
             "keyDirectory": usage.CompleteDirs(descr="key directory"),
-            "moduli": usage.CompleteDirs(descr="moduli directory")
+            "moduli": usage.CompleteDirs(descr="moduli directory"),
+            "userCAKeys": usage.CompleteFiles(descr="user CA keys file"),
+            "authorizedKeysDB": usage.CompleteFiles(
+                descr="authorized keys database"),
+            "authorizedKeysIndex": usage.CompleteFiles(
+                descr="authorized keys index"),
+            "profileDir": usage.CompleteDirs(descr="profile directory"),
+            "bandwidthLimits": usage.CompleteFiles(
+                descr="bandwidth limits file"),
+            "windowStrategy": usage.CompleteList(STRATEGIES),
+            "algorithmProfile": usage.CompleteList(sorted(PROFILES))
         })
 
+    def postOptions(self):
+        if self['adminSocket'] and not self['profileDir']:
+            raise usage.UsageError("--adminSocket requires --profileDir")
+        keySources = ['authorizedKeysCommand', 'authorizedKeysDB',
+                      'authorizedKeysIndex']
+        if len([name for name in keySources if self[name]]) > 1:
+            raise usage.UsageError("Only one of --" +
+                                   ", --".join(keySources) +
+                                   " may be given")
+        if self['windowStrategy'] not in STRATEGIES:
+            raise usage.UsageError("--windowStrategy must be one of: " +
+                                   ", ".join(STRATEGIES))
+        if self['algorithmProfile'] not in PROFILES:
+            raise usage.UsageError("--algorithmProfile must be one of: " +
+                                   ", ".join(sorted(PROFILES)))
+        for name, supported in [
+                ('ciphers', transport.SSHCiphers.cipherMap),
+                ('macs', transport.SSHCiphers.macMap),
+                ('kexAlgorithms',
+                 transport.SSHTransportBase.supportedKeyExchanges)]:
+            if self[name] is not None:
+                try:
+                    self[name] = parseAlgorithms(self[name], supported)
+                except ValueError as e:
+                    raise usage.UsageError('--{0}: {1}'.format(name, e))
+
+    def parseOptions(self, options=None):
+        """
+        Remember the arguments, so that worker processes can be given the
+        same ones
+        """
+        if options is None:
+            options = sys.argv[1:]
+        self.argv = list(options)
+        usage.Options.parseOptions(self, options)
+
 
 class EssFTPServiceMaker(object):
     implements(IServiceMaker, IPlugin)
@@ -48,15 +213,93 @@ class EssFTPServiceMaker(object):
 
     def makeService(self, options):
         """
-        Construct a TCPServer from a factory defined in myproject.
+        Construct a TCPServer from a factory defined in myproject, or a
+        supervisor for worker processes that each serve the port with that
+        factory.
+        """
+        if options['keyDirectory']:
+            self.makeHostKeys(options['keyDirectory'])
+        if options['workers'] > 1:
+            return WorkerSupervisor(
+                int(options["port"]), options['workers'],
+                'twisted.plugins.essftp_plugin.makeWorkerFactory',
+                options.argv, interface=options['interface'])
+        profiler = self.makeProfiler(options)
+        server = internet.TCPServer(int(options["port"]),
+                                    self.makeFactory(options, profiler),
+                                    interface=options['interface'])
+        monitors = self.makeMonitoringServices(options, profiler=profiler)
+        if not monitors:
+            return server
+
+        services = MultiService()
+        for s in [server] + monitors:
+            s.setServiceParent(services)
+        return services
+
+    def makeHostKeys(self, directory):
+        """
+        Generate the host keys missing from the key directory, once, before
+        any worker process loads them
+        """
+        try:
+            generateHostKeys(directory)
+        except (IOError, OSError) as e:
+            log.msg('Could not generate host keys in {0}: {1}'.format(
+                directory, e))
+
+    def makeProfiler(self, options):
+        """
+        Construct the session profiler, if enabled
+        """
+        if options['profileDir']:
+            return SessionProfiler(options['profileDir'])
+
+    def makeMonitoringServices(self, options, index=None, profiler=None):
+        """
+        Construct the services that serve metrics on localhost, detect
+        stalls and accept admin commands, if enabled
+
+        @param index: C{int} index of the worker process the services are
+            for, if any
+        @param profiler: the L{SessionProfiler} for admin commands to control
+        """
+        monitors = []
+        if options['metricsPort'] is not None:
+            monitors.append(internet.TCPServer(
+                options['metricsPort'] + (index or 0),
+                Site(MetricsResource()), interface='127.0.0.1'))
+        if options['stallThreshold'] is not None:
+            monitors.append(StallDetector(options['stallThreshold']))
+        if options['adminSocket'] and profiler is not None:
+            path = options['adminSocket']
+            if index is not None:
+                path = '{0}.{1}'.format(path, index)
+            monitors.append(internet.UNIXServer(path, AdminFactory(profiler),
+                                                mode=0600))
+        return monitors
+
+    def makeFactory(self, options, profiler=None):
+        """
+        Construct the SSH server factory
+
+        @param profiler: a L{SessionProfiler} to profile sessions with, or
+            C{None}
         """
+        credCheckers = options.get('credCheckers')
+        if credCheckers is None:
+            credCheckers = [self._makeChecker(options)]
+        bandwidth, bandwidthLimits = self._makeBandwidth(options)
         _portal = portal.Portal(
-            essftp.EssFTPRealm(essftp.FilePath(options['root']).path),
-            options.get('credCheckers',
-                        [SSHPublicKeyChecker(UNIXAuthorizedKeysFiles())]))
+            essftp.EssFTPRealm(essftp.FilePath(options['root']).path,
+                               profiler, options['maxRequests'] or None,
+                               options['maxBufferedBytes'] or None,
+                               bandwidth, bandwidthLimits,
+                               self._makeWindow(options)),
+            credCheckers)
 
         if options['keyDirectory']:
-            factory = OpenSSHFactory()
+            factory = EssOpenSSHFactory()
             factory.portal = _portal
             factory.dataRoot = options['keyDirectory']
             factory.moduliRoot = options['moduli']
@@ -64,7 +307,97 @@ class EssFTPServiceMaker(object):
         else:
             factory = ConchFactory(_portal)
 
-        return internet.TCPServer(int(options["port"]), factory)
+        factory.services = dict(factory.services)
+        factory.services['ssh-userauth'] = EssUserAuthServer
+        factory.services['ssh-connection'] = FlowControlledConnection
+        factory.protocol = makeTransport(
+            options['algorithmProfile'], options['ciphers'], options['macs'],
+            options['kexAlgorithms'])
+
+        if options['connectionRate'] or options['authFailureRate']:
+            factory = ThrottlingFactory(factory, SourceThrottle(
+                options['connectionRate'], options['connectionBurst'],
+                options['authFailureRate'], options['authFailureBurst'],
+                options['banTime']))
+        return factory
+
+    def _makeBandwidth(self, options):
+        """
+        Construct the bandwidth scheduler and per-user limits, if enabled
+        """
+        if not (options['bandwidth'] or options['userBandwidth'] or
+                options['bandwidthLimits']):
+            return None, None
+        limits = {}
+        if options['bandwidthLimits']:
+            with open(options['bandwidthLimits']) as f:
+                limits = readBandwidthLimits(f)
+        if options['userBandwidth'] and None not in limits:
+            limits[None] = BandwidthLimit(options['userBandwidth'], None, 1)
+        return BandwidthScheduler(options['bandwidth']), limits
+
+    def _makeWindow(self, options):
+        """
+        Construct the window policy of session channels, unless it is all
+        Conch's defaults
+        """
+        if not (options['windowSize'] or options['maxPacket'] or
+                options['windowStrategy'] != HALF):
+            return None
+        return WindowPolicy(options['windowSize'], options['maxPacket'],
+                            options['windowStrategy'],
+                            options['maxWindowSize'])
+
+    def _makeChecker(self, options):
+        """
+        Construct the default checker
+        """
+        checker = SSHPublicKeyChecker(self._makeKeyDB(options),
+                                      checkProbes=options['checkProbes'])
+        if options['userCAKeys']:
+            with open(options['userCAKeys']) as f:
+                caKeys = list(readAuthorizedKeyFile(f))
+            checker = SSHCertificateChecker(caKeys, fallback=checker)
+        return checker
+
+    def _makeKeyDB(self, options):
+        """
+        Construct the key DB for the default checker
+        """
+        if options['authorizedKeysDB']:
+            return SQLiteAuthorizedKeysDB(options['authorizedKeysDB'])
+        if options['authorizedKeysIndex']:
+            return MappedAuthorizedKeysIndex(options['authorizedKeysIndex'])
+
+        shared = None
+        if options['sharedCache']:
+            shared = SharedMemoryCache(options['sharedCache'])
+
+        if options['authorizedKeysCommand']:
+            from twisted.internet import reactor
+            args = shlex.split(options['authorizedKeysCommand'])
+            command = AuthorizedKeysCommand(args[0], args[1:])
+            reactor.addSystemEventTrigger('before', 'shutdown', command.stop)
+            return CachingAuthorizedKeysDB(CoalescingAuthorizedKeysDB(
+                command), shared=shared)
+
+        userdb = CachingUserDatabase(shared=shared)
+        keydb = UNIXAuthorizedKeysFiles(userdb)
+        if not options['cacheKeys']:
+            return keydb
+
+        watcher = None
+        if platform.supportsINotify():
+            from ess.watcher import FileWatcher
+            watcher = FileWatcher()
+        keydb = CachingAuthorizedKeysDB(keydb, watcher=watcher, shared=shared)
+
+        if watcher is not None:
+            def passwdChanged(filePath):
+                userdb.invalidate()
+                keydb.invalidate()
+            watcher.watch(FilePath('/etc/passwd'), passwdChanged)
+        return keydb
 
 
 # Now construct an object which *provides* the relevant interfaces
@@ -72,3 +405,17 @@ class EssFTPServiceMaker(object):
 # name bound to a provider of IPlugin and IServiceMaker.
 
 serviceMaker = EssFTPServiceMaker()
+
+
+def makeWorkerFactory(argv):
+    """
+    Construct the factory for a worker process (see L{ess.prefork}) from the
+    plugin's command line arguments
+    """
+    options = Options()
+    options.parseOptions(argv)
+    profiler = serviceMaker.makeProfiler(options)
+    for monitor in serviceMaker.makeMonitoringServices(
+            options, workerIndex(), profiler):
+        monitor.startService()
+    return serviceMaker.makeFactory(options, profiler)